@@ -1,41 +1,64 @@
-import asyncio
 import logging
 import warnings
-from io import BytesIO
 
-import nest_asyncio
-import pandas as pd
 import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from streamlit_extras.dataframe_explorer import dataframe_explorer
 
 from llm_plotting.assets.streamlit_txt import MAIN_INSTRUCTIONS
+from llm_plotting.cache import get_answer_cache
+from llm_plotting.dataset import DATAFRAME_FILE_STEM, ingest_csv, table_name
+from llm_plotting.scheduler import SchedulerFullError, get_scheduler
 from llm_plotting.settings import Settings
-from llm_plotting.streamlit_helper import STAgentInterface, display_and_get_agent_settings, display_popup_message
+from llm_plotting.streamlit_helper import (
+    STAgentInterface,
+    display_and_get_agent_settings,
+    display_answer_cache,
+    display_dataset_memory_report,
+    display_latest_trace,
+    display_popup_message,
+    display_scheduler_stats,
+)
 
-nest_asyncio.apply()
 Logger = logging.getLogger(st.__name__)
 warnings.filterwarnings("ignore", category=UserWarning, module="streamlit_extras.dataframe_explorer")
 
 
+def session_is_active(session_id: str) -> bool:
+    return Runtime.instance().is_active_session(session_id)
+
+
 def main():
     settings = Settings()
     st_agent_interface = None
+    session_id = get_script_run_ctx().session_id
+    scheduler = get_scheduler(settings)
+    scheduler.session_is_active = session_is_active
 
     st.title("LLM-Plotting Tool")
     st.write(MAIN_INSTRUCTIONS)
     display_popup_message()
 
     agent_settings = display_and_get_agent_settings()
-    uploaded_file = st.sidebar.file_uploader("Upload CSV", type="csv")
+    uploaded_files = st.sidebar.file_uploader(
+        "Upload CSV", type="csv", accept_multiple_files=True, help="The first file is `df`, others are joinable tables."
+    )
 
     if st.sidebar.button("Confirm Settings"):
-        if uploaded_file is None:
+        if not uploaded_files:
             st.error("You must upload a CSV file before confirming the settings.")
         else:
-            st.session_state.uploaded_file = uploaded_file.getvalue()
-
-            uploaded_file.seek(0)
-            st_agent_interface = STAgentInterface(settings, agent_settings, uploaded_file)
+            dataset = ingest_csv(uploaded_files[0].getvalue())
+            st.session_state.dataset = dataset
+            tables = {}
+            for uploaded_file in uploaded_files[1:]:
+                tables[table_name(uploaded_file.name, tuple(tables))] = ingest_csv(uploaded_file.getvalue())
+            st.session_state.tables = tables
+
+            st_agent_interface = STAgentInterface(
+                settings, agent_settings, dataset, session_id=session_id, tables=tables
+            )
             st.session_state.st_agent_interface = st_agent_interface
             st.session_state.messages = []
 
@@ -46,10 +69,12 @@ def main():
         Please note you can also ask the agent directly questions about the dataset."
     )
 
-    uploaded_file = st.session_state.get("uploaded_file", None)
-    if uploaded_file is not None:
-        uploaded_file = BytesIO(uploaded_file)
-        filtered_df = dataframe_explorer(pd.read_csv(uploaded_file), case=False)
+    dataset = st.session_state.get("dataset", None)
+    if dataset is not None:
+        explored = {DATAFRAME_FILE_STEM: dataset, **st.session_state.get("tables", {})}
+        explored_name = st.selectbox("Table", list(explored)) if len(explored) > 1 else DATAFRAME_FILE_STEM
+        display_dataset_memory_report(explored[explored_name])
+        filtered_df = dataframe_explorer(explored[explored_name].df, case=False)
         st.dataframe(filtered_df)
     else:
         st.markdown("The dataset will be displayed below once you upload a CSV file and confirm the settings.")
@@ -71,7 +96,7 @@ def main():
     if user_input := st.chat_input(
         "Please enter request here",
     ):
-        if uploaded_file is not None:
+        if dataset is not None:
             try:
                 STAgentInterface.store_and_display_message(
                     st.markdown,
@@ -82,15 +107,27 @@ def main():
 
                 if st.session_state.get("st_agent_interface") is not None:
                     st_agent_interface = st.session_state.st_agent_interface
-                    with st.spinner("Running Agent..."):
-                        asyncio.run(st_agent_interface.invoke(user_input))
+                    queued = scheduler.queue_depth
+                    with st.spinner(
+                        f"Running Agent... ({queued} requests queued ahead)" if queued else "Running Agent..."
+                    ):
+                        # the agent runs on the scheduler loop, results are rendered here on the script thread
+                        for chunk in scheduler.stream(session_id, lambda: st_agent_interface.astream(user_input)):
+                            st_agent_interface.render_item(chunk)
                 else:
                     st.error("You must confirm the settings before generating the plot.")
+            except SchedulerFullError as e:
+                st.warning(str(e))
             except Exception as e:
                 st.error(f"Error: {e}")
         else:
             st.error("You must upload a CSV file.")
 
+    display_latest_trace(st.session_state.get("st_agent_interface"))
+    display_scheduler_stats(scheduler)
+    if settings.answer_cache_enabled:
+        display_answer_cache(get_answer_cache(settings), dataset)
+
 
 if __name__ == "__main__":
     main()
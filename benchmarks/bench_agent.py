@@ -0,0 +1,271 @@
+"""End to end latency and throughput of STAgentInterface.invoke with local stand-ins for every
+external service: a scripted chat model, sandboxes running code in local processes and a
+stub of the vision endpoint. Runs every combination of dataset size, agent iterations and
+concurrent sessions and writes the results as JSON so runs can be compared. Stage timings
+are taken from the spans recorded for each request.
+
+python -m benchmarks.bench_agent --rows 1e3 1e5 --iterations 1 3 --sessions 1 4 --output bench_agent.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from langchain_core.messages import AIMessage
+
+from llm_plotting.dataset import IngestedDataset, ingest_csv
+from llm_plotting.executors import E2BExecutionBackend, ExecutionBackend, create_execution_backend
+from llm_plotting.prompts import IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE
+from llm_plotting.sandbox import LocalSandbox, SandboxPool
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.streamlit_helper import STAgentInterface
+from llm_plotting.tools import CodeValidationTool
+from llm_plotting.tracing import Trace
+from tests.stubs import ScriptedChatModel, VisionStubServer, tool_call_message
+
+FINAL_ATTEMPT_MARKER = "# final attempt"
+REJECTION = "The plot needs a clearer title, mention the aggregation in it."
+
+
+class StageTimings:
+    """Wall clock seconds per stage, collected from every session of a scenario."""
+
+    def __init__(self):
+        self.seconds: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage].append(seconds)
+
+    def record_trace(self, trace: Trace):
+        for span in trace.spans:
+            self.record(span.name, span.duration)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                "count": len(values),
+                "total_s": round(sum(values), 4),
+                "mean_s": round(statistics.mean(values), 4),
+                "p95_s": round(float(np.percentile(values, 95)), 4),
+            }
+            for stage, values in sorted(self.seconds.items())
+        }
+
+
+def make_csv(n_rows: int) -> bytes:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "salary": rng.normal(100_000, 30_000, n_rows).round(2),
+            "work_year": rng.integers(2020, 2024, n_rows),
+            "job_title": rng.choice([f"job {i}" for i in range(50)], n_rows),
+        }
+    )
+    buffer = BytesIO()
+    df.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def scripted_responses(load_code: str, iterations: int) -> List[AIMessage]:
+    """Plotting code for ``iterations`` tool calls, the vision stub only accepts the last one."""
+    responses = []
+    for attempt in range(1, iterations + 1):
+        marker = FINAL_ATTEMPT_MARKER if attempt == iterations else f"# attempt {attempt}"
+        code = "\n".join(
+            [
+                "import pandas as pd",
+                "import plotly.express as px",
+                load_code,
+                "top = df.groupby('job_title', as_index=False)['salary'].mean().nlargest(20, 'salary')",
+                f"fig = px.bar(top, x='salary', y='job_title', orientation='h', title='Attempt {attempt}')",
+                marker,
+            ]
+        )
+        responses.append(tool_call_message(code, description="average salary of the top 20 jobs"))
+    responses.append(AIMessage(content="Here is the average salary of the top 20 jobs."))
+    return responses
+
+
+def vision_verdict(payload: Dict) -> str:
+    prompt = payload["messages"][1]["content"][0]["text"]
+    return IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE if FINAL_ATTEMPT_MARKER in prompt else REJECTION
+
+
+def make_settings(api_base: str, backend: str) -> Settings:
+    # caches are off, every session repeats the same script and would otherwise be served from them
+    return Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        openai_api_base=api_base,
+        execution_backend="local" if backend == "local" else "e2b",
+        execution_cache_enabled=False,
+        validation_cache_enabled=False,
+        answer_cache_enabled=False,
+    )
+
+
+def make_backend(settings: Settings, dataset: IngestedDataset, sandbox_pool: Optional[SandboxPool]) -> ExecutionBackend:
+    if sandbox_pool is not None:
+        return E2BExecutionBackend(sandbox_pool)
+    return create_execution_backend(settings, dataset.sandbox_df)
+
+
+async def run_session(
+    settings: Settings,
+    dataset: IngestedDataset,
+    iterations: int,
+    timings: StageTimings,
+    sandbox_pool: Optional[SandboxPool],
+    llm_latency: float,
+) -> Tuple[float, bool]:
+    start = time.perf_counter()
+    code_validation_tool = CodeValidationTool(
+        settings=settings,
+        df=dataset.df,
+        sandbox_df=dataset.sandbox_df,
+        execution_backend=make_backend(settings, dataset, sandbox_pool),
+    )
+    llm = ScriptedChatModel(responses=scripted_responses(dataset.sandbox_df.load_code, iterations), latency=llm_latency)
+    st_agent_interface = STAgentInterface(
+        settings,
+        AgentSettings(max_iterations=iterations + 1),
+        dataset,
+        execute_st_funcs=False,
+        llm=llm,
+        code_validation_tool=code_validation_tool,
+    )
+    timings.record("session_setup", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        chunks = await st_agent_interface.invoke("Please make a plot of the average salary of the top 20 jobs")
+    finally:
+        if sandbox_pool is None:
+            code_validation_tool.get_execution_backend().close()
+    elapsed = time.perf_counter() - start
+    timings.record_trace(st_agent_interface.latest_trace)
+    return elapsed, any("output" in chunk["chunk"] for chunk in chunks)
+
+
+async def run_scenario(
+    n_rows: int,
+    iterations: int,
+    sessions: int,
+    backend: str = "sandbox",
+    llm_latency: float = 0.0,
+    vision_latency: float = 0.0,
+) -> Dict:
+    timings = StageTimings()
+    with VisionStubServer(verdict=vision_verdict, latency=vision_latency) as server:
+        settings = make_settings(server.api_base, backend)
+
+        start = time.perf_counter()
+        dataset = ingest_csv(make_csv(n_rows))
+        timings.record("ingest", time.perf_counter() - start)
+
+        sandbox_pool = None
+        if backend == "sandbox":
+            sandbox_pool = SandboxPool(sandbox_factory=LocalSandbox, size=sessions)
+            sandbox_pool.warm(block=True)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            outcomes = await asyncio.gather(
+                *[
+                    run_session(settings, dataset, iterations, timings, sandbox_pool, llm_latency)
+                    for _ in range(sessions)
+                ]
+            )
+        finally:
+            wall_time = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if sandbox_pool is not None:
+                sandbox_pool.close()
+        vision_requests = server.requests_received
+
+    latencies = [elapsed for elapsed, _ in outcomes]
+    return {
+        "rows": n_rows,
+        "iterations": iterations,
+        "sessions": sessions,
+        "backend": backend,
+        "wall_time_s": round(wall_time, 4),
+        "requests_per_s": round(sessions / wall_time, 4),
+        "latency_mean_s": round(statistics.mean(latencies), 4),
+        "latency_max_s": round(max(latencies), 4),
+        "completed_sessions": sum(completed for _, completed in outcomes),
+        "vision_requests": vision_requests,
+        "peak_traced_mb": round(peak / 1024**2, 2),
+        "stages": timings.summary(),
+    }
+
+
+def max_rss_mb() -> Dict[str, float]:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1024**2 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 2),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 2),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Union[Dict, List]]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=float, nargs="+", default=[1e3, 1e5])
+    parser.add_argument("--iterations", type=int, nargs="+", default=[1, 3], help="tool calls until a plot is accepted")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4], help="concurrent sessions")
+    parser.add_argument(
+        "--backend",
+        choices=["sandbox", "local"],
+        default="sandbox",
+        help="local sandboxes behind the sandbox pool, or the local process execution backend",
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="scripted chat model latency in seconds")
+    parser.add_argument("--vision-latency", type=float, default=0.0, help="vision stub latency in seconds")
+    parser.add_argument("--output", default="bench_agent.json")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'rows':>10}{'iterations':>12}{'sessions':>10}{'wall (s)':>10}{'req/s':>8}{'peak (MB)':>11}")
+    for n_rows in map(int, args.rows):
+        for iterations in args.iterations:
+            for sessions in args.sessions:
+                result = asyncio.run(
+                    run_scenario(n_rows, iterations, sessions, args.backend, args.llm_latency, args.vision_latency)
+                )
+                results.append(result)
+                print(
+                    f"{n_rows:>10}{iterations:>12}{sessions:>10}{result['wall_time_s']:>10.3f}"
+                    f"{result['requests_per_s']:>8.2f}{result['peak_traced_mb']:>11.1f}"
+                )
+
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "arguments": vars(args),
+        "max_rss_mb": max_rss_mb(),
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
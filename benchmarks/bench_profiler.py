@@ -0,0 +1,62 @@
+"""Compare the streaming profiler with the exact describe() based metadata extraction.
+
+python -m benchmarks.bench_profiler --rows 1e5 1e7 1e8 --legacy-max-rows 1e7
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from llm_plotting.profiler import iter_chunks, profile_chunks
+from llm_plotting.prompt_helper import extract_metadata
+
+
+def make_df(n_rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "salary": rng.normal(100_000, 30_000, n_rows),
+            "work_year": rng.integers(2020, 2024, n_rows),
+            "job_title": pd.Categorical.from_codes(rng.integers(0, 100, n_rows), [f"job {i}" for i in range(100)]),
+            "posted_at": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**8, n_rows), unit="s"),
+        }
+    )
+
+
+def measure(func):
+    """Time a run on its own, then trace a second run for peak memory as tracing slows it down."""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=float, nargs="+", default=[1e5, 1e7, 1e8])
+    parser.add_argument(
+        "--legacy-max-rows", type=float, default=1e7, help="skip the exact extraction above this many rows"
+    )
+    args = parser.parse_args()
+
+    print(f"{'rows':>12}{'method':>12}{'time (s)':>12}{'peak extra (MB)':>18}")
+    for n_rows in map(int, args.rows):
+        df = make_df(n_rows)
+        if n_rows <= args.legacy_max_rows:
+            elapsed, peak = measure(lambda: extract_metadata(df, exact_row_limit=float("inf")))
+            print(f"{n_rows:>12}{'describe':>12}{elapsed:>12.3f}{peak:>18.1f}")
+
+        elapsed, peak = measure(lambda: profile_chunks(iter_chunks(df, 1_000_000)))
+        print(f"{n_rows:>12}{'profiler':>12}{elapsed:>12.3f}{peak:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compare image validation request strategies against a local stub of the vision endpoint.
+
+python -m benchmarks.bench_validation_http --requests 20 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import time
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+from llm_plotting.settings import Settings
+from llm_plotting.tools import CodeValidationTool
+from tests.stubs import VisionStubServer
+
+
+def make_tool(api_base: str) -> CodeValidationTool:
+    settings = Settings(
+        openai_api_key="key", e2b_api_key="key", openai_api_base=api_base, validation_cache_enabled=False
+    )
+    return CodeValidationTool(settings=settings)
+
+
+def make_image_in_bytes() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (800, 600), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def bench_new_connection_per_call(code_validation_tool, image_in_bytes, n_requests):
+    for _ in range(n_requests):
+        url, headers, payload = code_validation_tool._image_validation_request(image_in_bytes, "plot", "code")
+        requests.post(url, headers=headers, json=payload).raise_for_status()
+
+
+def bench_shared_session(code_validation_tool, image_in_bytes, n_requests):
+    for _ in range(n_requests):
+        code_validation_tool._validate_image(image_in_bytes, "plot", "code")
+
+
+def bench_async_shared_client(code_validation_tool, image_in_bytes, n_requests):
+    async def run():
+        await asyncio.gather(
+            *[code_validation_tool._avalidate_image(image_in_bytes, "plot", "code") for _ in range(n_requests)]
+        )
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub server response latency in seconds")
+    args = parser.parse_args()
+
+    image_in_bytes = make_image_in_bytes()
+    benches = [
+        ("new connection per call", bench_new_connection_per_call),
+        ("sync shared session", bench_shared_session),
+        ("async shared client", bench_async_shared_client),
+    ]
+
+    print(f"{'strategy':<26}{'total (s)':>12}{'req/s':>10}{'connections':>14}")
+    for name, bench in benches:
+        with VisionStubServer(latency=args.latency) as server:
+            code_validation_tool = make_tool(server.api_base)
+            start = time.perf_counter()
+            bench(code_validation_tool, image_in_bytes, args.requests)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<26}{elapsed:>12.3f}{args.requests / elapsed:>10.1f}{len(server.connections):>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import pandas as pd
 import pytest
 
 from llm_plotting.settings import AgentSettings, Settings
+from tests.stubs import VisionStubServer
 
 
 @pytest.fixture
@@ -20,3 +21,9 @@ def agent_settings():
         max_iterations=4,
         code_generation_llm_temperature=0.0,
     )
+
+
+@pytest.fixture
+def vision_stub_server():
+    with VisionStubServer() as server:
+        yield server
@@ -1,60 +1,147 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
 import pandas as pd
 from langchain.agents import AgentExecutor, create_openai_functions_agent
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.memory import ConversationBufferMemory
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_openai import ChatOpenAI
 
-from llm_plotting.prompts import CODE_GENERATION_AGENT_PROMPT
+from llm_plotting.dataset import SandboxDataFrame
+from llm_plotting.executors import ExecutionBackend
+from llm_plotting.memory import TokenBudgetMemory
+from llm_plotting.prompt_helper import encode_metadata, encode_tables_metadata
+from llm_plotting.prompts import CODE_GENERATION_AGENT_PROMPT, TABLES_INSTRUCTIONS
+from llm_plotting.scheduler import LimitedChatModel
 from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.speculative import SpeculativeAgentExecutor
+from llm_plotting.streaming import TokenStreamCallbackHandler
 from llm_plotting.tools import CodeValidationTool
+from llm_plotting.tracing import Tracer, TracingCallbackHandler
 
 
-class MyStreamingCallback(StreamingStdOutCallbackHandler):
-    def __init__(self):
-        self.content = ""
-        self.final_answer = False
-
-    async def on_lm_new_token(self, token):
-        self.content += token
-        if "final_answer" in self.content:
-            self.final_answer = True
-            self.content = ""
-        if self.final_answer:
-            print(token)
+def _build_llm(settings: Settings, temperature: float) -> BaseChatModel:
+    return ChatOpenAI(
+        model_name="gpt-4-0125-preview",
+        api_key=settings.openai_api_key,
+        temperature=temperature,
+        streaming=True,
+        max_tokens=1500,
+    )
 
 
-def setup_agent_executor(settings: Settings, agent_settings: AgentSettings, df: pd.DataFrame):
+def setup_agent_executor(
+    settings: Settings,
+    agent_settings: AgentSettings,
+    df: pd.DataFrame,
+    sandbox_df: Optional[SandboxDataFrame] = None,
+    llm: Optional[BaseChatModel] = None,
+    code_validation_tool: Optional[CodeValidationTool] = None,
+    execution_backend: Optional[ExecutionBackend] = None,
+    tables: Optional[List[SandboxDataFrame]] = None,
+):
 
-    code_validation_tool = CodeValidationTool(
+    code_validation_tool = code_validation_tool or CodeValidationTool(
         df=df,
+        sandbox_df=sandbox_df,
         settings=settings,
         temperature=agent_settings.image_validation_llm_temperature,
+        image_format=agent_settings.image_format,
+        image_width=agent_settings.image_width,
+        image_height=agent_settings.image_height,
+        image_scale=agent_settings.image_scale,
+        execution_backend=execution_backend,
+        tables=tables or [],
     )
     tools = [code_validation_tool]
+    llm_calls = code_validation_tool.get_scheduler().llm_calls
+    # callbacks given to the executor are not passed on to the model, so they are bound to the model itself
+    llm_callbacks = [TracingCallbackHandler(code_validation_tool.get_tracer()), TokenStreamCallbackHandler()]
 
-    llm = ChatOpenAI(
-        model_name="gpt-4-0125-preview",
-        api_key=settings.openai_api_key,
-        temperature=agent_settings.code_generation_llm_temperature,
-        streaming=True,
-        callbacks=[MyStreamingCallback()],
-        max_tokens=1500,
+    agent = create_openai_functions_agent(
+        LimitedChatModel(
+            llm=llm or _build_llm(settings, agent_settings.code_generation_llm_temperature), limit=llm_calls
+        ).with_config(callbacks=llm_callbacks),
+        tools,
+        CODE_GENERATION_AGENT_PROMPT,
     )
-
-    agent = create_openai_functions_agent(llm, tools, CODE_GENERATION_AGENT_PROMPT)
-    memory = ConversationBufferMemory(
+    memory = TokenBudgetMemory(
         memory_key="chat_history",
         input_key="user_input",
         output_key="output",
         return_messages=True,
+        token_budget=settings.memory_token_budget,
+        columns=[
+            str(column) for sandbox_df in code_validation_tool.get_sandbox_dfs() for column in sandbox_df.df.columns
+        ],
+        tracer=code_validation_tool.get_tracer(),
     )
 
-    return AgentExecutor(
+    executor_kwargs = dict(
         agent=agent,
         tools=tools,
         verbose=True,
-        return_intermediate_steps=False,
+        # the memory keeps the code accepted in each turn
+        return_intermediate_steps=True,
         handle_parsing_errors=True,
         max_iterations=agent_settings.max_iterations,
         memory=memory,
     )
+    if agent_settings.num_candidates <= 1:
+        return AgentExecutor(**executor_kwargs)
+
+    candidate_agent = create_openai_functions_agent(
+        LimitedChatModel(
+            llm=llm or _build_llm(settings, agent_settings.candidate_llm_temperature), limit=llm_calls
+        ).with_config(callbacks=llm_callbacks),
+        tools,
+        CODE_GENERATION_AGENT_PROMPT,
+    )
+    return SpeculativeAgentExecutor(
+        **executor_kwargs,
+        candidate_agent=candidate_agent,
+        num_candidates=agent_settings.num_candidates,
+        max_parallel_candidates=agent_settings.max_parallel_candidates,
+    )
+
+
+def build_agent_inputs(
+    user_input: str,
+    df: pd.DataFrame,
+    sandbox_df: SandboxDataFrame,
+    metadata_token_budget: int,
+    tracer: Tracer,
+    tables: Sequence[SandboxDataFrame] = (),
+) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """Inputs of the agent prompt for a question, along with the prompt size metrics of the
+    dataframe metadata. Additional ``tables`` share the metadata budget with the dataframe.
+    """
+    if not tables:
+        with tracer.span("agent.metadata") as span:
+            metadata_json, metadata_metrics = encode_metadata(
+                df, user_input, metadata_token_budget, fingerprint=sandbox_df.fingerprint
+            )
+            span.set(**metadata_metrics)
+        agent_inputs = {
+            "user_input": user_input,
+            "metadata_json": metadata_json,
+            "dataframe_filename": sandbox_df.filename,
+            "dataframe_load_code": sandbox_df.load_code,
+        }
+        return agent_inputs, metadata_metrics
+
+    sandbox_dfs = [sandbox_df, *tables]
+    with tracer.span("agent.metadata", tables=len(sandbox_dfs)) as span:
+        metadata_json, metadata_metrics = encode_tables_metadata(
+            {table.file_stem: table.df for table in sandbox_dfs},
+            user_input,
+            metadata_token_budget,
+            fingerprints={table.file_stem: table.fingerprint for table in sandbox_dfs},
+        )
+        span.set(**metadata_metrics)
+    agent_inputs = {
+        "user_input": user_input,
+        "metadata_json": metadata_json,
+        "dataframe_filename": ", ".join(table.filename for table in sandbox_dfs),
+        "dataframe_load_code": "; ".join(table.load_code for table in sandbox_dfs),
+        "tables_instructions": TABLES_INSTRUCTIONS,
+    }
+    return agent_inputs, metadata_metrics
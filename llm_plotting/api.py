@@ -0,0 +1,324 @@
+"""Asynchronous HTTP API serving the agent without Streamlit.
+
+POST /datasets                         upload a CSV, as the request body or a multipart ``file``
+                                       field, returns its ``fingerprint``
+POST /datasets/{fingerprint}/questions ask a question about an uploaded dataset, the agent's
+                                       actions, observations, figures and final answer are
+                                       streamed back as server sent events, with ``delta``
+                                       events carrying the code and text as it is generated
+GET  /healthz                          liveness and readiness probe
+
+Requests carry everything needed to answer them and uploads are stored under their content
+hash in ``API_DATASET_DIR``, so with a shared directory any replica can serve any request.
+
+python -m llm_plotting.api --port 8080
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import streamlit as st
+from aiohttp import web
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import ValidationError
+
+from llm_plotting.agent import build_agent_inputs, setup_agent_executor
+from llm_plotting.dataset import IngestedDataset, get_ingested, ingest_csv
+from llm_plotting.events import AgentEvent, chunk_to_events
+from llm_plotting.executors import ExecutionBackend, create_execution_backend
+from llm_plotting.image_store import ImageStore
+from llm_plotting.rendering import PLOTLY_JSON_MIME_TYPE
+from llm_plotting.scheduler import RequestScheduler, SchedulerFullError, get_scheduler
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.streaming import BackgroundCalls, StreamDelta, astream_with_tokens
+
+Logger = logging.getLogger(st.__name__)
+
+FINGERPRINT_PATTERN = re.compile(r"[0-9a-f]{64}")
+# bounds of the numeric agent settings a client may ask for, the counts multiply the work per
+# question and the image size the memory of rendering it
+AGENT_SETTINGS_LIMITS = {
+    "max_iterations": (1, 10),
+    "num_candidates": (1, 4),
+    "max_parallel_candidates": (1, 4),
+    "code_generation_llm_temperature": (0.0, 2.0),
+    "image_validation_llm_temperature": (0.0, 2.0),
+    "candidate_llm_temperature": (0.0, 2.0),
+    "image_width": (100, 2000),
+    "image_height": (100, 2000),
+    "image_scale": (0.1, 2.0),
+}
+
+
+def sse_message(event: str, data: Dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def image_event_data(image_store: ImageStore, handle: str) -> Optional[Dict]:
+    """Figure stored under ``handle``, Plotly JSON as text and images base64 encoded."""
+    stored_figure = image_store.get(handle)
+    if stored_figure is None:
+        return None
+    if stored_figure.mime_type == PLOTLY_JSON_MIME_TYPE:
+        data = stored_figure.data.decode("utf-8")
+    else:
+        data = base64.b64encode(stored_figure.data).decode("ascii")
+    return {"handle": handle, "mime_type": stored_figure.mime_type, "data": data}
+
+
+class AgentService:
+    """Stores uploads and runs one agent per question. Nothing about a request outlives it
+    apart from caches, the parsed datasets and their execution backends.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        scheduler: Optional[RequestScheduler] = None,
+        llm_factory: Optional[Callable[[], BaseChatModel]] = None,
+        max_backends: int = 8,
+    ):
+        self.settings = settings
+        self.scheduler = scheduler or get_scheduler(settings)
+        self.llm_factory = llm_factory
+        self.max_backends = max_backends
+
+        self._backends: "OrderedDict[str, ExecutionBackend]" = OrderedDict()
+        self._backend_users: Dict[ExecutionBackend, int] = {}
+        self._backends_lock = threading.Lock()
+        os.makedirs(settings.api_dataset_dir, exist_ok=True)
+
+    def dataset_path(self, fingerprint: str) -> str:
+        return os.path.join(self.settings.api_dataset_dir, f"{fingerprint}.csv")
+
+    def store_dataset(self, data: bytes) -> IngestedDataset:
+        dataset = ingest_csv(data)
+        path = self.dataset_path(dataset.content_hash)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        return dataset
+
+    def load_dataset(self, fingerprint: str) -> Optional[IngestedDataset]:
+        """The uploaded dataset, parsed again from the shared directory when another replica
+        received the upload or it was evicted from the cache.
+        """
+        if not FINGERPRINT_PATTERN.fullmatch(fingerprint):
+            return None
+        dataset = get_ingested(fingerprint)
+        if dataset is not None:
+            return dataset
+        try:
+            with open(self.dataset_path(fingerprint), "rb") as file:
+                return ingest_csv(file)
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def execution_backend(self, dataset: IngestedDataset) -> Iterator[ExecutionBackend]:
+        """The execution backend of the dataset, shared by the requests about it. Beyond
+        ``max_backends`` the least recently used backends are dropped, and closed once no
+        request uses them any more.
+        """
+        with self._backends_lock:
+            backend = self._backends.get(dataset.content_hash)
+            if backend is None:
+                backend = create_execution_backend(self.settings, dataset.sandbox_df)
+                self._backends[dataset.content_hash] = backend
+            self._backends.move_to_end(dataset.content_hash)
+            self._backend_users[backend] = self._backend_users.get(backend, 0) + 1
+            evicted = []
+            while len(self._backends) > self.max_backends:
+                evicted.append(self._backends.popitem(last=False)[1])
+        self._close_unused(evicted)
+        try:
+            yield backend
+        finally:
+            with self._backends_lock:
+                self._backend_users[backend] -= 1
+                dropped = [backend] if backend not in self._backends.values() else []
+            self._close_unused(dropped)
+
+    def _close_unused(self, backends: List[ExecutionBackend]):
+        for backend in backends:
+            with self._backends_lock:
+                if self._backend_users.get(backend, 0) > 0:
+                    continue
+                self._backend_users.pop(backend, None)
+            backend.close()
+
+    async def answer(
+        self, dataset: IngestedDataset, question: str, agent_settings: AgentSettings
+    ) -> AsyncIterator[bytes]:
+        """Server sent events of the agent answering ``question``."""
+        with self.execution_backend(dataset) as execution_backend:
+            agent_executor = setup_agent_executor(
+                self.settings,
+                agent_settings,
+                dataset.df,
+                dataset.sandbox_df,
+                llm=self.llm_factory() if self.llm_factory is not None else None,
+                execution_backend=execution_backend.for_request(),
+            )
+            code_validation_tool = agent_executor.tools[0]
+            image_store = code_validation_tool.get_image_store()
+            tracer = code_validation_tool.get_tracer()
+
+            background_calls = BackgroundCalls()
+
+            def on_tool_code_start(tool_name: str, imports: str):
+                if tool_name == code_validation_tool.name:
+                    background_calls.start(code_validation_tool.aprewarm(imports), "Sandbox prewarm")
+
+            with tracer.span("api.request", question_chars=len(question)):
+                agent_inputs, _ = build_agent_inputs(
+                    question, dataset.df, dataset.sandbox_df, self.settings.metadata_token_budget, tracer
+                )
+                try:
+                    async for chunk in astream_with_tokens(agent_executor.astream(agent_inputs), on_tool_code_start):
+                        if isinstance(chunk, StreamDelta):
+                            yield sse_message("delta", chunk.model_dump())
+                            continue
+                        for event in chunk_to_events(chunk, image_store):
+                            yield self._event_message(event)
+                            if event.figure_handle is not None:
+                                image = image_event_data(image_store, event.figure_handle)
+                                if image is not None:
+                                    yield sse_message("image", image)
+                finally:
+                    await background_calls.wait()
+                    await asyncio.to_thread(code_validation_tool.release_prewarmed)
+
+    @staticmethod
+    def _event_message(event: AgentEvent) -> bytes:
+        return sse_message(event.event, event.model_dump(exclude={"event"}, exclude_none=True))
+
+    def close(self):
+        with self._backends_lock:
+            backends, self._backends = list(self._backends.values()), OrderedDict()
+        for backend in backends:
+            backend.close()
+
+
+async def upload_dataset(request: web.Request) -> web.Response:
+    service: AgentService = request.app["service"]
+    if request.content_type.startswith("multipart/"):
+        form = await request.post()
+        field = form.get("file")
+        if not isinstance(field, web.FileField):
+            raise web.HTTPBadRequest(text="Send the CSV as a multipart field named `file`.")
+        data = field.file.read()
+    else:
+        data = await request.read()
+    if not data:
+        raise web.HTTPBadRequest(text="The uploaded CSV is empty.")
+
+    try:
+        dataset = await asyncio.to_thread(service.store_dataset, data)
+    except Exception as e:
+        raise web.HTTPBadRequest(text=f"Could not parse the CSV: {e}")
+    return web.json_response(
+        {
+            "fingerprint": dataset.content_hash,
+            "rows": len(dataset.df),
+            "columns": [str(column) for column in dataset.df.columns],
+        }
+    )
+
+
+async def ask_question(request: web.Request) -> web.StreamResponse:
+    service: AgentService = request.app["service"]
+    try:
+        body = await request.json()
+        question = body["question"]
+        agent_settings = AgentSettings(**body.get("agent_settings", {}))
+    except (json.JSONDecodeError, KeyError, TypeError, ValidationError) as e:
+        raise web.HTTPBadRequest(text=f"Expected a JSON body with a `question` and optional `agent_settings`: {e}")
+    for field, (low, high) in AGENT_SETTINGS_LIMITS.items():
+        value = getattr(agent_settings, field)
+        if value is not None:
+            setattr(agent_settings, field, max(low, min(value, high)))
+
+    dataset = await asyncio.to_thread(service.load_dataset, request.match_info["fingerprint"])
+    if dataset is None:
+        raise web.HTTPNotFound(text="Unknown dataset, upload it again.")
+
+    # the session id only decides whose turn it is in the scheduler, no state is kept for it
+    session_id = body.get("session_id") or uuid.uuid4().hex
+    messages = service.scheduler.astream(session_id, lambda: service.answer(dataset, question, agent_settings))
+    # the first message is awaited before the response starts, so a full queue can still be a 429
+    first_message, error = None, None
+    try:
+        first_message = await anext(messages)
+    except SchedulerFullError as e:
+        raise web.HTTPTooManyRequests(text=str(e))
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        error = e
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    try:
+        if first_message is not None:
+            await response.write(first_message)
+            async for message in messages:
+                await response.write(message)
+    except ConnectionResetError:
+        Logger.info("Client disconnected, stopping the agent")
+        return response
+    except Exception as e:
+        error = e
+    finally:
+        await messages.aclose()
+
+    if error is not None:
+        Logger.error(f"Error answering question: {error}")
+        await response.write(sse_message("error", {"message": str(error)}))
+    else:
+        await response.write(sse_message("done", {}))
+    return response
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", **request.app["service"].scheduler.stats()})
+
+
+def create_app(service: AgentService) -> web.Application:
+    app = web.Application(client_max_size=service.settings.api_max_upload_mb * 1024**2)
+    app["service"] = service
+    app.router.add_post("/datasets", upload_dataset)
+    app.router.add_post("/datasets/{fingerprint}/questions", ask_question)
+    app.router.add_get("/healthz", healthz)
+
+    async def close_service(app: web.Application):
+        service.close()
+
+    app.on_cleanup.append(close_service)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(AgentService(Settings())), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
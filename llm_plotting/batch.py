@@ -0,0 +1,281 @@
+"""Headless batch mode, runs many (dataset, question) jobs without Streamlit.
+
+Jobs are read from a JSON lines file, one ``{"dataset": "path.csv", "question": "...", "id": "..."}``
+per line, ``id`` is optional. Each job writes ``result.json``, along with ``figure.json`` and an
+image of the accepted figure, to its own directory under the output directory. Jobs whose result
+is already there are skipped, so a crashed run is resumed by running it again.
+
+python -m llm_plotting.batch jobs.jsonl --output-dir charts --concurrency 8
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+import streamlit as st
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import BaseModel
+
+from llm_plotting.agent import build_agent_inputs, setup_agent_executor
+from llm_plotting.dataset import IngestedDataset, ingest_csv
+from llm_plotting.executors import ExecutionBackend, create_execution_backend
+from llm_plotting.rendering import PLOTLY_JSON_MIME_TYPE
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.speculative import is_accepted
+from llm_plotting.tools import CodeValidationTool
+from llm_plotting.tracing import Trace, get_tracer
+
+Logger = logging.getLogger(st.__name__)
+
+RESULT_FILENAME = "result.json"
+SUMMARY_FILENAME = "summary.jsonl"
+
+
+class BatchJob(BaseModel):
+    id: str
+    dataset: str
+    question: str
+
+
+class JobResult(BaseModel):
+    id: str
+    dataset: str
+    question: str
+    status: str
+    answer: Optional[str] = None
+    code: Optional[str] = None
+    description: Optional[str] = None
+    figure_files: List[str] = []
+    error: Optional[str] = None
+    wall_time_s: float = 0.0
+    timings: Dict[str, float] = {}
+
+
+def read_jobs(path: str) -> List[BatchJob]:
+    jobs = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if "id" not in job:
+                key = f"{job['dataset']}\n{job['question']}".encode("utf-8")
+                job["id"] = hashlib.sha256(key).hexdigest()[:16]
+            jobs.append(BatchJob(**job))
+
+    ids = [job.id for job in jobs]
+    duplicates = sorted({job_id for job_id in ids if ids.count(job_id) > 1})
+    if duplicates:
+        raise ValueError(f"Job ids must be unique, these appear more than once: {', '.join(duplicates)}")
+    return jobs
+
+
+def _write_atomic(path: str, data: bytes):
+    # a crash mid write leaves the temporary file behind, never a truncated result
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def stage_timings(trace: Optional[Trace]) -> Dict[str, float]:
+    """Seconds spent per stage of a job, summed over the spans of the same name."""
+    timings: Dict[str, float] = defaultdict(float)
+    for span in trace.spans if trace is not None else []:
+        timings[span.name] += span.duration
+    return {stage: round(seconds, 4) for stage, seconds in sorted(timings.items())}
+
+
+class BatchRunner:
+    """Runs jobs concurrently, at most ``concurrency`` at a time.
+
+    Jobs on the same file share one ingested dataset, so the file is parsed, profiled and
+    fingerprinted once. They also share one execution backend: local worker processes load the
+    dataframe once and pooled sandboxes skip uploads of a dataframe they already hold.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        agent_settings: AgentSettings,
+        output_dir: str,
+        concurrency: int = 4,
+        retry_failed: bool = False,
+        llm_factory: Optional[Callable[[BatchJob], BaseChatModel]] = None,
+    ):
+        self.settings = settings
+        self.agent_settings = agent_settings
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.retry_failed = retry_failed
+        self.llm_factory = llm_factory
+
+        self._datasets: Dict[str, IngestedDataset] = {}
+        self._backends: Dict[str, ExecutionBackend] = {}
+        self._dataset_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._summary_lock = asyncio.Lock()
+
+    def job_dir(self, job: BatchJob) -> str:
+        return os.path.join(self.output_dir, job.id)
+
+    def load_result(self, job: BatchJob) -> Optional[JobResult]:
+        try:
+            with open(os.path.join(self.job_dir(job), RESULT_FILENAME)) as file:
+                return JobResult.model_validate_json(file.read())
+        except FileNotFoundError:
+            return None
+
+    def is_finished(self, job: BatchJob) -> bool:
+        result = self.load_result(job)
+        return result is not None and (result.status == "done" or not self.retry_failed)
+
+    async def run(self, jobs: List[BatchJob]) -> List[JobResult]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        pending = [job for job in jobs if not self.is_finished(job)]
+        Logger.info(f"Running {len(pending)} of {len(jobs)} jobs, the others have results already")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_limited(job: BatchJob) -> JobResult:
+            async with semaphore:
+                return await self.run_job(job)
+
+        try:
+            await asyncio.gather(*[run_limited(job) for job in pending])
+        finally:
+            self.close()
+        return [self.load_result(job) for job in jobs]
+
+    async def run_job(self, job: BatchJob) -> JobResult:
+        start = time.perf_counter()
+        tracer = get_tracer(self.settings)
+        result = JobResult(id=job.id, dataset=job.dataset, question=job.question, status="failed")
+        try:
+            with tracer.span("batch.job", session_id=job.id, dataset=job.dataset):
+                await self._run_agent(job, result)
+        except Exception as e:
+            Logger.error(f"Job {job.id} failed: {e}")
+            result.error = f"{type(e).__name__}: {e}"
+
+        result.wall_time_s = round(time.perf_counter() - start, 4)
+        result.timings = stage_timings(tracer.latest_trace(job.id))
+        await self._write_result(job, result)
+        return result
+
+    async def _dataset(self, path: str) -> IngestedDataset:
+        async with self._dataset_locks[path]:
+            if path not in self._datasets:
+                with get_tracer().span("batch.ingest", path=path):
+                    with open(path, "rb") as file:
+                        self._datasets[path] = await asyncio.to_thread(ingest_csv, file)
+            return self._datasets[path]
+
+    def _execution_backend(self, path: str, dataset: IngestedDataset) -> ExecutionBackend:
+        if path not in self._backends:
+            self._backends[path] = create_execution_backend(self.settings, dataset.sandbox_df)
+        return self._backends[path]
+
+    async def _run_agent(self, job: BatchJob, result: JobResult):
+        dataset = await self._dataset(job.dataset)
+        agent_executor = setup_agent_executor(
+            self.settings,
+            self.agent_settings,
+            dataset.df,
+            dataset.sandbox_df,
+            llm=self.llm_factory(job) if self.llm_factory is not None else None,
+            execution_backend=self._execution_backend(job.dataset, dataset).for_request(),
+        )
+        code_validation_tool = agent_executor.tools[0]
+        agent_inputs, _ = build_agent_inputs(
+            job.question,
+            dataset.df,
+            dataset.sandbox_df,
+            self.settings.metadata_token_budget,
+            code_validation_tool.get_tracer(),
+        )
+
+        # the answer the executor gives when it runs out of iterations
+        stopped_response = agent_executor.agent.return_stopped_response(agent_executor.early_stopping_method, [])
+        async for chunk in agent_executor.astream(agent_inputs):
+            for step in chunk.get("steps", []):
+                tool_input = step.action.tool_input
+                if isinstance(tool_input, dict) and tool_input.get("plotting_code", True) and is_accepted(step):
+                    result.code = tool_input["code"]
+                    result.description = tool_input.get("description")
+            if "output" in chunk:
+                result.answer = chunk["output"]
+
+        if result.answer == stopped_response.return_values.get("output"):
+            result.error = f"Stopped after {self.agent_settings.max_iterations} iterations without a final answer"
+        elif result.code is None:
+            result.error = "No plotting code was accepted"
+        if result.code is not None:
+            result.figure_files = await asyncio.to_thread(self._write_figure, job, code_validation_tool, result.code)
+        # failed jobs are run again by --retry-failed
+        result.status = "done" if result.error is None else "failed"
+
+    def _write_figure(self, job: BatchJob, code_validation_tool: CodeValidationTool, code: str) -> List[str]:
+        image_store = code_validation_tool.get_image_store()
+        handle = image_store.latest_handle_for(code)
+        stored_figure = image_store.get(handle) if handle is not None else None
+        if stored_figure is None:
+            return []
+
+        os.makedirs(self.job_dir(job), exist_ok=True)
+        if stored_figure.mime_type != PLOTLY_JSON_MIME_TYPE:
+            _write_atomic(os.path.join(self.job_dir(job), "figure.png"), stored_figure.data)
+            return ["figure.png"]
+
+        figure_renderer = code_validation_tool.get_figure_renderer()
+        image_filename = f"figure.{figure_renderer.image_format}"
+        _write_atomic(os.path.join(self.job_dir(job), "figure.json"), stored_figure.data)
+        with get_tracer().span("batch.render"):
+            _write_atomic(os.path.join(self.job_dir(job), image_filename), figure_renderer.render(stored_figure.data))
+        return ["figure.json", image_filename]
+
+    async def _write_result(self, job: BatchJob, result: JobResult):
+        os.makedirs(self.job_dir(job), exist_ok=True)
+        result_json = result.model_dump_json()
+        _write_atomic(os.path.join(self.job_dir(job), RESULT_FILENAME), result_json.encode("utf-8"))
+        async with self._summary_lock:
+            with open(os.path.join(self.output_dir, SUMMARY_FILENAME), "a") as file:
+                file.write(result_json + "\n")
+
+    def close(self):
+        for backend in self._backends.values():
+            backend.close()
+        self._backends = {}
+
+
+def main(argv: Optional[List[str]] = None) -> List[JobResult]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="JSON lines file of jobs")
+    parser.add_argument("--output-dir", default="batch_output")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs run at once")
+    parser.add_argument("--max-iterations", type=int, default=AgentSettings().max_iterations)
+    parser.add_argument("--retry-failed", action="store_true", help="run failed jobs of an earlier run again")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    runner = BatchRunner(
+        Settings(),
+        AgentSettings(max_iterations=args.max_iterations),
+        args.output_dir,
+        concurrency=args.concurrency,
+        retry_failed=args.retry_failed,
+    )
+    results = asyncio.run(runner.run(read_jobs(args.jobs)))
+
+    done = sum(result is not None and result.status == "done" for result in results)
+    print(f"{done} of {len(results)} jobs done, results written to {args.output_dir}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+import ast
+import base64
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+import streamlit as st
+from PIL import Image
+from pydantic import BaseModel
+
+from llm_plotting.executors import ExecutionResult
+from llm_plotting.settings import Settings
+
+Logger = logging.getLogger(st.__name__)
+
+
+def normalise_code(code: str) -> str:
+    """Formatting and comment independent representation of the code."""
+    try:
+        return ast.dump(ast.parse(code))
+    except SyntaxError:
+        return code.strip()
+
+
+def execution_cache_key(code: str, plotting_code: bool, df_fingerprint: str) -> str:
+    key = json.dumps([normalise_code(code), plotting_code, df_fingerprint])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _result_size(result: ExecutionResult) -> int:
+    return len(result.stdout) + len(result.stderr) + len(result.image or b"") + len(result.figure_json or b"")
+
+
+class ExecutionCache:
+    """LRU cache of successful execution results, bounded by the total size of the cached
+    outputs. With ``disk_dir`` set, results are also written to disk so they survive restarts
+    and are read back into memory on a miss. The files are bounded by ``max_bytes`` as well,
+    the least recently used are deleted first.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[str, ExecutionResult]" = OrderedDict()
+        self._size = 0
+        # sizes of the files in the disk tier, least recently used first
+        self._disk_files: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._size}
+
+    def get(self, key: str) -> Optional[ExecutionResult]:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+
+        if result is None and self.disk_dir is not None:
+            result = self._read_from_disk(key)
+            if result is not None:
+                self._put_in_memory(key, result)
+
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key: str, result: ExecutionResult):
+        if result.exit_code != 0:
+            return
+        self._put_in_memory(key, result)
+        if self.disk_dir is not None:
+            self._write_to_disk(key, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _put_in_memory(self, key: str, result: ExecutionResult):
+        size = _result_size(result)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= _result_size(self._entries.pop(key))
+            self._entries[key] = result
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= _result_size(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _load_disk_index(self):
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json") and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name.removesuffix(".json"), stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk_files[key] = size
+            self._disk_size += size
+        self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        evicted = []
+        with self._lock:
+            while self._disk_size > self.max_bytes and self._disk_files:
+                key, size = self._disk_files.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(key)
+        for key in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(self._disk_path(key))
+
+    def _read_from_disk(self, key: str) -> Optional[ExecutionResult]:
+        try:
+            with open(self._disk_path(key)) as file:
+                data = json.load(file)
+            # the modification time orders the files by use after a restart
+            os.utime(self._disk_path(key))
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._disk_files:
+                self._disk_files.move_to_end(key)
+
+        for name in ("image", "figure_json"):
+            data[name] = base64.b64decode(data[name]) if data.get(name) is not None else None
+        return ExecutionResult(**data)
+
+    def _write_to_disk(self, key: str, result: ExecutionResult):
+        data = result.model_dump()
+        for name in ("image", "figure_json"):
+            value = getattr(result, name)
+            data[name] = base64.b64encode(value).decode("utf-8") if value is not None else None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.disk_dir, delete=False) as file:
+                json.dump(data, file)
+            os.replace(file.name, self._disk_path(key))
+            size = os.path.getsize(self._disk_path(key))
+        except OSError as e:
+            Logger.warning(f"Failed to write execution result to disk cache: {e}")
+            return
+
+        with self._lock:
+            self._disk_size += size - self._disk_files.pop(key, 0)
+            self._disk_files[key] = size
+        self._evict_from_disk()
+
+
+def perceptual_hash(image_in_bytes: bytes, hash_size: int = 16) -> int:
+    """Difference hash of an image, visually similar images differ in only a few bits."""
+    image = Image.open(BytesIO(image_in_bytes)).convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(image.getdata())
+
+    image_hash = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            image_hash = (image_hash << 1) | int(left > right)
+    return image_hash
+
+
+def _normalise_description(description: str) -> str:
+    return " ".join(description.lower().split())
+
+
+class ValidationCache:
+    """Cache of image validation verdicts so that figures which look the same as one already
+    validated for the same description skip the vision model. Only verdicts accepting a figure
+    are put in the cache.
+
+    Images match when the hamming distance between their perceptual hashes is at most
+    ``max_distance``. Entries expire after ``ttl`` seconds and the least recently used
+    entries are evicted beyond ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3600.0, max_distance: int = 4):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired, "entries": len(self._entries)}
+
+    def get(self, image_hash: int, description: str) -> Optional[str]:
+        description = _normalise_description(description)
+        now = time.monotonic()
+
+        with self._lock:
+            match = None
+            for key, (verdict, created_at) in list(self._entries.items()):
+                if now - created_at > self.ttl:
+                    del self._entries[key]
+                    self.expired += 1
+                elif match is None and key[0] == description:
+                    if bin(key[1] ^ image_hash).count("1") <= self.max_distance:
+                        match = key
+
+            if match is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(match)
+            return self._entries[match][0]
+
+    def put(self, image_hash: int, description: str, verdict: str):
+        key = (_normalise_description(description), image_hash)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (verdict, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def normalise_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation independent form of a question. Anything else,
+    like an operator or a single word, may change what is asked for.
+    """
+    return " ".join(question.lower().split()).rstrip(".?! ")
+
+
+class CachedAnswer(BaseModel):
+    """The accepted tool call of a request with its output and figure, and the final answer."""
+
+    code: str
+    description: str
+    plotting_code: bool
+    observation: str
+    answer: str
+    figure: Optional[bytes] = None
+    figure_mime_type: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.code) + len(self.observation) + len(self.answer) + len(self.figure or b"")
+
+
+class AnswerCache:
+    """LRU cache of whole answers keyed on the dataframe fingerprint and the normalised
+    question, bounded by entries and the total size of the answers. All answers about a
+    dataframe can be dropped with ``invalidate``.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 128 * 1024**2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+        self._entries: "OrderedDict[Tuple[str, str], CachedAnswer]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidated": self.invalidated,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    def get(self, df_fingerprint: str, question: str) -> Optional[CachedAnswer]:
+        key = (df_fingerprint, normalise_question(question))
+        with self._lock:
+            answer = self._entries.get(key)
+            if answer is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return answer
+
+    def put(self, df_fingerprint: str, question: str, answer: CachedAnswer):
+        if answer.size > self.max_bytes:
+            return
+        key = (df_fingerprint, normalise_question(question))
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = answer
+            self._size += answer.size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, df_fingerprint: str, question: str):
+        with self._lock:
+            self.invalidated += self._pop((df_fingerprint, normalise_question(question)))
+
+    def invalidate(self, df_fingerprint: str) -> int:
+        """Drop every answer about the dataframe, including answers about it joined with other
+        tables, returns how many were dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if df_fingerprint in key[0].split(",")]
+            for key in keys:
+                self._pop(key)
+            self.invalidated += len(keys)
+        return len(keys)
+
+    def _pop(self, key: Tuple[str, str]) -> bool:
+        answer = self._entries.pop(key, None)
+        if answer is None:
+            return False
+        self._size -= answer.size
+        return True
+
+
+_execution_cache: Optional[ExecutionCache] = None
+_execution_cache_lock = threading.Lock()
+
+
+def get_execution_cache(settings: Settings) -> ExecutionCache:
+    """Process wide cache shared by every session."""
+    global _execution_cache
+    with _execution_cache_lock:
+        if _execution_cache is None:
+            _execution_cache = ExecutionCache(
+                max_bytes=settings.execution_cache_max_mb * 1024**2,
+                disk_dir=settings.execution_cache_dir,
+            )
+    return _execution_cache
+
+
+_validation_cache: Optional[ValidationCache] = None
+_validation_cache_lock = threading.Lock()
+
+
+def get_validation_cache(settings: Settings) -> ValidationCache:
+    """Process wide cache shared by every session."""
+    global _validation_cache
+    with _validation_cache_lock:
+        if _validation_cache is None:
+            _validation_cache = ValidationCache(
+                max_entries=settings.validation_cache_max_entries,
+                ttl=settings.validation_cache_ttl,
+                max_distance=settings.validation_cache_max_distance,
+            )
+    return _validation_cache
+
+
+_answer_cache: Optional[AnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache(settings: Settings) -> AnswerCache:
+    """Process wide cache shared by every session."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(
+                max_entries=settings.answer_cache_max_entries,
+                max_bytes=settings.answer_cache_max_mb * 1024**2,
+            )
+    return _answer_cache
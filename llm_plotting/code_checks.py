@@ -0,0 +1,305 @@
+import ast
+import difflib
+import os
+import sys
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional, Set
+
+from pydantic import BaseModel
+
+# plotly express arguments which name columns of ``data_frame``
+COLUMN_ARGUMENTS = (
+    "x",
+    "y",
+    "z",
+    "color",
+    "size",
+    "symbol",
+    "text",
+    "facet_row",
+    "facet_col",
+    "hover_name",
+    "line_group",
+    "animation_frame",
+    "names",
+    "values",
+    "parents",
+    "ids",
+)
+# keyword arguments whose string values become column names in the result
+NEW_COLUMN_ARGUMENTS = ("name", "names", "columns", "value_name", "var_name", "values")
+DATAFRAME_READERS = ("read_csv", "read_parquet", "read_json", "read_excel", "read_feather", "read_table")
+# keyword names of the path argument of the readers
+PATH_ARGUMENTS = ("filepath_or_buffer", "path", "path_or_buf", "io")
+SANDBOX_HELPER_MODULES = ("plot_prep",)
+STATIC_CHECKS_FAILED_MESSAGE = "The code was not executed, static checks found these problems."
+
+
+class CodeIssue(BaseModel):
+    check: str
+    message: str
+    line: Optional[int] = None
+
+    def __str__(self) -> str:
+        return f"line {self.line}: {self.message}" if self.line is not None else self.message
+
+
+def module_names(libraries: str) -> Set[str]:
+    """Importable module names for a comma separated list of packages, e.g. AVAILABLE_LIBRARIES."""
+    return {library.strip().lower().replace("-", "_") for library in libraries.split(",") if library.strip()}
+
+
+def _string_value(node: ast.AST) -> Optional[str]:
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+
+def _strings_in(node: ast.AST) -> Iterable[str]:
+    for child in ast.walk(node):
+        value = _string_value(child)
+        if value is not None:
+            yield value
+
+
+def _call_name(node: ast.Call) -> Optional[str]:
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def _root_name(node: ast.expr) -> Optional[str]:
+    """The variable an attribute or subscript chain like ``df.columns.values[0]`` starts from."""
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def is_dataframe_read(node: ast.AST) -> bool:
+    return isinstance(node, ast.Call) and _call_name(node) in DATAFRAME_READERS
+
+
+def read_path(node: ast.Call) -> Optional[str]:
+    """File name a reader call reads, None when it is not a string literal."""
+    path = node.args[0] if node.args else next((k.value for k in node.keywords if k.arg in PATH_ARGUMENTS), None)
+    path = _string_value(path) if path is not None else None
+    return os.path.basename(path) if path is not None else None
+
+
+def referenced_files(code: str) -> Optional[Set[str]]:
+    """Names of the files the code reads dataframes from. None when that cannot be told from
+    the code, because it does not parse or reads a path which is not a string literal.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    paths = {node: read_path(node) for node in ast.walk(tree) if is_dataframe_read(node)}
+    if any(path is None for path in paths.values()):
+        return None
+    return set(paths.values())
+
+
+class _CodeVisitor(ast.NodeVisitor):
+    """Collects everything the checks need in a single pass over the tree."""
+
+    def __init__(self):
+        self.imports: List[ast.AST] = []
+        self.reads: List[ast.Call] = []
+        self.plotly_calls: List[ast.Call] = []
+        self.column_loads: List[ast.Subscript] = []
+        self.binds_fig = False
+        self.created_columns: Set[str] = set()
+        # variables assigned straight from a reader call, with the file they read
+        self.dataframe_files: Dict[str, Optional[str]] = {}
+        # variables assigned anything else or changed in place, their columns are not known
+        self.other_assignments: Set[str] = set()
+
+    def visit_Import(self, node: ast.Import):
+        self.imports.append(node)
+        self.binds_fig |= any((alias.asname or alias.name) == "fig" for alias in node.names)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        self.imports.append(node)
+        self.binds_fig |= any((alias.asname or alias.name) == "fig" for alias in node.names)
+
+    def visit_Name(self, node: ast.Name):
+        if node.id == "fig" and isinstance(node.ctx, ast.Store):
+            self.binds_fig = True
+
+    def visit_Assign(self, node: ast.Assign):
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                if is_dataframe_read(node.value):
+                    self.dataframe_files[target.id] = read_path(node.value)
+                else:
+                    self.other_assignments.add(target.id)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node: ast.Attribute):
+        # like df.columns = ..., which may rename the columns
+        if isinstance(node.ctx, ast.Store):
+            self.other_assignments.add(_root_name(node))
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript):
+        if isinstance(node.ctx, ast.Store):
+            self.created_columns.update(_strings_in(node.slice))
+            self.other_assignments.add(_root_name(node))
+        elif isinstance(node.value, ast.Name) and _string_value(node.slice) is not None:
+            self.column_loads.append(node)
+        self.generic_visit(node)
+
+    def visit_Dict(self, node: ast.Dict):
+        self.created_columns.update(value for value in map(_string_value, node.values) if value is not None)
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        if is_dataframe_read(node):
+            self.reads.append(node)
+        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+            if node.func.value.id in ("px", "plotly_express"):
+                self.plotly_calls.append(node)
+        for keyword in node.keywords:
+            if keyword.arg == "inplace" and isinstance(node.func, ast.Attribute):
+                self.other_assignments.add(_root_name(node.func.value))
+            if keyword.arg is not None:
+                self.created_columns.add(keyword.arg)
+            if keyword.arg in NEW_COLUMN_ARGUMENTS:
+                self.created_columns.update(_strings_in(keyword.value))
+        self.generic_visit(node)
+
+
+class CodeChecker:
+    """Static checks of generated code which catch mistakes locally, before any sandbox round
+    trip: syntax errors, imports of unavailable libraries, reads of a file other than the
+    session dataframes, unknown column names and plotting code which never binds ``fig``.
+    ``tables`` holds the columns of the session's other dataframes by file name.
+
+    Column checks are deliberately conservative. Only string subscripts and plotly express
+    arguments on variables loaded straight from the dataframe file, and never assigned to
+    or changed in place, are checked, and any name the code itself creates is accepted.
+    """
+
+    def __init__(
+        self,
+        columns: Iterable[str],
+        dataframe_filename: str,
+        available_modules: Iterable[str],
+        tables: Optional[Mapping[str, Iterable[str]]] = None,
+    ):
+        self.columns = [str(column) for column in columns]
+        self.dataframe_filename = dataframe_filename
+        self.table_columns = {dataframe_filename: self.columns}
+        self.table_columns.update({name: [str(column) for column in cols] for name, cols in (tables or {}).items()})
+        self.available_modules = set(available_modules) | set(sys.stdlib_module_names) | set(SANDBOX_HELPER_MODULES)
+        self.checks_run = 0
+        self.sandbox_calls_saved = 0
+
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        return {"checks_run": self.checks_run, "sandbox_calls_saved": self.sandbox_calls_saved}
+
+    def check(self, code: str, plotting_code: bool) -> List[CodeIssue]:
+        issues = self._check(code, plotting_code)
+        with self._lock:
+            self.checks_run += 1
+            self.sandbox_calls_saved += bool(issues)
+        return issues
+
+    def _check(self, code: str, plotting_code: bool) -> List[CodeIssue]:
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return [CodeIssue(check="syntax", message=f"syntax error: {e.msg}", line=e.lineno)]
+
+        visitor = _CodeVisitor()
+        visitor.visit(tree)
+
+        issues = self._check_imports(visitor) + self._check_reads(visitor) + self._check_columns(visitor)
+        if plotting_code and not visitor.binds_fig:
+            issues.append(
+                CodeIssue(
+                    check="figure",
+                    message="plotting code never assigns the figure to a variable named `fig`, it is saved from `fig`",
+                )
+            )
+        return issues
+
+    def _check_imports(self, visitor: _CodeVisitor) -> List[CodeIssue]:
+        issues = []
+        for node in visitor.imports:
+            if isinstance(node, ast.ImportFrom):
+                modules = [node.module] if node.level == 0 and node.module else []
+            else:
+                modules = [alias.name for alias in node.names]
+            for module in modules:
+                if module.split(".")[0] not in self.available_modules:
+                    issues.append(
+                        CodeIssue(
+                            check="import",
+                            message=(
+                                f"`{module}` is not installed in the sandbox, only these libraries are available: "
+                                f"{', '.join(sorted(self.available_modules - set(sys.stdlib_module_names)))}"
+                            ),
+                            line=node.lineno,
+                        )
+                    )
+        return issues
+
+    def _check_reads(self, visitor: _CodeVisitor) -> List[CodeIssue]:
+        issues = []
+        for node in visitor.reads:
+            path = _string_value(node.args[0]) if node.args else None
+            if path is not None and os.path.basename(path) not in self.table_columns:
+                if len(self.table_columns) == 1:
+                    message = f"reads `{path}` but the dataframe is stored as `{self.dataframe_filename}`"
+                else:
+                    message = (
+                        f"reads `{path}` but the dataframes are stored as {', '.join(map(repr, self.table_columns))}"
+                    )
+                issues.append(CodeIssue(check="data_file", message=message, line=node.lineno))
+        return issues
+
+    def _check_columns(self, visitor: _CodeVisitor) -> List[CodeIssue]:
+        # columns of the table each dataframe variable was read from, any table's when unknown
+        all_columns = [column for columns in self.table_columns.values() for column in columns]
+        dataframe_columns = {
+            name: self.table_columns.get(path, all_columns)
+            for name, path in visitor.dataframe_files.items()
+            if name not in visitor.other_assignments
+        }
+
+        references = [
+            (node.slice.value, node.lineno, node.value.id)
+            for node in visitor.column_loads
+            if node.value.id in dataframe_columns
+        ]
+        for node in visitor.plotly_calls:
+            data_frame = node.args[0] if node.args else None
+            data_frame = next((k.value for k in node.keywords if k.arg == "data_frame"), data_frame)
+            if not (isinstance(data_frame, ast.Name) and data_frame.id in dataframe_columns):
+                continue
+            for keyword in node.keywords:
+                if keyword.arg in COLUMN_ARGUMENTS:
+                    values = keyword.value.elts if isinstance(keyword.value, (ast.List, ast.Tuple)) else [keyword.value]
+                    references.extend(
+                        (value.value, node.lineno, data_frame.id) for value in values if _string_value(value)
+                    )
+
+        issues = []
+        for column, line, name in references:
+            columns = dataframe_columns[name]
+            if column in columns or column in visitor.created_columns:
+                continue
+            suggestions = difflib.get_close_matches(column, columns, n=3)
+            hint = f", did you mean {' or '.join(f'`{s}`' for s in suggestions)}?" if suggestions else ""
+            issues.append(CodeIssue(check="column", message=f"column `{column}` does not exist{hint}", line=line))
+        return issues
+
+
+def format_issues(issues: List[CodeIssue]) -> str:
+    return "\n".join(
+        [f"{STATIC_CHECKS_FAILED_MESSAGE} Fix them and validate again:"] + [f"- {issue}" for issue in issues]
+    )
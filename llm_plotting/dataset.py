@@ -0,0 +1,254 @@
+import hashlib
+import keyword
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import cached_property
+from io import BytesIO
+from typing import IO, Dict, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+Logger = logging.getLogger(st.__name__)
+
+DATAFRAME_FILE_STEM = "df"
+# names generated code already uses for other things
+RESERVED_TABLE_NAMES = (DATAFRAME_FILE_STEM, "pd", "px", "go", "np", "fig", "plot_prep")
+
+
+def fingerprint_dataframe(df: pd.DataFrame, chunk_size: int = 1_000_000) -> str:
+    """Content hash of a dataframe, independent of its memory layout. Rows are hashed in
+    chunks so the temporary hash arrays stay small for large frames.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr(df.columns.tolist()).encode("utf-8"))
+    hasher.update(repr(df.dtypes.astype(str).tolist()).encode("utf-8"))
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:][:chunk_size]
+        try:
+            hasher.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+        except TypeError:
+            # unhashable cells such as lists, fall back to hashing the text representation
+            hasher.update(chunk.to_csv(index=False).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class SandboxDataFrame:
+    """A dataframe prepared for upload into a code execution sandbox.
+
+    The fingerprint and serialised payload are computed once and reused for every upload.
+    Parquet is used when pyarrow can serialise the frame, otherwise it falls back to CSV.
+    """
+
+    def __init__(self, df: pd.DataFrame, file_stem: str = DATAFRAME_FILE_STEM):
+        self.df = df
+        self.file_stem = file_stem
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return fingerprint_dataframe(self.df)
+
+    @property
+    def file_format(self) -> str:
+        return self._serialised[0]
+
+    @property
+    def payload(self) -> bytes:
+        return self._serialised[1]
+
+    @property
+    def filename(self) -> str:
+        return f"{self.file_stem}.{self.file_format}"
+
+    @property
+    def load_code(self) -> str:
+        return f"{self.file_stem} = pd.read_{self.file_format}('{self.filename}')"
+
+    @cached_property
+    def _serialised(self):
+        df = restore_standard_dtypes(self.df)
+        buffer = BytesIO()
+        try:
+            df.to_parquet(buffer, index=False)
+            return "parquet", buffer.getvalue()
+        except Exception as e:
+            Logger.warning(f"Falling back to CSV upload, could not serialise dataframe to parquet: {e}")
+
+        buffer = BytesIO()
+        df.to_csv(buffer, index=False)
+        return "csv", buffer.getvalue()
+
+
+def downcast_dataframe(df: pd.DataFrame, category_ratio: float = 0.5) -> pd.DataFrame:
+    """Shrink column dtypes without losing information: integers to the smallest integer type
+    that holds them, floats to float32 when every value round trips exactly and low
+    cardinality string columns to categoricals.
+    """
+    columns = {}
+    for column, series in df.items():
+        if pd.api.types.is_bool_dtype(series):
+            columns[column] = series
+        elif pd.api.types.is_integer_dtype(series):
+            columns[column] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series):
+            downcast = series.astype("float32")
+            lossless = (downcast.astype(series.dtype) == series) | series.isna()
+            columns[column] = downcast if lossless.all() else series
+        elif pd.api.types.is_object_dtype(series) and len(series) > 0:
+            is_low_cardinality = series.nunique(dropna=True) <= category_ratio * len(series)
+            columns[column] = series.astype("category") if is_low_cardinality else series
+        else:
+            columns[column] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+def standard_dtype(dtype):
+    """The dtype a plain ``read_csv`` gives a column which ``downcast_dataframe`` stored as ``dtype``."""
+    if isinstance(dtype, pd.CategoricalDtype):
+        return dtype.categories.dtype
+    if pd.api.types.is_extension_array_dtype(dtype):
+        return dtype
+    if pd.api.types.is_integer_dtype(dtype):
+        return np.dtype("int64")
+    if pd.api.types.is_float_dtype(dtype):
+        return np.dtype("float64")
+    return dtype
+
+
+def restore_standard_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Undo ``downcast_dataframe`` so generated code sees the dtypes a plain ``read_csv`` gives,
+    e.g. arithmetic on a downcast int16 column would silently overflow.
+    """
+    dtypes = {}
+    for column, series in df.items():
+        dtype = standard_dtype(series.dtype)
+        if dtype != series.dtype:
+            dtypes[column] = dtype
+    return df.astype(dtypes) if dtypes else df
+
+
+def _read_only(values: np.ndarray) -> np.ndarray:
+    view = values.view()
+    view.flags.writeable = False
+    return view
+
+
+def read_only_view(df: pd.DataFrame) -> pd.DataFrame:
+    """A frame sharing the memory of ``df`` whose numpy backed and categorical columns cannot be
+    written in place, such writes raise a ``ValueError``. Columns added to or dropped from the
+    view do not change ``df``.
+    """
+    columns = {}
+    for column, series in df.items():
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            columns[column] = pd.Categorical.from_codes(_read_only(series.cat.codes.to_numpy()), dtype=series.dtype)
+        elif isinstance(series.dtype, np.dtype):
+            columns[column] = _read_only(series.to_numpy())
+        else:
+            columns[column] = series
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def _memory_usage(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+class IngestedDataset:
+    """An uploaded CSV parsed once and shared, read only, by everything that needs the frame:
+    the agent, the dataset explorer and the sandbox uploader.
+    """
+
+    def __init__(self, content_hash: str, df: pd.DataFrame, memory_report: Dict):
+        self.content_hash = content_hash
+        self.df = read_only_view(df)
+        self.memory_report = memory_report
+        self.sandbox_df = SandboxDataFrame(df)
+        self._tables: Dict[str, SandboxDataFrame] = {}
+        self._lock = threading.Lock()
+
+    def as_table(self, name: str) -> SandboxDataFrame:
+        """The frame stored under another name in the sandbox, as one of several tables of a
+        session. Shared like the dataset, so the fingerprint and payload are computed once.
+        """
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = SandboxDataFrame(self.df, file_stem=name)
+            return self._tables[name]
+
+
+def table_name(filename: str, taken: Tuple[str, ...] = ()) -> str:
+    """Python identifier for an uploaded file, used as its variable and file stem in the
+    sandbox, e.g. "Company Info.csv" becomes "company_info".
+    """
+    name = re.sub(r"\W+", "_", os.path.splitext(os.path.basename(filename))[0].lower()).strip("_") or "table"
+    if name[0].isdigit() or keyword.iskeyword(name):
+        name = f"t_{name}"
+    candidate, suffix = name, 2
+    while candidate in RESERVED_TABLE_NAMES or candidate in taken:
+        candidate, suffix = f"{name}_{suffix}", suffix + 1
+    return candidate
+
+
+def _parse_csv(data: bytes, chunk_size: int) -> Tuple[pd.DataFrame, int]:
+    """Parse with the multithreaded pyarrow engine, falling back to chunked reads with the C
+    engine. Returns the downcast frame along with the memory the frame used before downcasting.
+    """
+    try:
+        df = pd.read_csv(BytesIO(data), engine="pyarrow")
+        return downcast_dataframe(df), _memory_usage(df)
+    except (ImportError, ValueError) as e:
+        Logger.warning(f"Falling back to chunked CSV parsing: {e}")
+
+    memory_before, chunks = 0, []
+    for chunk in pd.read_csv(BytesIO(data), chunksize=chunk_size):
+        memory_before += _memory_usage(chunk)
+        chunks.append(downcast_dataframe(chunk, category_ratio=0.0))
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.read_csv(BytesIO(data))
+    return downcast_dataframe(df), memory_before
+
+
+_datasets: "OrderedDict[str, IngestedDataset]" = OrderedDict()
+_datasets_lock = threading.Lock()
+DATASET_CACHE_SIZE = 8
+
+
+def get_ingested(content_hash: str) -> Optional[IngestedDataset]:
+    """The dataset parsed from a CSV with this content hash, if it is still cached."""
+    with _datasets_lock:
+        return _datasets.get(content_hash)
+
+
+def ingest_csv(data: Union[bytes, IO], chunk_size: int = 1_000_000) -> IngestedDataset:
+    """Parse an uploaded CSV once per distinct content, later calls with the same bytes return
+    the already parsed dataset.
+    """
+    if not isinstance(data, bytes):
+        data = data.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    with _datasets_lock:
+        if content_hash in _datasets:
+            _datasets.move_to_end(content_hash)
+            return _datasets[content_hash]
+
+    df, memory_before = _parse_csv(data, chunk_size)
+    memory_after = _memory_usage(df)
+    memory_report = {
+        "file_mb": round(len(data) / 1024**2, 2),
+        "parsed_mb": round(memory_before / 1024**2, 2),
+        "downcast_mb": round(memory_after / 1024**2, 2),
+        "saved_mb": round((memory_before - memory_after) / 1024**2, 2),
+        "dtypes": df.dtypes.astype(str).to_dict(),
+    }
+    Logger.info(f"Ingested dataset {content_hash[:12]}: {memory_report}")
+
+    dataset = IngestedDataset(content_hash, df, memory_report)
+    with _datasets_lock:
+        _datasets[content_hash] = dataset
+        while len(_datasets) > DATASET_CACHE_SIZE:
+            _datasets.popitem(last=False)
+    return dataset
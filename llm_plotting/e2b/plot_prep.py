@@ -0,0 +1,274 @@
+"""Shrinks oversized Plotly traces before a figure is serialised.
+
+This module is copied into the sandbox image and must only depend on the libraries listed in
+requirments.txt. Generated plotting code calls ``fig = prepare_figure(fig)`` as its last step:
+
+- line traces are downsampled with largest triangle three buckets (LTTB)
+- marker traces are aggregated into 2D bins, a density heatmap for a single trace or
+  one marker per occupied bin, sized by count, when several traces share the plot
+- bar traces keep the top categories and sum the rest into "Other"
+
+Each reduction is printed on its own line starting with ``PLOT_PREP_MARKER`` so the caller
+can report it back to the agent.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+PLOT_PREP_MARKER = "[plot-prep]"
+OTHER_CATEGORY = "Other"
+POINT_ATTRIBUTES = ("customdata", "text", "hovertext", "ids")
+MARKER_ATTRIBUTES = ("color", "size", "symbol", "opacity")
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the ``n_out`` points chosen by largest triangle three buckets, the first
+    and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    bucket_edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = bucket_edges[i], bucket_edges[i + 1]
+        next_start, next_end = end, bucket_edges[i + 2] if i + 2 < len(bucket_edges) else n
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+
+        areas = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        indices[i + 1] = previous
+    return indices
+
+
+def _as_numeric(values) -> Optional[Tuple[np.ndarray, str]]:
+    """Numeric view of trace coordinates along with their kind, None for categorical data."""
+    series = pd.Series(np.asarray(values))
+    if pd.api.types.is_bool_dtype(series):
+        return None
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=np.float64), "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(np.float64), "datetime"
+    try:
+        parsed = pd.to_datetime(series, errors="raise")
+        return parsed.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(np.float64), "datetime"
+    except (ValueError, TypeError):
+        return None
+
+
+def _from_numeric(values: np.ndarray, kind: str):
+    if kind == "datetime":
+        return pd.to_datetime(values.astype(np.int64)).to_numpy()
+    return values
+
+
+def _trace_label(index: int, trace) -> str:
+    return f"trace {index} ({trace.type}{', ' + repr(trace.name) if trace.name else ''})"
+
+
+def _n_points(trace) -> int:
+    for attribute in ("x", "y"):
+        values = getattr(trace, attribute, None)
+        if values is not None:
+            return len(values)
+    return 0
+
+
+def _is_line_trace(trace) -> bool:
+    return trace.type in ("scatter", "scattergl") and "lines" in (trace.mode or "")
+
+
+def _is_marker_trace(trace) -> bool:
+    # plotly draws scatter traces without a mode as markers once they have more than 20 points
+    return trace.type in ("scatter", "scattergl") and (trace.mode is None or trace.mode == "markers")
+
+
+def _select_points(trace, indices: np.ndarray, n: int):
+    trace.x = np.asarray(trace.x)[indices]
+    trace.y = np.asarray(trace.y)[indices]
+    for attribute in POINT_ATTRIBUTES:
+        values = getattr(trace, attribute, None)
+        if values is not None and not isinstance(values, str) and len(values) == n:
+            setattr(trace, attribute, np.asarray(values)[indices])
+    for attribute in MARKER_ATTRIBUTES:
+        values = getattr(trace.marker, attribute, None)
+        if values is not None and not isinstance(values, str) and np.ndim(values) == 1 and len(values) == n:
+            setattr(trace.marker, attribute, np.asarray(values)[indices])
+
+
+def _downsample_line(index: int, trace, max_points: int) -> Optional[str]:
+    if trace.x is None or trace.y is None:
+        return None
+    x, y = _as_numeric(trace.x), _as_numeric(trace.y)
+    if y is None:
+        return None
+
+    n = len(trace.y)
+    y_values = y[0]
+    x_values = x[0] if x is not None and np.all(np.diff(x[0]) >= 0) else np.arange(n, dtype=np.float64)
+    if np.isnan(x_values).any() or np.isnan(y_values).any():
+        return None
+
+    _select_points(trace, lttb_indices(x_values, y_values, max_points), n)
+    return f"{_trace_label(index, trace)}: downsampled from {n:,} to {max_points:,} points with LTTB"
+
+
+def _bin_edges(values: List[np.ndarray], bins: int) -> np.ndarray:
+    stacked = np.concatenate(values)
+    low, high = np.nanmin(stacked), np.nanmax(stacked)
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1)
+
+
+def _bin_markers(figure, trace_indices: List[int], bins: int) -> Tuple[object, List[str]]:
+    numeric = {}
+    for index in trace_indices:
+        trace = figure.data[index]
+        if trace.x is None or trace.y is None:
+            continue
+        x, y = _as_numeric(trace.x), _as_numeric(trace.y)
+        if x is not None and y is not None:
+            numeric[index] = (x, y)
+    if not numeric:
+        return figure, []
+
+    x_edges = _bin_edges([x[0] for x, _ in numeric.values()], bins)
+    y_edges = _bin_edges([y[0] for _, y in numeric.values()], bins)
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+    x_kind, y_kind = next((x[1], y[1]) for x, y in numeric.values())
+
+    reductions = []
+    traces = list(figure.data)
+    for index, ((x, _), (y, _)) in numeric.items():
+        trace = traces[index]
+        keep = ~(np.isnan(x) | np.isnan(y))
+        counts, _, _ = np.histogram2d(x[keep], y[keep], bins=[x_edges, y_edges])
+        label = _trace_label(index, trace)
+
+        if len(numeric) == 1:
+            z = np.where(counts.T > 0, counts.T, np.nan)
+            traces[index] = dict(
+                type="heatmap",
+                x=_from_numeric(x_centres, x_kind),
+                y=_from_numeric(y_centres, y_kind),
+                z=z,
+                name=trace.name or "count",
+                colorscale="Viridis",
+                colorbar={"title": "count"},
+                hovertemplate="x: %{x}<br>y: %{y}<br>count: %{z}<extra></extra>",
+            )
+            reductions.append(f"{label}: {len(x):,} points binned into a {bins}x{bins} density heatmap")
+        else:
+            x_bins, y_bins = np.nonzero(counts)
+            occupied = counts[x_bins, y_bins]
+            trace.x = _from_numeric(x_centres[x_bins], x_kind)
+            trace.y = _from_numeric(y_centres[y_bins], y_kind)
+            for attribute in POINT_ATTRIBUTES:
+                setattr(trace, attribute, None)
+            trace.marker.size = 4 + 12 * np.log1p(occupied) / np.log1p(occupied.max())
+            trace.customdata = occupied
+            trace.hovertemplate = "x: %{x}<br>y: %{y}<br>count: %{customdata}<extra></extra>"
+            reductions.append(f"{label}: {len(x):,} points binned into {len(occupied):,} markers sized by count")
+
+    data = [trace if isinstance(trace, dict) else trace.to_plotly_json() for trace in traces]
+    return go.Figure(data=data, layout=figure.layout), reductions
+
+
+def _bar_axes(trace) -> Tuple[str, str]:
+    return ("y", "x") if trace.orientation == "h" else ("x", "y")
+
+
+def _top_bar_categories(figure, max_categories: int) -> Optional[set]:
+    totals: Dict = {}
+    for trace in figure.data:
+        if trace.type != "bar":
+            continue
+        category_axis, value_axis = _bar_axes(trace)
+        categories, values = getattr(trace, category_axis), getattr(trace, value_axis)
+        if categories is None or values is None or _as_numeric(values) is None:
+            return None
+        frame = pd.DataFrame({"category": np.asarray(categories), "value": np.asarray(values, dtype=np.float64)})
+        for category, value in frame.groupby("category", sort=False)["value"].sum().items():
+            totals[category] = totals.get(category, 0.0) + abs(value)
+
+    if len(totals) <= max_categories:
+        return None
+    ranked = sorted(totals, key=totals.get, reverse=True)
+    return set(ranked[: max_categories - 1])
+
+
+def _group_bars(index: int, trace, top_categories: set) -> str:
+    category_axis, value_axis = _bar_axes(trace)
+    frame = pd.DataFrame(
+        {
+            "category": np.asarray(getattr(trace, category_axis)),
+            "value": np.asarray(getattr(trace, value_axis), dtype=np.float64),
+        }
+    )
+    n_categories = frame["category"].nunique()
+    frame["category"] = frame["category"].where(frame["category"].isin(top_categories), OTHER_CATEGORY)
+    grouped = frame.groupby("category", sort=False)["value"].sum()
+    order = sorted(grouped.index, key=lambda category: (category == OTHER_CATEGORY, -grouped[category]))
+    grouped = grouped.reindex(order)
+
+    setattr(trace, category_axis, grouped.index.to_numpy())
+    setattr(trace, value_axis, grouped.to_numpy())
+    for attribute in POINT_ATTRIBUTES:
+        setattr(trace, attribute, None)
+    for attribute in MARKER_ATTRIBUTES:
+        if np.ndim(getattr(trace.marker, attribute, None)) == 1:
+            setattr(trace.marker, attribute, None)
+    return (
+        f"{_trace_label(index, trace)}: {n_categories:,} categories reduced to the top "
+        f"{len(top_categories)} by total with the rest summed into '{OTHER_CATEGORY}'"
+    )
+
+
+def prepare_figure(
+    figure,
+    max_line_points: int = 5000,
+    max_scatter_points: int = 20000,
+    max_categories: int = 30,
+    bins: int = 100,
+    report: bool = True,
+):
+    """Return ``figure`` with its oversized traces reduced. Traces are changed in place, binned
+    scatters replace the figure with a new one so always use the returned figure.
+    """
+    reductions = []
+
+    for index, trace in enumerate(figure.data):
+        if _is_line_trace(trace) and _n_points(trace) > max_line_points:
+            reduction = _downsample_line(index, trace, max_line_points)
+            if reduction is not None:
+                reductions.append(reduction)
+
+    marker_traces = [i for i, trace in enumerate(figure.data) if _is_marker_trace(trace)]
+    if sum(_n_points(figure.data[i]) for i in marker_traces) > max_scatter_points:
+        figure, binned = _bin_markers(figure, marker_traces, bins)
+        reductions.extend(binned)
+
+    top_categories = _top_bar_categories(figure, max_categories)
+    if top_categories is not None:
+        for index, trace in enumerate(figure.data):
+            if trace.type == "bar":
+                reductions.append(_group_bars(index, trace, top_categories))
+
+    if report:
+        for reduction in reductions:
+            print(f"{PLOT_PREP_MARKER} {reduction}")
+    return figure
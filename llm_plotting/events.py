@@ -0,0 +1,58 @@
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel
+
+from llm_plotting.image_store import ImageStore
+
+
+class AgentEvent(BaseModel):
+    """A step of the agent in a form any interface can display: a tool call, the tool's
+    observation with a handle to the figure it stored, or the final answer.
+    """
+
+    event: Literal["action", "observation", "answer"]
+    tool: Optional[str] = None
+    code: Optional[str] = None
+    description: Optional[str] = None
+    plotting_code: Optional[bool] = None
+    text: Optional[str] = None
+    figure_handle: Optional[str] = None
+
+
+def chunk_to_events(chunk: Dict, image_store: ImageStore) -> List[AgentEvent]:
+    """Events of a chunk streamed by the agent executor."""
+    if "actions" in chunk:
+        events = []
+        for action in chunk["actions"]:
+            if action.tool != "CodeValidationTool":
+                raise ValueError("Tool not recognized")
+            events.append(
+                AgentEvent(
+                    event="action",
+                    tool=action.tool,
+                    code=action.tool_input["code"],
+                    description=action.tool_input["description"],
+                    plotting_code=action.tool_input.get("plotting_code", True),
+                )
+            )
+        return events
+
+    if "steps" in chunk:
+        events = []
+        for step in chunk["steps"]:
+            tool_input = step.action.tool_input
+            plotting_code = isinstance(tool_input, dict) and tool_input.get("plotting_code", True)
+            events.append(
+                AgentEvent(
+                    event="observation",
+                    tool=step.action.tool,
+                    plotting_code=plotting_code,
+                    text=str(step.observation),
+                    figure_handle=image_store.latest_handle_for(tool_input["code"]) if plotting_code else None,
+                )
+            )
+        return events
+
+    if "output" in chunk:
+        return [AgentEvent(event="answer", text=str(chunk["output"]))]
+    return []
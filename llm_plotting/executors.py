@@ -0,0 +1,400 @@
+import contextlib
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import traceback
+import weakref
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Sequence
+
+import streamlit as st
+from e2b import Sandbox
+from pydantic import BaseModel
+
+from llm_plotting.dataset import SandboxDataFrame
+from llm_plotting.prompts import FIGURE_SAVE_PATH
+from llm_plotting.sandbox import (
+    SANDBOX_CODE_PATH,
+    SANDBOX_HELPERS_DIR,
+    SANDBOX_HOME,
+    SandboxPool,
+    get_sandbox_pool,
+    local_code_environment,
+)
+from llm_plotting.settings import Settings
+from llm_plotting.tracing import get_tracer
+
+try:
+    import resource
+except ImportError:  # not available on windows, limits are skipped
+    resource = None
+
+Logger = logging.getLogger(st.__name__)
+
+
+class NamedBytesIO(io.BytesIO):
+    """Custom BytesIO class with name attribute to circumvent e2b .upload_file()
+    method needing file to be saved locally.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.name = kwargs.pop("name", "untitled")
+        super().__init__(*args, **kwargs)
+
+
+class ExecutionResult(BaseModel):
+    stdout: str = ""
+    stderr: str = ""
+    exit_code: int = 0
+    image: Optional[bytes] = None
+    figure_json: Optional[bytes] = None
+
+
+class ExecutionBackend(ABC):
+    """Runs generated code against the session dataframes in ``sandbox_dfs``, which are the
+    ones the code reads. When ``plotting_code`` is True the code is expected to save the figure
+    JSON to ``FIGURE_SAVE_PATH`` and its bytes are returned.
+    """
+
+    @abstractmethod
+    def execute(self, code: str, sandbox_dfs: Sequence[SandboxDataFrame], plotting_code: bool) -> ExecutionResult:
+        pass
+
+    def prewarm(self, sandbox_dfs: Sequence[SandboxDataFrame]):
+        """Get ready to execute code reading ``sandbox_dfs`` while the code is still being written."""
+
+    def release_prewarmed(self):
+        """Give up what ``prewarm`` holds when the next execution does not need it after all."""
+
+    def for_request(self) -> "ExecutionBackend":
+        """The backend to use for one request when the backend is shared between requests.
+        Backends with per request state, like a prewarmed sandbox, return a copy of themselves
+        sharing everything else.
+        """
+        return self
+
+    def close(self):
+        pass
+
+
+class E2BExecutionBackend(ExecutionBackend):
+    def __init__(self, sandbox_pool: SandboxPool, binary: str = "python3"):
+        self.sandbox_pool = sandbox_pool
+        self.binary = binary
+        self._prewarm_lock = threading.Lock()
+        self._prewarmed: Optional[Sandbox] = None
+
+    def prewarm(self, sandbox_dfs: Sequence[SandboxDataFrame]):
+        """Lease a sandbox, booting one when none is idle, upload the dataframes to it and keep
+        it for the next execution of this backend.
+        """
+        with self._prewarm_lock:
+            with get_tracer().span("sandbox.prewarm", reused=self._prewarmed is not None):
+                if self._prewarmed is None:
+                    self._prewarmed = self.sandbox_pool.acquire(_pool_files(sandbox_dfs))
+                try:
+                    for sandbox_df in sandbox_dfs:
+                        self._upload_df_to_sandbox(self._prewarmed, sandbox_df)
+                except Exception:
+                    self.sandbox_pool.release(self._prewarmed, discard=True)
+                    self._prewarmed = None
+                    raise
+
+    def release_prewarmed(self):
+        with self._prewarm_lock:
+            sandbox, self._prewarmed = self._prewarmed, None
+        if sandbox is not None:
+            self.sandbox_pool.release(sandbox)
+
+    def for_request(self) -> "E2BExecutionBackend":
+        # the pool is shared, the prewarmed sandbox is the request's own
+        return E2BExecutionBackend(self.sandbox_pool, self.binary)
+
+    def close(self):
+        self.release_prewarmed()
+
+    def execute(self, code: str, sandbox_dfs: Sequence[SandboxDataFrame], plotting_code: bool) -> ExecutionResult:
+        tracer = get_tracer()
+        # waits for a prewarm still under way
+        with self._prewarm_lock:
+            sandbox, self._prewarmed = self._prewarmed, None
+        with tracer.span("sandbox.acquire", idle=self.sandbox_pool.idle_count, prewarmed=sandbox is not None):
+            if sandbox is None:
+                sandbox = self.sandbox_pool.acquire(_pool_files(sandbox_dfs))
+        try:
+            for sandbox_df in sandbox_dfs:
+                self._upload_df_to_sandbox(sandbox, sandbox_df)
+            sandbox.filesystem.write(SANDBOX_CODE_PATH, code)
+
+            with tracer.span("sandbox.run") as span:
+                output = sandbox.process.start_and_wait(cmd=f"{self.binary} {SANDBOX_CODE_PATH}")
+                span.set(exit_code=output.exit_code or 0)
+            result = ExecutionResult(stdout=output.stdout, stderr=output.stderr, exit_code=output.exit_code or 0)
+
+            if plotting_code and result.exit_code == 0:
+                with tracer.span("sandbox.download") as span:
+                    result.figure_json = sandbox.download_file(f"{SANDBOX_HOME}/{FIGURE_SAVE_PATH}")
+                    span.set(payload_bytes=len(result.figure_json))
+            return result
+        finally:
+            with tracer.span("sandbox.release"):
+                self.sandbox_pool.release(sandbox)
+
+    def _upload_df_to_sandbox(self, sandbox, sandbox_df: SandboxDataFrame):
+        if self.sandbox_pool.uploaded_fingerprint(sandbox, sandbox_df.filename) == sandbox_df.fingerprint:
+            return
+
+        with get_tracer().span(
+            "sandbox.upload", payload_bytes=len(sandbox_df.payload), file_format=sandbox_df.file_format
+        ):
+            sandbox.upload_file(NamedBytesIO(sandbox_df.payload, name=sandbox_df.filename))
+        self.sandbox_pool.mark_uploaded(
+            sandbox, sandbox_df.filename, sandbox_df.fingerprint, hashlib.sha256(sandbox_df.payload).hexdigest()
+        )
+
+
+def _pool_files(sandbox_dfs: Sequence[SandboxDataFrame]) -> Dict[str, str]:
+    return {sandbox_df.filename: sandbox_df.fingerprint for sandbox_df in sandbox_dfs}
+
+
+class CPUTimeLimitExceeded(Exception):
+    pass
+
+
+_worker_state = {}
+_environ_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _local_code_environ():
+    """Swap the environment of the app process for the one of generated code while worker
+    processes are spawned, they start with a copy of it.
+    """
+    with _environ_lock:
+        environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(local_code_environment())
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+def _init_worker(data_dir: str, dataframe_filename: str, memory_limit_mb: Optional[int]):
+    """Import the heavy libraries and load the main session dataframe up front so that none of
+    it is paid for by the first execution. Other tables are loaded on their first read.
+    """
+    import pandas as pd
+    import plotly.express  # noqa: F401
+    import plotly.io  # noqa: F401
+
+    # workers the pool replaces after a crash are spawned with the app's environment
+    environ = local_code_environment()
+    os.environ.clear()
+    os.environ.update(environ)
+    sys.path.insert(0, SANDBOX_HELPERS_DIR)
+    _worker_state["data_dir"] = data_dir
+    _worker_state["frames"] = {
+        dataframe_filename: getattr(pd, f"read_{dataframe_filename.rsplit('.', 1)[-1]}")(
+            os.path.join(data_dir, dataframe_filename)
+        )
+    }
+    _patch_dataframe_readers(pd)
+
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _raise_cpu_time_limit_exceeded)
+        if memory_limit_mb is not None:
+            address_space = current_address_space() + memory_limit_mb * 1024**2
+            resource.setrlimit(resource.RLIMIT_AS, (address_space, resource.RLIM_INFINITY))
+
+
+def _patch_dataframe_readers(pd):
+    """Serve reads of the session dataframes from frames held in memory, each table is read
+    from the data directory once per worker.
+    """
+    for reader_name in ("read_parquet", "read_csv"):
+        reader = getattr(pd, reader_name)
+
+        def read_preloaded(path, *args, _reader=reader, **kwargs):
+            filename = os.path.basename(str(path))
+            frames = _worker_state["frames"]
+            if args or kwargs:
+                return _reader(path, *args, **kwargs)
+            if filename not in frames:
+                data_path = os.path.join(_worker_state["data_dir"], filename)
+                if not os.path.isfile(data_path):
+                    return _reader(path)
+                frames[filename] = _reader(data_path)
+            return frames[filename].copy()
+
+        setattr(pd, reader_name, read_preloaded)
+
+
+def current_address_space() -> int:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _raise_cpu_time_limit_exceeded(signum, frame):
+    raise CPUTimeLimitExceeded("CPU time limit exceeded")
+
+
+def _worker_ready(_) -> bool:
+    return True
+
+
+def _run_in_worker(code: str, plotting_code: bool, cpu_time_limit: Optional[int]) -> ExecutionResult:
+    work_dir = tempfile.mkdtemp(dir=_worker_state["data_dir"])
+    for filename in os.listdir(_worker_state["data_dir"]):
+        if os.path.isfile(os.path.join(_worker_state["data_dir"], filename)):
+            os.symlink(os.path.join(_worker_state["data_dir"], filename), os.path.join(work_dir, filename))
+
+    if resource is not None and cpu_time_limit is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft_limit = int(usage.ru_utime + usage.ru_stime) + cpu_time_limit
+        resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, resource.RLIM_INFINITY))
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            exec(compile(code, SANDBOX_CODE_PATH, "exec"), {"__name__": "__main__"})
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        stderr.write(traceback.format_exc())
+        exit_code = 1
+    finally:
+        os.chdir(cwd)
+        if resource is not None and cpu_time_limit is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+
+    figure_json = None
+    figure_path = os.path.join(work_dir, FIGURE_SAVE_PATH)
+    if plotting_code and exit_code == 0 and os.path.exists(figure_path):
+        with open(figure_path, "rb") as file:
+            figure_json = file.read()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return ExecutionResult(
+        stdout=stdout.getvalue().rstrip("\n"),
+        stderr=stderr.getvalue().rstrip("\n"),
+        exit_code=exit_code,
+        figure_json=figure_json,
+    )
+
+
+class LocalProcessExecutionBackend(ExecutionBackend):
+    """Executes code in a pool of local worker processes which have pandas and plotly
+    imported and the main session dataframe loaded before the first execution arrives. Other
+    tables of the session are written to the data directory when code first reads them.
+
+    Every execution is bounded by a CPU time limit, a memory limit and a wall clock timeout.
+    A timed out execution takes its worker down with it, so the pool is rebuilt.
+    """
+
+    def __init__(
+        self,
+        sandbox_df: SandboxDataFrame,
+        workers: int = 2,
+        cpu_time_limit: Optional[int] = 60,
+        memory_limit_mb: Optional[int] = 2048,
+        timeout: float = 120.0,
+    ):
+        self.sandbox_df = sandbox_df
+        self.workers = workers
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit_mb = memory_limit_mb
+        self.timeout = timeout
+
+        self.data_dir = tempfile.mkdtemp(prefix="llm-plotting-executor-")
+        self._written: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._write_table(sandbox_df)
+
+        self._pool = self._start_pool()
+        self._finalizer = weakref.finalize(self, self._shutdown, self._pool, self.data_dir)
+
+    def _start_pool(self):
+        with _local_code_environ():
+            pool = multiprocessing.get_context("spawn").Pool(
+                processes=self.workers,
+                initializer=_init_worker,
+                initargs=(self.data_dir, self.sandbox_df.filename, self.memory_limit_mb),
+            )
+        # worker start up is not counted against the timeout of the first execution
+        self._pool_ready = pool.map_async(_worker_ready, range(self.workers), chunksize=1)
+        return pool
+
+    def _write_table(self, sandbox_df: SandboxDataFrame):
+        with self._lock:
+            written = self._written.get(sandbox_df.filename)
+            if written == sandbox_df.fingerprint:
+                return
+            if written is not None:
+                # workers keep the frames they have read in memory, so a file cannot change
+                raise ValueError(f"Local executor already holds a different dataframe as {sandbox_df.filename}")
+            with open(os.path.join(self.data_dir, sandbox_df.filename), "wb") as file:
+                file.write(sandbox_df.payload)
+            self._written[sandbox_df.filename] = sandbox_df.fingerprint
+
+    def execute(self, code: str, sandbox_dfs: Sequence[SandboxDataFrame], plotting_code: bool) -> ExecutionResult:
+        try:
+            for sandbox_df in sandbox_dfs:
+                self._write_table(sandbox_df)
+        except ValueError as e:
+            return ExecutionResult(stderr=str(e), exit_code=1)
+
+        self._pool_ready.wait()
+        async_result = self._pool.apply_async(_run_in_worker, (code, plotting_code, self.cpu_time_limit))
+        try:
+            with get_tracer().span("executor.run") as span:
+                result = async_result.get(timeout=self.timeout)
+                span.set(exit_code=result.exit_code)
+            return result
+        except multiprocessing.TimeoutError:
+            Logger.warning(f"Local execution timed out after {self.timeout}s, restarting worker pool")
+            self._pool.terminate()
+            self._pool = self._start_pool()
+            self._finalizer.detach()
+            self._finalizer = weakref.finalize(self, self._shutdown, self._pool, self.data_dir)
+            return ExecutionResult(stderr=f"Execution timed out after {self.timeout} seconds", exit_code=1)
+
+    def close(self):
+        self._finalizer()
+
+    @staticmethod
+    def _shutdown(pool, data_dir: str):
+        pool.terminate()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def create_execution_backend(
+    settings: Settings,
+    sandbox_df: SandboxDataFrame,
+    sandbox_pool: Optional[SandboxPool] = None,
+) -> ExecutionBackend:
+    if settings.execution_backend == "e2b":
+        return E2BExecutionBackend(sandbox_pool or get_sandbox_pool(settings))
+    if settings.execution_backend == "local":
+        return LocalProcessExecutionBackend(
+            sandbox_df,
+            workers=settings.local_executor_workers,
+            cpu_time_limit=settings.local_executor_cpu_time_limit,
+            memory_limit_mb=settings.local_executor_memory_limit_mb,
+            timeout=settings.local_executor_timeout,
+        )
+    raise ValueError(f"Unknown execution backend: {settings.execution_backend}")
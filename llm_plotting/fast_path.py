@@ -0,0 +1,373 @@
+"""In-process fast path for read-only pandas questions.
+
+Code which only reads the session dataframes and prints pandas expressions of them is run in a
+forked child of the app process, which already holds the frames, instead of a sandbox which
+has to be booted and sent the data. The code has to pass an AST whitelist: pandas and numpy
+are the only imports, session files the only reads, and only the statements, builtins and
+attributes listed below are allowed, so there are no loops, lambdas, definitions or I/O. The
+child runs under CPU time and memory limits and is killed at the timeout. Everything else,
+including code which hits a limit, is left to the sandbox.
+"""
+
+import ast
+import builtins
+import contextlib
+import io
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from typing import Any, Dict, Iterable, Optional, Sequence
+
+import pandas as pd
+import streamlit as st
+from pydantic import BaseModel, ConfigDict
+
+from llm_plotting.code_checks import PATH_ARGUMENTS, is_dataframe_read, read_path
+from llm_plotting.dataset import SandboxDataFrame, restore_standard_dtypes
+from llm_plotting.executors import ExecutionResult, current_address_space
+from llm_plotting.sandbox import SANDBOX_CODE_PATH
+from llm_plotting.settings import Settings
+from llm_plotting.tracing import get_tracer
+
+try:
+    import resource
+except ImportError:  # not available on windows, limits are skipped
+    resource = None
+
+Logger = logging.getLogger(st.__name__)
+
+FAST_PATH_MODULES = ("pandas", "numpy")
+# methods like to_string and info, which write to a file given as any argument, are not on the
+# whitelist at all, these keywords are rejected in case such a method is added
+FILE_ARGUMENTS = ("buf", *PATH_ARGUMENTS)
+# fmt: off
+SAFE_BUILTINS = (
+    "abs", "bool", "dict", "float", "int", "len", "list", "max", "min", "print", "round", "set", "sorted", "str",
+    "sum", "tuple",
+)
+ALLOWED_ATTRIBUTES = frozenset(
+    [
+        # dataframes and series
+        "abs", "agg", "aggregate", "all", "any", "astype", "between", "clip", "columns", "corr", "count", "cov",
+        "cummax", "cummin", "cumsum", "describe", "diff", "drop", "drop_duplicates", "dropna", "dt", "dtype",
+        "dtypes", "duplicated", "empty", "fillna", "first", "groupby", "head", "iat", "idxmax", "idxmin", "iloc",
+        "index", "isin", "isna", "isnull", "kurt", "last", "loc", "max", "mean", "median", "melt", "merge",
+        "min", "mode", "name", "ndim", "nlargest", "notna", "notnull", "nsmallest", "nunique", "pct_change",
+        "pivot_table", "quantile", "rank", "rename", "replace", "reset_index", "round", "sem", "set_index", "shape",
+        "size", "skew", "sort_index", "sort_values", "std", "sum", "T", "tail", "to_dict", "to_frame", "to_list",
+        "tolist", "transpose", "unique", "value_counts", "values", "var", "where",
+        # string and datetime accessors
+        "contains", "date", "day", "dayofweek", "endswith", "hour", "len", "lower", "month", "quarter", "split",
+        "startswith", "strip", "title", "upper", "weekday", "year",
+        # pandas and numpy functions
+        "concat", "crosstab", "cut", "inf", "isnan", "nan", "percentile", "qcut", "sqrt", "to_datetime",
+        "to_numeric",
+    ]
+)
+# pandas looks functions given by name up as attributes of the frame, so the names passed to these
+# calls have to be reductions. The keyword and position of their function argument, positional
+# arguments after it are passed on to the function
+AGGREGATING_CALLS = {
+    "agg": ("func", 0), "aggregate": ("func", 0), "pivot_table": ("aggfunc", 3), "crosstab": ("aggfunc", 5),
+}
+AGGREGATIONS = frozenset(
+    [
+        "all", "any", "count", "first", "idxmax", "idxmin", "kurt", "last", "max", "mean", "median", "min",
+        "nunique", "prod", "sem", "size", "skew", "std", "sum", "var",
+    ]
+)
+ALLOWED_EXPRESSIONS = (
+    ast.Attribute, ast.BinOp, ast.BoolOp, ast.Call, ast.Compare, ast.Constant, ast.Dict, ast.FormattedValue,
+    ast.IfExp, ast.JoinedStr, ast.List, ast.Name, ast.Set, ast.Slice, ast.Subscript, ast.Tuple, ast.UnaryOp,
+    ast.keyword, ast.expr_context, ast.operator, ast.boolop, ast.unaryop, ast.cmpop,
+)
+# fmt: on
+
+
+class FastPathPlan(BaseModel):
+    """Whitelisted code compiled without its imports and reads, along with what they bind."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    code: Any
+    modules: Dict[str, str]
+    frames: Dict[str, str]
+
+
+class _Whitelist:
+    def __init__(self, filenames: Iterable[str]):
+        self.filenames = set(filenames)
+        self.modules: Dict[str, str] = {}
+        self.frames: Dict[str, str] = {}
+        self.names = set(SAFE_BUILTINS)
+
+    def statement(self, node: ast.stmt) -> Optional[ast.stmt]:
+        """The statement to run, a ``pass`` for imports and reads, None when it is not allowed."""
+        if isinstance(node, ast.Import):
+            if not all(alias.name in FAST_PATH_MODULES for alias in node.names):
+                return None
+            for alias in node.names:
+                self._bind(alias.asname or alias.name, self.modules, alias.name)
+            return ast.copy_location(ast.Pass(), node)
+
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            filename = self._session_read(node.value)
+            if filename is not None:
+                self._bind(node.targets[0].id, self.frames, filename)
+                return ast.copy_location(ast.Pass(), node)
+
+        if isinstance(node, (ast.Assign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if not self.expression(node.value) or not all(self.target(target) for target in targets):
+                return None
+            self.names.update(target.id for target in targets if isinstance(target, ast.Name))
+            return node
+
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            func = node.value.func
+            if isinstance(func, ast.Name) and func.id == "print" and self.expression(node.value):
+                return node
+        return None
+
+    def _bind(self, name: str, bindings: Dict[str, str], value: str):
+        for other in (self.modules, self.frames):
+            other.pop(name, None)
+        bindings[name] = value
+        self.names.add(name)
+
+    def _session_read(self, node: ast.expr) -> Optional[str]:
+        if not is_dataframe_read(node) or len(node.args) + len(node.keywords) != 1:
+            return None
+        if node.keywords and node.keywords[0].arg not in PATH_ARGUMENTS:
+            return None
+        filename = read_path(node)
+        return filename if filename in self.filenames else None
+
+    def target(self, node: ast.expr) -> bool:
+        if isinstance(node, ast.Name):
+            return not node.id.startswith("_") and node.id not in self.modules
+        if isinstance(node, ast.Subscript):
+            value = node.value
+            if isinstance(value, ast.Attribute) and value.attr in ("loc", "iloc"):
+                value = value.value
+            return isinstance(value, ast.Name) and value.id in self.names and self.expression(node.slice)
+        return False
+
+    def expression(self, node: ast.expr) -> bool:
+        for child in ast.walk(node):
+            if not isinstance(child, ALLOWED_EXPRESSIONS):
+                return False
+            if isinstance(child, ast.Name) and (child.id.startswith("_") or child.id not in self.names):
+                return False
+            if isinstance(child, ast.Attribute) and child.attr not in ALLOWED_ATTRIBUTES:
+                return False
+            if isinstance(child, ast.Call) and not isinstance(child.func, (ast.Name, ast.Attribute)):
+                return False
+            if isinstance(child, ast.Call) and not self._aggregations(child):
+                return False
+            # ** unpacking would hide the keyword names
+            if isinstance(child, ast.keyword) and (child.arg is None or child.arg in FILE_ARGUMENTS):
+                return False
+        return True
+
+    def _aggregations(self, node: ast.Call) -> bool:
+        """Whether the functions passed to an aggregating call are all reductions."""
+        name = node.func.attr if isinstance(node.func, ast.Attribute) else node.func.id
+        if name not in AGGREGATING_CALLS:
+            return True
+        keyword, position = AGGREGATING_CALLS[name]
+        functions = node.args[position:] + [k.value for k in node.keywords if k.arg == keyword]
+        if name in ("agg", "aggregate"):
+            # named aggregations like total=("salary", "sum")
+            named = [k.value for k in node.keywords if k.arg not in (keyword, "axis")]
+            if not all(isinstance(value, ast.Tuple) and len(value.elts) == 2 for value in named):
+                return False
+            functions += [value.elts[1] for value in named]
+        return all(self._aggregation(function) for function in functions)
+
+    def _aggregation(self, node: ast.expr) -> bool:
+        if isinstance(node, ast.Constant):
+            return node.value in AGGREGATIONS
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return all(self._aggregation(element) for element in node.elts)
+        if isinstance(node, ast.Dict):
+            return all(self._aggregation(value) for value in node.values)
+        # whitelisted names and attributes like np.mean
+        return isinstance(node, (ast.Name, ast.Attribute))
+
+
+def may_take_fast_path(imports: str) -> bool:
+    """Whether code starting with the import lines ``imports`` may be answered by the fast path,
+    judging by whether it imports nothing but the fast path modules.
+    """
+    try:
+        tree = ast.parse(imports)
+    except SyntaxError:
+        return False
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            modules.add((node.module or "").split(".")[0])
+    return bool(modules) and modules <= set(FAST_PATH_MODULES)
+
+
+def plan_fast_path(code: str, filenames: Iterable[str]) -> Optional[FastPathPlan]:
+    """The plan to run ``code`` in process, None when the code is not on the whitelist."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    whitelist = _Whitelist(filenames)
+    body = []
+    for node in tree.body:
+        statement = whitelist.statement(node)
+        if statement is None:
+            return None
+        body.append(statement)
+    if not any(isinstance(node, ast.Expr) for node in body):
+        return None
+
+    module = ast.Module(body=body, type_ignores=[])
+    return FastPathPlan(
+        code=compile(module, SANDBOX_CODE_PATH, "exec"), modules=whitelist.modules, frames=whitelist.frames
+    )
+
+
+def _evaluate_in_child(plan: FastPathPlan, frames: Dict[str, pd.DataFrame], connection, cpu_time_limit, memory_mb):
+    # code sees the dtypes a plain read gives, like in the sandbox
+    namespace = {"__builtins__": {name: getattr(builtins, name) for name in SAFE_BUILTINS}}
+    namespace.update({name: __import__(module) for name, module in plan.modules.items()})
+    namespace.update({name: restore_standard_dtypes(df) for name, df in frames.items()})
+
+    if resource is not None:
+        if cpu_time_limit is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft_limit = int(usage.ru_utime + usage.ru_stime) + cpu_time_limit
+            resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, resource.RLIM_INFINITY))
+        if memory_mb is not None:
+            address_space = current_address_space() + memory_mb * 1024**2
+            resource.setrlimit(resource.RLIMIT_AS, (address_space, resource.RLIM_INFINITY))
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            exec(plan.code, namespace)
+    except MemoryError:
+        # over the limit here, the sandbox may have more room
+        connection.send(None)
+        return
+    except BaseException:
+        stderr.write(traceback.format_exc())
+        exit_code = 1
+    connection.send(
+        ExecutionResult(
+            stdout=stdout.getvalue().rstrip("\n"), stderr=stderr.getvalue().rstrip("\n"), exit_code=exit_code
+        )
+    )
+
+
+class FastPathEvaluator:
+    """Runs whitelisted code in forked children and keeps track of the latency saved, which is
+    the average sandbox execution time of code answering questions minus the fast path time.
+    """
+
+    def __init__(self, cpu_time_limit: Optional[int] = 5, memory_limit_mb: Optional[int] = 512, timeout: float = 10.0):
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit_mb = memory_limit_mb
+        self.timeout = timeout
+        self.available = "fork" in multiprocessing.get_all_start_methods()
+
+        self._lock = threading.Lock()
+        self.evaluations = 0
+        self.fallbacks = 0
+        self.seconds = 0.0
+        self.seconds_saved = 0.0
+        self._sandbox_seconds: Optional[float] = None
+
+    def plan(self, code: str, sandbox_dfs: Sequence[SandboxDataFrame]) -> Optional[FastPathPlan]:
+        if not self.available:
+            return None
+        return plan_fast_path(code, [sandbox_df.filename for sandbox_df in sandbox_dfs])
+
+    def evaluate(self, plan: FastPathPlan, sandbox_dfs: Sequence[SandboxDataFrame]) -> Optional[ExecutionResult]:
+        """The result of the plan, None when the child hit a limit or died."""
+        dfs = {sandbox_df.filename: sandbox_df.df for sandbox_df in sandbox_dfs}
+        frames = {name: dfs[filename] for name, filename in plan.frames.items()}
+
+        with get_tracer().span("fast_path.run", frames=len(frames)) as span:
+            start = time.perf_counter()
+            result = self._run_child(plan, frames)
+            seconds = time.perf_counter() - start
+
+            with self._lock:
+                saved = None if self._sandbox_seconds is None else max(self._sandbox_seconds - seconds, 0.0)
+                if result is None:
+                    self.fallbacks += 1
+                else:
+                    self.evaluations += 1
+                    self.seconds += seconds
+                    self.seconds_saved += saved or 0.0
+            span.set(completed=result is not None)
+            if result is not None and saved is not None:
+                span.set(saved_s=round(saved, 4))
+        if result is None:
+            Logger.info(f"Fast path gave up after {seconds:.2f}s, running the code in the sandbox")
+        return result
+
+    def _run_child(self, plan: FastPathPlan, frames: Dict[str, pd.DataFrame]) -> Optional[ExecutionResult]:
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_evaluate_in_child,
+            args=(plan, frames, sender, self.cpu_time_limit, self.memory_limit_mb),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        try:
+            return receiver.recv() if receiver.poll(self.timeout) else None
+        except EOFError:
+            return None
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join()
+            receiver.close()
+
+    def record_sandbox_time(self, seconds: float):
+        with self._lock:
+            previous = self._sandbox_seconds
+            self._sandbox_seconds = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "evaluations": self.evaluations,
+                "fallbacks": self.fallbacks,
+                "mean_seconds": round(self.seconds / self.evaluations, 4) if self.evaluations else 0.0,
+                "mean_sandbox_seconds": round(self._sandbox_seconds or 0.0, 4),
+                "seconds_saved": round(self.seconds_saved, 4),
+            }
+
+
+_fast_path_evaluator: Optional[FastPathEvaluator] = None
+_fast_path_evaluator_lock = threading.Lock()
+
+
+def get_fast_path_evaluator(settings: Settings) -> FastPathEvaluator:
+    """Process wide evaluator, so the sandbox times it compares against come from every session."""
+    global _fast_path_evaluator
+    with _fast_path_evaluator_lock:
+        if _fast_path_evaluator is None:
+            _fast_path_evaluator = FastPathEvaluator(
+                cpu_time_limit=settings.fast_path_cpu_time_limit,
+                memory_limit_mb=settings.fast_path_memory_limit_mb,
+                timeout=settings.fast_path_timeout,
+            )
+    return _fast_path_evaluator
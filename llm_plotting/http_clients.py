@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from llm_plotting.settings import Settings
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_http_session(settings: Settings) -> requests.Session:
+    """Process wide session so that sync requests reuse keep-alive connections."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=settings.http_max_keepalive_connections,
+                pool_maxsize=settings.http_max_connections,
+            )
+            _http_session = requests.Session()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+    return _http_session
+
+
+def get_async_http_client(settings: Settings) -> httpx.AsyncClient:
+    """Keep-alive client shared by everything running on the current event loop. httpx
+    connections are bound to the loop they were opened on, so each loop gets its own client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.http_max_connections,
+                max_keepalive_connections=settings.http_max_keepalive_connections,
+            ),
+            timeout=settings.http_timeout,
+        )
+        _async_http_clients[loop] = client
+    return client
@@ -0,0 +1,79 @@
+import base64
+import itertools
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple
+
+from PIL import Image
+from pydantic import BaseModel
+
+
+class StoredImage(BaseModel):
+    handle: str
+    data: bytes
+    mime_type: str = "image/png"
+    key: Optional[str] = None
+
+
+class ImageStore:
+    """Per session store of rendered figures, holding raw bytes rather than base64 strings.
+    Callers keep the short handle returned by ``put``, or look it up by the ``key`` the image was
+    stored under, and resolve it when displaying. The
+    oldest images are evicted once either ``max_images`` or ``max_bytes`` is exceeded.
+    """
+
+    def __init__(self, max_images: int = 20, max_bytes: int = 50 * 1024**2):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+
+        self._images: "OrderedDict[str, StoredImage]" = OrderedDict()
+        self._size = 0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+    @property
+    def latest_handle(self) -> Optional[str]:
+        return next(reversed(self._images), None)
+
+    def put(self, data: bytes, mime_type: str = "image/png", key: Optional[str] = None) -> str:
+        with self._lock:
+            handle = f"img-{next(self._counter)}"
+            self._images[handle] = StoredImage(handle=handle, data=data, mime_type=mime_type, key=key)
+            self._size += len(data)
+            while len(self._images) > 1 and (len(self._images) > self.max_images or self._size > self.max_bytes):
+                _, evicted = self._images.popitem(last=False)
+                self._size -= len(evicted.data)
+        return handle
+
+    def get(self, handle: str) -> Optional[StoredImage]:
+        return self._images.get(handle)
+
+    def latest_handle_for(self, key: str) -> Optional[str]:
+        """Handle of the newest image stored under ``key``, e.g. the code that produced it."""
+        with self._lock:
+            return next((image.handle for image in reversed(self._images.values()) if image.key == key), None)
+
+
+def prepare_validation_image(
+    image_in_bytes: bytes, mime_type: str = "image/png", max_size: int = 1024
+) -> Tuple[str, str]:
+    """Downscale an image so its longest side is at most ``max_size`` pixels and return it
+    base64 encoded with its mime type, ready to send to the vision model.
+    """
+    image = Image.open(BytesIO(image_in_bytes))
+    if max(image.size) <= max_size:
+        return base64.b64encode(image_in_bytes).decode("utf-8"), mime_type
+
+    image.thumbnail((max_size, max_size))
+    buffer = BytesIO()
+    image_format = "JPEG" if mime_type == "image/jpeg" else "PNG"
+    image.convert("RGB").save(buffer, format=image_format)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8"), f"image/{image_format.lower()}"
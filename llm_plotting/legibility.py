@@ -0,0 +1,211 @@
+import base64
+import json
+import re
+import threading
+from typing import Dict, List, Union
+
+import numpy as np
+from pydantic import BaseModel
+
+CARTESIAN_TRACE_TYPES = ("bar", "scatter", "scattergl", "histogram", "box", "violin", "heatmap", "funnel", "waterfall")
+# trace types whose legibility the checks understand well enough to accept without the vision model
+WELL_UNDERSTOOD_TRACE_TYPES = ("bar", "scatter", "scattergl", "histogram", "box", "heatmap", "pie")
+POINT_ATTRIBUTES = ("x", "y", "z", "values", "labels", "lat", "lon", "r")
+# axis types plotly gives string values which are not categories
+CONTINUOUS_AXIS_TYPES = ("linear", "log", "date")
+# datetimes serialise to ISO strings in the figure JSON
+DATE_PATTERN = re.compile(r"\d{4}(-\d{2}(-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?)?)?")
+AVERAGE_CHARACTER_WIDTH = 7
+PLOT_MARGIN = 160
+
+
+class LegibilityReport(BaseModel):
+    """``issues`` are clear failures with fix instructions, ``warnings`` are signals that are
+    not clear cut and need the vision model to judge.
+    """
+
+    issues: List[str] = []
+    warnings: List[str] = []
+
+    @property
+    def clean(self) -> bool:
+        return not self.issues and not self.warnings
+
+
+def _values(values) -> list:
+    if isinstance(values, dict) and "bdata" in values:
+        return np.frombuffer(base64.b64decode(values["bdata"]), dtype=values.get("dtype", "f8")).tolist()
+    return values if isinstance(values, list) else []
+
+
+def _is_date_or_number(value: str) -> bool:
+    if DATE_PATTERN.fullmatch(value.strip()):
+        return True
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _axis_key(reference: str) -> str:
+    # trace references look like "x2", the layout keys like "xaxis2"
+    return f"{reference[0]}axis{reference[1:]}"
+
+
+def _axis_title(layout: Dict, axis_key: str) -> str:
+    title = layout.get(axis_key, {}).get("title")
+    if isinstance(title, dict):
+        title = title.get("text")
+    return (title or "").strip()
+
+
+class LegibilityChecker:
+    """Deterministic legibility checks over the Plotly figure JSON emitted from the sandbox,
+    run before the figure is rasterised and sent to the vision model.
+
+    Figures with clear problems, such as too many categories or legend entries, empty traces
+    or missing axis titles, get fix instructions straight away. Clean figures of well
+    understood trace types can be accepted without the vision model when ``auto_accept`` is
+    set, everything else is escalated.
+    """
+
+    def __init__(
+        self,
+        max_categories: int = 50,
+        warn_categories: int = 25,
+        max_legend_entries: int = 20,
+        warn_legend_entries: int = 10,
+        max_label_length: int = 30,
+        plot_width: int = 800,
+        auto_accept: bool = False,
+    ):
+        self.max_categories = max_categories
+        self.warn_categories = warn_categories
+        self.max_legend_entries = max_legend_entries
+        self.warn_legend_entries = warn_legend_entries
+        self.max_label_length = max_label_length
+        self.plot_width = plot_width
+        self.auto_accept = auto_accept
+        self.rejected = 0
+        self.accepted = 0
+        self.escalated = 0
+
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, int]:
+        return {"rejected": self.rejected, "accepted": self.accepted, "escalated": self.escalated}
+
+    def check(self, figure_json: Union[bytes, str, Dict]) -> LegibilityReport:
+        figure = json.loads(figure_json) if isinstance(figure_json, (bytes, str)) else figure_json
+        report = self.analyse(figure)
+        with self._lock:
+            if report.issues:
+                self.rejected += 1
+            elif self.accepts(figure, report):
+                self.accepted += 1
+            else:
+                self.escalated += 1
+        return report
+
+    def accepts(self, figure: Dict, report: LegibilityReport) -> bool:
+        """True when the vision model can be skipped for a figure without issues."""
+        trace_types = {trace.get("type", "scatter") for trace in figure.get("data", [])}
+        return self.auto_accept and report.clean and trace_types <= set(WELL_UNDERSTOOD_TRACE_TYPES)
+
+    def analyse(self, figure: Dict) -> LegibilityReport:
+        report = LegibilityReport()
+        traces = figure.get("data", [])
+        layout = figure.get("layout", {})
+
+        points = [max((len(_values(trace.get(name))) for name in POINT_ATTRIBUTES), default=0) for trace in traces]
+        if not traces or not any(points):
+            report.issues.append("The figure contains no data. Check the filtering and aggregation steps.")
+            return report
+        empty = [trace.get("name") or f"trace {i}" for i, (trace, n) in enumerate(zip(traces, points)) if n == 0]
+        if empty:
+            report.issues.append(f"These traces are empty and should be removed or fixed: {', '.join(empty)}.")
+
+        self._check_categories(traces, layout, report)
+        self._check_legend(traces, layout, report)
+        self._check_axis_titles(traces, layout, report)
+        return report
+
+    def _categorical_axes(self, traces: List[Dict], layout: Dict) -> Dict[str, List[str]]:
+        """Labels of the axes showing categories. Axes plotly does not lay out as categories,
+        going by the axis type or, when it is not set, by whether all values are dates or numbers
+        like plotly's own guess, are left out.
+        """
+        axes: Dict[str, List[str]] = {}
+        for trace in traces:
+            if trace.get("type", "scatter") not in CARTESIAN_TRACE_TYPES:
+                continue
+            for name in ("x", "y"):
+                values = _values(trace.get(name))
+                if values and all(isinstance(value, str) for value in values):
+                    axis_key = _axis_key(trace.get(f"{name}axis", name))
+                    axes.setdefault(axis_key, []).extend(values)
+
+        categorical_axes = {}
+        for axis_key, labels in axes.items():
+            labels = list(dict.fromkeys(labels))
+            axis_type = layout.get(axis_key, {}).get("type")
+            if axis_type in CONTINUOUS_AXIS_TYPES:
+                continue
+            if axis_type not in ("category", "multicategory") and all(_is_date_or_number(label) for label in labels):
+                continue
+            categorical_axes[axis_key] = labels
+        return categorical_axes
+
+    def _check_categories(self, traces: List[Dict], layout: Dict, report: LegibilityReport):
+        for axis_key, labels in self._categorical_axes(traces, layout).items():
+            axis = axis_key.replace("axis", " axis ").strip()
+            if len(labels) > self.max_categories:
+                report.issues.append(
+                    f"The {axis} has {len(labels)} categories, which cannot be read. Show only the top "
+                    f"{self.warn_categories} categories and group the rest into 'Other', or aggregate further."
+                )
+            elif len(labels) > self.warn_categories:
+                report.warnings.append(f"The {axis} has {len(labels)} categories.")
+
+            longest = max(len(label) for label in labels)
+            rotated = layout.get(axis_key, {}).get("tickangle") not in (None, 0, "auto")
+            if axis_key.startswith("x") and longest > self.max_label_length and not rotated:
+                report.issues.append(
+                    f"Tick labels on the {axis} are up to {longest} characters long and unrotated. Use a "
+                    "horizontal bar chart, shorten the labels or rotate them with fig.update_xaxes(tickangle=-45)."
+                )
+            elif sum(len(label) for label in labels) * AVERAGE_CHARACTER_WIDTH > self.plot_width - PLOT_MARGIN:
+                report.warnings.append(f"Tick labels on the {axis} may overlap.")
+
+    def _check_legend(self, traces: List[Dict], layout: Dict, report: LegibilityReport):
+        if layout.get("showlegend") is False:
+            return
+        entries = {trace.get("name") for trace in traces if trace.get("showlegend", True) and trace.get("name")}
+        slices = max((len(_values(trace.get("labels"))) for trace in traces if trace.get("type") == "pie"), default=0)
+        n_entries = max(len(entries), slices)
+        if n_entries > self.max_legend_entries:
+            report.issues.append(
+                f"The legend has {n_entries} entries. Keep the top {self.warn_legend_entries} groups and combine "
+                "the rest into 'Other', or use facets instead of colours."
+            )
+        elif n_entries > self.warn_legend_entries:
+            report.warnings.append(f"The legend has {n_entries} entries.")
+
+    def _check_axis_titles(self, traces: List[Dict], layout: Dict, report: LegibilityReport):
+        missing = set()
+        for trace in traces:
+            if trace.get("type", "scatter") not in CARTESIAN_TRACE_TYPES:
+                continue
+            for name in ("x", "y"):
+                # like the x axis of a box plot of a single column, which shows no data
+                if trace.get(name) is None:
+                    continue
+                axis_key = _axis_key(trace.get(f"{name}axis", name))
+                if not _axis_title(layout, axis_key):
+                    missing.add(axis_key.replace("axis", " axis ").strip())
+        if missing:
+            report.issues.append(
+                f"Add a descriptive title to the {' and '.join(sorted(missing))}, e.g. with "
+                "fig.update_layout(xaxis_title=..., yaxis_title=...)."
+            )
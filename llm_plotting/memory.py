@@ -0,0 +1,159 @@
+import ast
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.pydantic_v1 import BaseModel
+from langchain_core.agents import AgentStep
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from llm_plotting.prompt_helper import count_tokens
+from llm_plotting.speculative import is_accepted
+
+CODE_BLOCK_PATTERN = re.compile(r"```.*?(?:```|$)", re.DOTALL)
+SUMMARY_HEADER = "Summary of earlier questions in this conversation:"
+
+
+def strip_code_blocks(text: str) -> str:
+    """The text without fenced code, which is kept separately as the accepted code of the turn."""
+    return re.sub(r"\n{3,}", "\n\n", CODE_BLOCK_PATTERN.sub("", text)).strip()
+
+
+def code_topic(code: str, columns: List[str]) -> Optional[FrozenSet[str]]:
+    """Columns the code names. Accepted code naming the same columns answers the same topic, so
+    only the latest such code is worth sending again. None when no column is named.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = {node.value for node in ast.walk(tree) if isinstance(node, ast.Constant) and isinstance(node.value, str)}
+    return frozenset(names & set(columns)) or None
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else f"{text[: max_chars - 3].rstrip()}..."
+
+
+class MemoryTurn(BaseModel):
+    user_input: str
+    answer: str
+    code: Optional[str] = None
+    topic: Optional[FrozenSet[str]] = None
+
+    def messages(self, code: Optional[str]) -> List[BaseMessage]:
+        answer = self.answer
+        if code is not None:
+            answer = f"{answer}\n\nAccepted code:\n```python\n{code}\n```".strip()
+        return [HumanMessage(content=self.user_input), AIMessage(content=answer)]
+
+    def summary(self, code: Optional[str], max_chars: int = 100) -> str:
+        summary = f"- Asked: {_truncate(self.user_input, max_chars)} Answered: {_truncate(self.answer, max_chars)}"
+        if code is not None:
+            summary += f" Accepted code:\n```python\n{code}\n```"
+        return summary
+
+
+class TokenBudgetMemory(BaseChatMemory):
+    """Conversation memory which sends at most ``token_budget`` tokens of earlier turns.
+
+    Only the code accepted in a turn is kept, never the rejected attempts, and code blocks in
+    the answers are dropped. Code is superseded by later accepted code naming the same columns.
+    The newest turns are sent verbatim within ``verbatim_share`` of the budget, older ones as
+    one line summaries and the oldest are dropped once the budget is spent. The full
+    conversation stays in ``chat_memory``.
+    """
+
+    memory_key: str = "chat_history"
+    token_budget: int = 1500
+    verbatim_share: float = 0.6
+    columns: List[str] = []
+    tracer: Any = None
+    turns: List[MemoryTurn] = []
+    last_metrics: Dict[str, int] = {}
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, Any]):
+        code = None
+        for action, observation in outputs.get("intermediate_steps", []):
+            tool_input = action.tool_input
+            if isinstance(tool_input, dict) and "code" in tool_input:
+                if is_accepted(AgentStep(action=action, observation=observation)):
+                    code = tool_input["code"]
+        self.save_turn(inputs[self.input_key], str(outputs[self.output_key]), code)
+
+    def save_turn(self, user_input: str, answer: str, code: Optional[str] = None):
+        self.chat_memory.add_user_message(user_input)
+        self.chat_memory.add_ai_message(answer)
+        self.turns.append(
+            MemoryTurn(
+                user_input=user_input,
+                answer=strip_code_blocks(answer),
+                code=code,
+                topic=code_topic(code, self.columns) if code is not None else None,
+            )
+        )
+
+    def clear(self):
+        super().clear()
+        self.turns = []
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        if self.tracer is None:
+            messages, self.last_metrics = self.build_messages()
+        else:
+            with self.tracer.span("agent.memory") as span:
+                messages, self.last_metrics = self.build_messages()
+                span.set(**self.last_metrics)
+        return {self.memory_key: messages}
+
+    def _latest_code_turns(self) -> set:
+        latest: Dict[Any, int] = {}
+        for i, turn in enumerate(self.turns):
+            if turn.code is not None:
+                latest[turn.topic if turn.topic is not None else i] = i
+        return set(latest.values())
+
+    def build_messages(self) -> Tuple[List[BaseMessage], Dict[str, int]]:
+        """Messages of the earlier turns within the budget, with metrics of what was kept."""
+        latest_code_turns = self._latest_code_turns()
+        verbatim: List[BaseMessage] = []
+        summaries: List[str] = []
+        used = count_tokens(SUMMARY_HEADER)
+        dropped = 0
+
+        for i in reversed(range(len(self.turns))):
+            turn = self.turns[i]
+            code = turn.code if i in latest_code_turns else None
+            if not summaries:
+                messages = turn.messages(code)
+                cost = sum(count_tokens(message.content) for message in messages)
+                if used + cost <= self.token_budget * self.verbatim_share:
+                    verbatim = messages + verbatim
+                    used += cost
+                    continue
+            for summary in dict.fromkeys([turn.summary(code), turn.summary(None)]):
+                cost = count_tokens(summary)
+                if used + cost <= self.token_budget:
+                    summaries.insert(0, summary)
+                    used += cost
+                    break
+            else:
+                dropped = i + 1
+                break
+
+        messages = verbatim
+        if summaries:
+            messages = [SystemMessage(content="\n".join([SUMMARY_HEADER, *summaries]))] + verbatim
+        metrics = {
+            "memory_tokens": sum(count_tokens(message.content) for message in messages),
+            "verbatim_turns": len(verbatim) // 2,
+            "summarised_turns": len(summaries),
+            "dropped_turns": dropped,
+            "superseded_code": sum(turn.code is not None for turn in self.turns) - len(latest_code_turns),
+        }
+        return messages, metrics
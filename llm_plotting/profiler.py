@@ -0,0 +1,311 @@
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from llm_plotting.dataset import fingerprint_dataframe, standard_dtype
+
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def _to_python(value):
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, np.floating):
+        return None if np.isnan(value) else round(float(value), 6)
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    return value
+
+
+class ColumnProfiler:
+    """Accumulates a fixed size summary of one column over a stream of chunks.
+
+    - quantiles come from a uniform bottom-k sample of ``sample_size`` values
+    - distinct counts come from a k minimum values sketch of ``sketch_size`` hashes
+    - top values come from value counts truncated to ``top_k * 10`` candidates per merge
+    """
+
+    def __init__(self, name: str, sample_size: int, sketch_size: int, top_k: int, seed: int = 0):
+        self.name = name
+        self.sample_size = sample_size
+        self.sketch_size = sketch_size
+        self.top_k = top_k
+        self.rng = np.random.default_rng(seed)
+
+        self.dtype = None
+        self.count = 0
+        self.missing = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sample = np.array([])
+        self.sample_keys = np.array([])
+        self.sketch = np.array([], dtype=np.uint64)
+        self.top_values: Counter = Counter()
+
+    @property
+    def kind(self) -> str:
+        if pd.api.types.is_bool_dtype(self.dtype):
+            return "categorical"
+        if pd.api.types.is_numeric_dtype(self.dtype):
+            return "numeric"
+        if pd.api.types.is_datetime64_any_dtype(self.dtype):
+            return "datetime"
+        return "categorical"
+
+    def update(self, series: pd.Series):
+        self.dtype = series.dtype if self.dtype is None else self.dtype
+        values = series.dropna()
+        self.missing += len(series) - len(values)
+        self.count += len(values)
+        if values.empty:
+            return
+
+        self._update_sketch(values)
+        if self.kind == "numeric":
+            self._update_numeric(values.to_numpy(dtype=np.float64))
+        elif self.kind == "datetime":
+            self._update_range(values.min(), values.max())
+        else:
+            self._update_top_values(values)
+
+    def _update_range(self, minimum, maximum):
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def _update_numeric(self, values: np.ndarray):
+        self._update_range(values.min(), values.max())
+        self.total += values.sum()
+        self.total_squares += np.square(values).sum()
+
+        keys = self.rng.random(len(values))
+        if len(values) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[: self.sample_size]
+            values, keys = values[keep], keys[keep]
+        sample = np.concatenate([self.sample, values])
+        sample_keys = np.concatenate([self.sample_keys, keys])
+        if len(sample) > self.sample_size:
+            keep = np.argpartition(sample_keys, self.sample_size)[: self.sample_size]
+            sample, sample_keys = sample[keep], sample_keys[keep]
+        self.sample, self.sample_keys = sample, sample_keys
+
+    def _update_sketch(self, values: pd.Series):
+        hashes = pd.util.hash_array(np.asarray(values.unique()))
+        if len(hashes) > self.sketch_size:
+            hashes = np.partition(hashes, self.sketch_size)[: self.sketch_size]
+        self.sketch = np.unique(np.concatenate([self.sketch, hashes]))[: self.sketch_size]
+
+    def _update_top_values(self, values: pd.Series):
+        counts = values.value_counts(sort=True).head(self.top_k * 10)
+        self.top_values.update({str(value): count for value, count in counts.items()})
+        if len(self.top_values) > self.top_k * 10:
+            self.top_values = Counter(dict(self.top_values.most_common(self.top_k * 10)))
+
+    @property
+    def distinct_count(self) -> int:
+        if len(self.sketch) < self.sketch_size:
+            return len(self.sketch)
+        kth_smallest = float(self.sketch[-1]) / np.iinfo(np.uint64).max
+        # the estimate can overshoot, there are never more distinct values than values
+        return min(int((self.sketch_size - 1) / kth_smallest), self.count)
+
+    def summary(self) -> Optional[Dict]:
+        if self.kind != "numeric" or self.count == 0:
+            return None
+
+        mean = self.total / self.count
+        variance = max(self.total_squares / self.count - mean**2, 0.0) * self.count / max(self.count - 1, 1)
+        quantiles = np.quantile(self.sample, QUANTILES)
+        return {
+            "count": self.count,
+            "mean": mean,
+            "std": np.sqrt(variance),
+            "min": self.minimum,
+            **{f"{int(q * 100)}%": value for q, value in zip(QUANTILES, quantiles)},
+            "max": self.maximum,
+        }
+
+
+def profile_chunks(
+    chunks: Iterable[pd.DataFrame],
+    sample_size: int = 10_000,
+    sketch_size: int = 1024,
+    top_k: int = 10,
+) -> Dict:
+    """Profile a dataframe delivered as a stream of chunks with memory bounded by the sample,
+    sketch and top-k sizes rather than by the number of rows.
+    """
+    profilers: Dict[str, ColumnProfiler] = {}
+    columns: List[str] = []
+    n_rows = 0
+
+    for chunk in chunks:
+        if not columns:
+            columns = chunk.columns.tolist()
+            profilers = {
+                column: ColumnProfiler(column, sample_size, sketch_size, top_k, seed=i)
+                for i, column in enumerate(columns)
+            }
+        n_rows += len(chunk)
+        for column in columns:
+            profilers[column].update(chunk[column])
+
+    profiles = [profilers[column] for column in columns]
+    profile = {
+        "column_names": columns,
+        "data_dimensions": [n_rows, len(columns)],
+        # generated code sees the standard dtypes, not the downcast ones the frame is stored with
+        "data_types_per_column": {p.name: standard_dtype(p.dtype).name for p in profiles},
+        "statistical_summary": {p.name: p.summary() for p in profiles if p.summary() is not None},
+        "missing_values_per_column": {p.name: p.missing for p in profiles},
+        "distinct_values_per_column": {p.name: p.distinct_count for p in profiles},
+        "top_values_per_column": {
+            p.name: dict(p.top_values.most_common(top_k)) for p in profiles if p.kind == "categorical"
+        },
+        "datetime_ranges": {
+            p.name: {"min": p.minimum, "max": p.maximum}
+            for p in profiles
+            if p.kind == "datetime" and p.minimum is not None
+        },
+    }
+    return _to_json_compatible(profile)
+
+
+def _to_json_compatible(value):
+    if isinstance(value, dict):
+        return {str(key): _to_json_compatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_compatible(item) for item in value]
+    return _to_python(value)
+
+
+def iter_chunks(df: pd.DataFrame, chunk_size: int):
+    for start in range(0, max(len(df), 1), chunk_size):
+        yield df.iloc[start:][:chunk_size]
+
+
+_profile_cache: "OrderedDict[tuple, Dict]" = OrderedDict()
+_profile_cache_lock = threading.Lock()
+PROFILE_CACHE_SIZE = 32
+
+
+def profile_dataframe(
+    df: pd.DataFrame,
+    fingerprint: Optional[str] = None,
+    chunk_size: int = 1_000_000,
+    sample_size: int = 10_000,
+    sketch_size: int = 1024,
+    top_k: int = 10,
+) -> Dict:
+    """Profile an in memory dataframe chunk by chunk, without copying it. Profiles are memoised
+    by the dataframe fingerprint, pass ``fingerprint`` if it has already been computed.
+    """
+    fingerprint = fingerprint or fingerprint_dataframe(df)
+    key = (fingerprint, sample_size, sketch_size, top_k)
+    with _profile_cache_lock:
+        if key in _profile_cache:
+            _profile_cache.move_to_end(key)
+            return _profile_cache[key]
+
+    profile = profile_chunks(iter_chunks(df, chunk_size), sample_size, sketch_size, top_k)
+
+    with _profile_cache_lock:
+        _profile_cache[key] = profile
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profile
+
+
+_key_cache: "OrderedDict[tuple, Optional[np.ndarray]]" = OrderedDict()
+_key_cache_lock = threading.Lock()
+KEY_CACHE_SIZE = 256
+
+
+def _key_kind(series: pd.Series) -> Optional[str]:
+    """Kind of values a join key column holds, None for columns which are not join keys."""
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_float_dtype(series):
+        return None
+    if pd.api.types.is_integer_dtype(series):
+        return "integer"
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return _key_kind(pd.Series(series.cat.categories))
+    if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+        return "string"
+    return None
+
+
+def _distinct_hashes(series: pd.Series, fingerprint: str, min_distinct: int) -> Optional[np.ndarray]:
+    """Sorted hashes of the distinct values of a column, memoised by the dataframe fingerprint."""
+    key = (fingerprint, series.name)
+    with _key_cache_lock:
+        if key in _key_cache:
+            _key_cache.move_to_end(key)
+            return _key_cache[key]
+
+    values = np.asarray(series.dropna().unique())
+    kind = _key_kind(series)
+    hashes = None
+    if len(values) >= min_distinct:
+        values = values.astype("int64") if kind == "integer" else values.astype(str).astype(object)
+        hashes = np.unique(pd.util.hash_array(values))
+
+    with _key_cache_lock:
+        _key_cache[key] = hashes
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return hashes
+
+
+def join_hints(
+    tables: Dict[str, pd.DataFrame],
+    fingerprints: Optional[Dict[str, str]] = None,
+    min_overlap: float = 0.5,
+    min_distinct: int = 3,
+    max_hints: int = 10,
+) -> List[Dict]:
+    """Column pairs of different tables which share values and so are likely join keys.
+
+    ``overlap`` is the share of the distinct values of the smaller column found in the other
+    one. A side is ``unique`` when no value repeats, joins where neither side is unique
+    multiply rows. Distinct values are hashed once per column and table fingerprint.
+    """
+    fingerprints = fingerprints or {name: fingerprint_dataframe(df) for name, df in tables.items()}
+    keys = {}
+    for name, df in tables.items():
+        for column in df.columns:
+            kind = _key_kind(df[column])
+            if kind is None:
+                continue
+            hashes = _distinct_hashes(df[column], fingerprints[name], min_distinct)
+            if hashes is not None:
+                unique = bool(len(hashes) == df[column].count())
+                keys[(name, column)] = (kind, hashes, unique)
+
+    hints = []
+    items = list(keys.items())
+    for i, ((left_table, left_column), (left_kind, left_hashes, left_unique)) in enumerate(items, start=1):
+        for (right_table, right_column), (right_kind, right_hashes, right_unique) in items[i:]:
+            if left_table == right_table or left_kind != right_kind:
+                continue
+            shared = len(np.intersect1d(left_hashes, right_hashes, assume_unique=True))
+            overlap = shared / min(len(left_hashes), len(right_hashes))
+            if overlap < min_overlap:
+                continue
+            hints.append(
+                {
+                    "left": f"{left_table}.{left_column}",
+                    "right": f"{right_table}.{right_column}",
+                    "overlap": round(overlap, 3),
+                    "left_unique": left_unique,
+                    "right_unique": right_unique,
+                    "same_name": str(left_column).lower() == str(right_column).lower(),
+                }
+            )
+    hints.sort(
+        key=lambda hint: (hint["overlap"], hint["same_name"], hint["left_unique"] or hint["right_unique"]), reverse=True
+    )
+    return hints[:max_hints]
@@ -1,6 +1,18 @@
+import difflib
+import functools
 import json
+import logging
+import math
+import re
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
+import streamlit as st
+
+from llm_plotting.dataset import standard_dtype
+from llm_plotting.profiler import join_hints, profile_dataframe
+
+Logger = logging.getLogger(st.__name__)
 
 
 def parse_requirements(requirments_file_path: str, names_only: bool = False) -> str:
@@ -21,16 +33,179 @@ def parse_requirements(requirments_file_path: str, names_only: bool = False) ->
     return result.rstrip(", ")
 
 
-def extract_metadata(df: pd.DataFrame, col_limit=150):
-    if df.shape[1] > col_limit:
-        raise ValueError(f"Dataframe exceeds col limit of {col_limit}")
+def extract_metadata(df: pd.DataFrame, exact_row_limit=100_000, fingerprint=None):
+    """Full metadata about the dataframe. Frames with more than ``exact_row_limit`` rows are
+    summarised by the streaming profiler with approximate quantiles instead of a full
+    ``describe()``. The agent prompt uses the budgeted ``encode_metadata`` instead.
+    """
+    if len(df) > exact_row_limit:
+        return json.dumps(profile_dataframe(df, fingerprint=fingerprint))
 
-    df = df.copy()
     metadata_dict = {
         "column_names": df.columns.tolist(),
         "data_dimensions": df.shape,
-        "data_types_per_column": df.dtypes.apply(lambda x: x.name).to_dict(),
+        "data_types_per_column": df.dtypes.apply(lambda x: standard_dtype(x).name).to_dict(),
         "statistical_summary": df.describe().to_dict(),
         "missing_values_per_column": df.isnull().sum().to_dict(),
     }
-    return json.dumps(metadata_dict)
+    return json.dumps(metadata_dict, default=str)
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        Logger.warning(f"Falling back to estimating token counts, could not load tiktoken encoding: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _token_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text))
+
+
+def _round(value, digits: int = 4):
+    if isinstance(value, float) and math.isfinite(value) and value != 0:
+        return round(value, max(digits - 1 - int(math.floor(math.log10(abs(value)))), 0))
+    return value
+
+
+def _words(text: str) -> List[str]:
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def _column_entry(profile: Dict, column: str, top_k: int = 5, max_value_length: int = 30) -> Dict:
+    entry = {"type": profile["data_types_per_column"][column]}
+    if profile["missing_values_per_column"].get(column):
+        entry["missing"] = profile["missing_values_per_column"][column]
+    entry["distinct"] = profile["distinct_values_per_column"][column]
+
+    summary = profile["statistical_summary"].get(column)
+    if summary is not None:
+        entry["range"] = [_round(summary["min"]), _round(summary["max"])]
+        entry["mean"] = _round(summary["mean"])
+        entry["median"] = _round(summary["50%"])
+    if column in profile["datetime_ranges"]:
+        entry["range"] = [profile["datetime_ranges"][column]["min"], profile["datetime_ranges"][column]["max"]]
+    if column in profile["top_values_per_column"]:
+        entry["top"] = [value[:max_value_length] for value in list(profile["top_values_per_column"][column])[:top_k]]
+    return entry
+
+
+def rank_columns(profile: Dict, user_input: str) -> List[str]:
+    """Columns ordered by lexical relevance to the user input, ties keep the dataframe order.
+    A column scores for being named in full, for each of its words in the input, for close
+    spellings of its words and for top values that appear in the input.
+    """
+    input_words = _words(user_input)
+    input_text = " ".join(input_words)
+    input_word_set = set(input_words)
+
+    def score(column: str) -> float:
+        column_words = [word for word in _words(column) if len(word) > 1]
+        value = 3.0 if column_words and f" {' '.join(column_words)} " in f" {input_text} " else 0.0
+        for word in column_words:
+            if word in input_word_set:
+                value += 1.0
+            elif len(word) > 3 and difflib.get_close_matches(word, input_words, n=1, cutoff=0.85):
+                value += 0.5
+        top_values = profile["top_values_per_column"].get(column, {})
+        if any(" ".join(_words(top_value)) in input_text for top_value in top_values if _words(top_value)):
+            value += 1.0
+        return value
+
+    columns = profile["column_names"]
+    scores = {column: score(column) for column in columns}
+    return sorted(columns, key=lambda column: -scores[column])
+
+
+def encode_metadata(
+    df: pd.DataFrame,
+    user_input: str = "",
+    token_budget: int = 2000,
+    fingerprint: Optional[str] = None,
+    details_share: float = 0.6,
+) -> Tuple[str, Dict[str, int]]:
+    """Compact metadata for the agent prompt which fits ``token_budget``. Columns are ranked by
+    relevance to ``user_input`` and the most relevant get full details within ``details_share``
+    of the budget, the rest are listed by type while they fit and counted after that. Returns
+    the JSON along with prompt size metrics comparing it to the full metadata.
+    """
+    profile = profile_dataframe(df, fingerprint=fingerprint)
+    n_rows, n_columns = profile["data_dimensions"]
+
+    metadata = {"rows": n_rows, "columns": n_columns, "column_details": {}}
+    used = count_tokens(_dumps(metadata)) + 20
+    ranked = rank_columns(profile, user_input)
+
+    remaining = []
+    for column in ranked:
+        entry = _column_entry(profile, column)
+        cost = count_tokens(_dumps({column: entry}))
+        if used + cost <= token_budget * details_share and not remaining:
+            metadata["column_details"][column] = entry
+            used += cost
+        else:
+            remaining.append(column)
+
+    other_columns = {}
+    for column in remaining:
+        cost = count_tokens(_dumps({column: profile["data_types_per_column"][column]}))
+        if used + cost > token_budget:
+            break
+        other_columns[column] = profile["data_types_per_column"][column]
+        used += cost
+    if other_columns:
+        metadata["other_columns"] = other_columns
+    if len(remaining) > len(other_columns):
+        metadata["omitted_columns"] = len(remaining) - len(other_columns)
+
+    metadata_json = _dumps(metadata)
+    metrics = {
+        "full_metadata_tokens": count_tokens(json.dumps(profile, default=str)),
+        "metadata_tokens": count_tokens(metadata_json),
+        "detailed_columns": len(metadata["column_details"]),
+        "listed_columns": len(other_columns),
+        "omitted_columns": metadata.get("omitted_columns", 0),
+    }
+    Logger.info(f"Prompt metadata size: {metrics}")
+    return metadata_json, metrics
+
+
+def encode_tables_metadata(
+    tables: Dict[str, pd.DataFrame],
+    user_input: str = "",
+    token_budget: int = 2000,
+    fingerprints: Optional[Dict[str, str]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """Compact metadata of several tables for the agent prompt which fits ``token_budget``.
+    Likely join keys are listed first, the rest of the budget is split evenly between the
+    tables, each encoded like ``encode_metadata``. Metrics are summed over the tables.
+    """
+    fingerprints = fingerprints or {}
+    hints = join_hints(tables, fingerprints=fingerprints or None)
+    hints_tokens = count_tokens(_dumps(hints))
+    table_budget = max((token_budget - hints_tokens) // max(len(tables), 1), 100)
+
+    metadata = {"tables": {}, "join_hints": hints}
+    metrics: Dict[str, int] = {}
+    for name, df in tables.items():
+        table_json, table_metrics = encode_metadata(df, user_input, table_budget, fingerprint=fingerprints.get(name))
+        metadata["tables"][name] = json.loads(table_json)
+        for metric, value in table_metrics.items():
+            metrics[metric] = metrics.get(metric, 0) + value
+
+    metadata_json = _dumps(metadata)
+    metrics["metadata_tokens"] = count_tokens(metadata_json)
+    metrics["join_hints"] = len(hints)
+    return metadata_json, metrics
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, separators=(",", ":"), default=str)
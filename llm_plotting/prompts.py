@@ -3,13 +3,14 @@ from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from llm_plotting.prompt_helper import parse_requirements
 
 IMAGE_SAVE_PATH = "figure.png"
+FIGURE_SAVE_PATH = "figure.json"
 IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE = "The plot is legible"
 AVAILABLE_LIBRARIES = parse_requirements("llm_plotting/e2b/requirments.txt", names_only=True)
 
 CODE_GENERATION_AGENT_SYSTEM_TEMPLATE = f"""
 You are a powerful code generation assistant who specializes in generating code \
 to visualize graphs. You can also generate code to answer questions about user \
-DataFrames (always stored under df.csv). When answering questions about the data, \
+DataFrames (always stored under {{dataframe_filename}}). When answering questions about the data, \
 you must always send your answer in a print statement.
 
 Whenever you generate any type of code, you must also validate the code. However, \
@@ -24,7 +25,8 @@ validation tool before returning code in this case.
 
 Here are some assumptions you should always follow:
 - You should always plot using Python and with the Plotly library.
-- The DataFrame is stored under df.csv. Please load it in with `df = pd.read_csv('df.csv')`.
+- The DataFrame is stored under {{dataframe_filename}}. \
+Please load it in with `{{dataframe_load_code}}`.{{tables_instructions}}
 - Provide a brief description of what the plot is about in the context of the data.
 - You have access to the following libraries: {AVAILABLE_LIBRARIES }.
 
@@ -36,6 +38,12 @@ Here is some metadata about the data:
 """
 
 
+TABLES_INSTRUCTIONS = """
+- There are several DataFrames, one per table in the metadata. Only load the tables the question needs.
+- Join tables on the columns listed in join_hints, check with `.is_unique` whether a join key is unique \
+before merging, aggregate a table before joining it when neither key is unique, and never cross join."""
+
+
 VALIDATION_LLM_PROMPT_SYSTEM_TEMPLATE = f"""
 You are a highly skilled validation agent who will be examining plots generated from Python's Plotly library. \
 You will be given the code along with the image and a description of the plot in context of the data.
@@ -62,10 +70,10 @@ CODE_GENERATION_AGENT_PROMPT = ChatPromptTemplate.from_messages(
         ("user", "{user_input}"),
         MessagesPlaceholder(variable_name="agent_scratchpad"),
     ]
-)
+).partial(tables_instructions="")
 
 
-def generate_validation_llm_messages(base64_string: str, description: str, code: str):
+def generate_validation_llm_messages(base64_string: str, description: str, code: str, mime_type: str = "image/png"):
     return [
         {
             "role": "system",
@@ -84,7 +92,7 @@ def generate_validation_llm_messages(base64_string: str, description: str, code:
                 },
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_string}"},
+                    "image_url": {"url": f"data:{mime_type};base64,{base64_string}"},
                 },
             ],
         },
@@ -0,0 +1,53 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import plotly.io as pio
+import streamlit as st
+
+Logger = logging.getLogger(st.__name__)
+
+PLOTLY_JSON_MIME_TYPE = "application/vnd.plotly.v1+json"
+
+
+class FigureRenderer:
+    """Rasterises Plotly figure JSON with kaleido, outside the sandbox, for the callers that
+    need pixels. Time spent in kaleido is accumulated so it can be reported separately from
+    code execution and validation.
+    """
+
+    def __init__(
+        self,
+        image_format: str = "png",
+        width: int = 800,
+        height: int = 600,
+        scale: Optional[float] = None,
+    ):
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.renders = 0
+        self.render_seconds = 0.0
+
+        self._lock = threading.Lock()
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{'jpeg' if self.image_format == 'jpg' else self.image_format}"
+
+    def stats(self) -> Dict[str, float]:
+        return {"renders": self.renders, "render_seconds": round(self.render_seconds, 4)}
+
+    def render(self, figure_json: bytes) -> bytes:
+        start = time.perf_counter()
+        figure = pio.from_json(figure_json.decode("utf-8"), skip_invalid=True)
+        image = pio.to_image(figure, format=self.image_format, width=self.width, height=self.height, scale=self.scale)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.renders += 1
+            self.render_seconds += elapsed
+        Logger.info(f"Rasterised figure in {elapsed:.3f}s: {self.stats()}")
+        return image
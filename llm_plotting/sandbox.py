@@ -0,0 +1,400 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, Callable, Dict, Iterator, List, Optional
+
+import streamlit as st
+from e2b import Sandbox
+from pydantic import BaseModel
+
+from llm_plotting.settings import Settings
+from llm_plotting.tracing import get_tracer
+
+Logger = logging.getLogger(st.__name__)
+
+SANDBOX_HOME = "/home/user"
+SANDBOX_CODE_PATH = "/index.py"
+# directories besides the working directory which code may leave files in for the next lessee
+SANDBOX_SCRATCH_DIRS = ("/tmp", "/var/tmp", "/dev/shm")
+# helper modules which the sandbox image has on its python path, see e2b/e2b.Dockerfile
+SANDBOX_HELPERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "e2b")
+# the environment variables generated code running on this machine keeps, the app's API keys
+# and other settings are left out like they are in an e2b sandbox
+LOCAL_CODE_ENVIRONMENT = ("PATH", "HOME", "LANG", "LC_ALL", "LC_CTYPE", "TMPDIR", "TZ", "SYSTEMROOT")
+
+
+def local_code_environment() -> Dict[str, str]:
+    """Environment for generated code run in a local process."""
+    return {name: os.environ[name] for name in LOCAL_CODE_ENVIRONMENT if name in os.environ}
+
+
+class LocalProcessOutput(BaseModel):
+    stdout: str = ""
+    stderr: str = ""
+    exit_code: Optional[int] = None
+
+
+class LocalSandbox:
+    """Offline stand-in for an e2b ``Sandbox`` which maps the sandbox filesystem onto a
+    temporary directory and runs commands as local subprocesses. Only the subset of the
+    e2b API used by this package is implemented.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.root = tempfile.mkdtemp(prefix="llm-plotting-sandbox-")
+        for path in (SANDBOX_HOME, *SANDBOX_SCRATCH_DIRS):
+            os.makedirs(self._local_path(path), exist_ok=True)
+        self.filesystem = _LocalFilesystem(self)
+        self.process = _LocalProcess(self)
+        self.is_open = True
+
+    def _local_path(self, path: str) -> str:
+        if not path.startswith("/"):
+            path = f"{SANDBOX_HOME}/{path}"
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def upload_file(self, file: IO, timeout: Optional[float] = None) -> str:
+        remote_path = f"{SANDBOX_HOME}/{os.path.basename(file.name)}"
+        self.filesystem.write_bytes(remote_path, _read_as_bytes(file))
+        return remote_path
+
+    def download_file(self, remote_path: str, timeout: Optional[float] = None) -> bytes:
+        return self.filesystem.read_bytes(remote_path)
+
+    def close(self):
+        self.is_open = False
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _LocalFilesystem:
+    def __init__(self, sandbox: LocalSandbox):
+        self.sandbox = sandbox
+
+    def write(self, path: str, content: str, timeout: Optional[float] = None):
+        self.write_bytes(path, content.encode("utf-8"))
+
+    def write_bytes(self, path: str, content: bytes, timeout: Optional[float] = None):
+        local_path = self.sandbox._local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as file:
+            file.write(content)
+
+    def read(self, path: str, timeout: Optional[float] = None) -> str:
+        return self.read_bytes(path).decode("utf-8")
+
+    def read_bytes(self, path: str, timeout: Optional[float] = None) -> bytes:
+        with open(self.sandbox._local_path(path), "rb") as file:
+            return file.read()
+
+    def remove(self, path: str, timeout: Optional[float] = None):
+        os.remove(self.sandbox._local_path(path))
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self.sandbox._local_path(path))
+
+
+class _LocalProcess:
+    def __init__(self, sandbox: LocalSandbox):
+        self.sandbox = sandbox
+
+    def start_and_wait(self, cmd: str, timeout: Optional[float] = 60, **kwargs) -> LocalProcessOutput:
+        if not self.sandbox.is_open:
+            raise RuntimeError("Sandbox is closed")
+
+        args = [self.sandbox._local_path(arg) if arg.startswith("/") else arg for arg in shlex.split(cmd)]
+        if args and args[0] in ("python", "python3"):
+            args[0] = sys.executable
+
+        env = local_code_environment()
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [SANDBOX_HELPERS_DIR, os.environ.get("PYTHONPATH")]))
+        completed = subprocess.run(
+            args,
+            cwd=self.sandbox._local_path(SANDBOX_HOME),
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        return LocalProcessOutput(
+            stdout=completed.stdout.rstrip("\n"),
+            stderr=completed.stderr.rstrip("\n"),
+            exit_code=completed.returncode,
+        )
+
+
+def _read_as_bytes(file: IO) -> bytes:
+    content = file.read()
+    return content.encode("utf-8") if isinstance(content, str) else content
+
+
+class PooledSandbox:
+    def __init__(self, sandbox: Sandbox):
+        self.sandbox = sandbox
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.last_health_check = self.created_at
+        self.uploaded_files: Dict[str, str] = {}
+        self.checksums: Dict[str, str] = {}
+        # the user code runs as, looked up on the first reset
+        self.user: Optional[str] = None
+
+    def forget(self, filename: str):
+        self.uploaded_files.pop(filename, None)
+        self.checksums.pop(filename, None)
+
+
+class SandboxPool:
+    """Keeps a number of booted sandboxes warm so that tool calls do not pay sandbox start up
+    and teardown on every execution.
+
+    Sandboxes are handed out with ``lease()`` and reset before being returned to the pool. The
+    reset removes the executed code, everything in the working directory, hidden files included,
+    apart from the uploaded data files whose checksum still matches the upload, and the files
+    code left in the scratch directories such as /tmp. The pool remembers the
+    fingerprint of every file uploaded into each sandbox so callers can skip re-uploading data
+    the sandbox already holds. As the pool is shared by every session, a lease names the files
+    the lessee works with, sandboxes already holding them are preferred and any other data is
+    removed before the sandbox is handed out.
+    Idle sandboxes are closed after ``idle_timeout`` seconds and sandboxes that have been idle
+    for longer than ``health_check_interval`` are checked before being leased again.
+    """
+
+    def __init__(
+        self,
+        sandbox_factory: Callable[[], Sandbox],
+        size: int = 2,
+        idle_timeout: float = 300.0,
+        health_check_interval: float = 60.0,
+    ):
+        self.sandbox_factory = sandbox_factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle: List[PooledSandbox] = []
+        self._leased = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @property
+    def leased_count(self) -> int:
+        return len(self._leased)
+
+    def warm(self, block: bool = False):
+        """Boot sandboxes until ``size`` are idle in the pool."""
+        missing = self.size - len(self._idle) - len(self._leased)
+        threads = [threading.Thread(target=self._boot_into_pool, daemon=True) for _ in range(max(missing, 0))]
+        for thread in threads:
+            thread.start()
+        if block:
+            for thread in threads:
+                thread.join()
+
+    def acquire(self, files: Optional[Dict[str, str]] = None) -> Sandbox:
+        """A sandbox holding no data files but those of ``files``, a mapping of file names to
+        fingerprints, preferably one which already holds some of them.
+        """
+        if self._closed:
+            raise RuntimeError("Sandbox pool is closed")
+
+        files = files or {}
+        self.evict_idle()
+        while True:
+            with self._lock:
+                pooled = self._pop_idle(files)
+            if pooled is None:
+                with get_tracer().span("sandbox.boot"):
+                    pooled = PooledSandbox(self.sandbox_factory())
+                break
+            if self._is_healthy(pooled) and self._remove_other_files(pooled, files):
+                break
+            self._close(pooled)
+
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            self._leased[id(pooled.sandbox)] = pooled
+        return pooled.sandbox
+
+    def release(self, sandbox: Sandbox, discard: bool = False):
+        with self._lock:
+            pooled = self._leased.pop(id(sandbox), None)
+        if pooled is None:
+            raise ValueError("Sandbox was not leased from this pool")
+
+        if discard or self._closed or not self._reset(pooled):
+            self._close(pooled)
+            return
+
+        pooled.last_used = time.monotonic()
+        pooled.last_health_check = pooled.last_used
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(pooled)
+                return
+        self._close(pooled)
+
+    @contextmanager
+    def lease(self, files: Optional[Dict[str, str]] = None) -> Iterator[Sandbox]:
+        sandbox = self.acquire(files)
+        try:
+            yield sandbox
+        finally:
+            self.release(sandbox)
+
+    def uploaded_fingerprint(self, sandbox: Sandbox, filename: str) -> Optional[str]:
+        return self._leased[id(sandbox)].uploaded_files.get(filename)
+
+    def mark_uploaded(self, sandbox: Sandbox, filename: str, fingerprint: str, checksum: str):
+        """Record an upload along with the sha256 checksum of the uploaded bytes."""
+        pooled = self._leased[id(sandbox)]
+        pooled.uploaded_files[filename] = fingerprint
+        pooled.checksums[filename] = checksum
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [pooled for pooled in self._idle if now - pooled.last_used > self.idle_timeout]
+            self._idle = [pooled for pooled in self._idle if pooled not in expired]
+        for pooled in expired:
+            Logger.info("Evicting idle sandbox")
+            self._close(pooled)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._close(pooled)
+
+    def _boot_into_pool(self):
+        try:
+            pooled = PooledSandbox(self.sandbox_factory())
+        except Exception as e:
+            Logger.error(f"Failed to boot sandbox: {e}")
+            return
+        with self._lock:
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append(pooled)
+                return
+        self._close(pooled)
+
+    def _is_healthy(self, pooled: PooledSandbox) -> bool:
+        if not getattr(pooled.sandbox, "is_open", True):
+            return False
+        if time.monotonic() - pooled.last_health_check < self.health_check_interval:
+            return True
+        try:
+            output = pooled.sandbox.process.start_and_wait(cmd="true")
+        except Exception as e:
+            Logger.warning(f"Sandbox health check failed: {e}")
+            return False
+        pooled.last_health_check = time.monotonic()
+        return output.exit_code == 0
+
+    def _pop_idle(self, files: Dict[str, str]) -> Optional[PooledSandbox]:
+        # the most recently released sandbox holding nothing but the lessee's files, else the most recent one
+        for i in reversed(range(len(self._idle))):
+            uploaded_files = self._idle[i].uploaded_files.items()
+            if uploaded_files and uploaded_files <= files.items():
+                return self._idle.pop(i)
+        return self._idle.pop() if self._idle else None
+
+    def _remove_other_files(self, pooled: PooledSandbox, files: Dict[str, str]) -> bool:
+        others = [name for name, fingerprint in pooled.uploaded_files.items() if files.get(name) != fingerprint]
+        if not others:
+            return True
+        paths = " ".join(shlex.quote(f"{SANDBOX_HOME}/{name}") for name in others)
+        if self._run(pooled, f"rm -f {paths}") is None:
+            return False
+        for name in others:
+            pooled.forget(name)
+        return True
+
+    def _reset(self, pooled: PooledSandbox) -> bool:
+        """Remove the code, everything in the working directory but the intact uploads, hidden
+        files included, and whatever the sandbox user left in the scratch directories. Uploads
+        the executed code changed are removed as well and are uploaded again when needed.
+        """
+        if pooled.user is None:
+            output = self._run(pooled, "id -un")
+            if output is None:
+                return False
+            pooled.user = output.stdout.strip()
+
+        if pooled.uploaded_files:
+            names = sorted(pooled.uploaded_files)
+            paths = " ".join(shlex.quote(f"{SANDBOX_HOME}/{name}") for name in names)
+            output = self._run(pooled, f"sha256sum {paths}", check=False)
+            if output is None:
+                return False
+            # lines are "<checksum>  <path>", files which are gone are left out
+            lines = [line.split(maxsplit=1) for line in output.stdout.splitlines()]
+            checksums = {os.path.basename(line[1]): line[0] for line in lines if len(line) == 2}
+            for name in names:
+                if checksums.get(name) != pooled.checksums.get(name):
+                    pooled.forget(name)
+
+        kept = " ".join(f"! -path {shlex.quote(f'{SANDBOX_HOME}/{name}')}" for name in pooled.uploaded_files)
+        scratch = " -o ".join(f"-path '{path}/*'" for path in SANDBOX_SCRATCH_DIRS)
+        command = (
+            f"find / {SANDBOX_HOME} {' '.join(SANDBOX_SCRATCH_DIRS)} -mindepth 1 -maxdepth 1 \\( "
+            f"-path {SANDBOX_CODE_PATH} -o -path '{SANDBOX_HOME}/*' {kept} "
+            f"-o -user {shlex.quote(pooled.user)} \\( {scratch} \\) \\) -exec rm -rf {{}} +"
+        )
+        return self._run(pooled, command) is not None
+
+    @staticmethod
+    def _run(pooled: PooledSandbox, cmd: str, check: bool = True):
+        """The output of the command, None when it fails."""
+        try:
+            output = pooled.sandbox.process.start_and_wait(cmd=cmd)
+        except Exception as e:
+            Logger.warning(f"Sandbox reset failed: {e}")
+            return None
+        if check and output.exit_code != 0:
+            Logger.warning(f"Sandbox reset failed: {output.stderr}")
+            return None
+        return output
+
+    @staticmethod
+    def _close(pooled: PooledSandbox):
+        try:
+            pooled.sandbox.close()
+        except Exception as e:
+            Logger.warning(f"Failed to close sandbox: {e}")
+
+
+_sandbox_pool: Optional[SandboxPool] = None
+_sandbox_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool(settings: Settings) -> SandboxPool:
+    """Process wide pool shared by every session."""
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None:
+            _sandbox_pool = SandboxPool(
+                sandbox_factory=lambda: Sandbox(template=settings.sandbox_template, api_key=settings.e2b_api_key),
+                size=settings.sandbox_pool_size,
+                idle_timeout=settings.sandbox_idle_timeout,
+                health_check_interval=settings.sandbox_health_check_interval,
+            )
+            _sandbox_pool.warm()
+    return _sandbox_pool
@@ -0,0 +1,386 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Mapping, Optional
+
+import streamlit as st
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from llm_plotting.settings import Settings
+
+Logger = logging.getLogger(st.__name__)
+
+
+class SchedulerFullError(Exception):
+    pass
+
+
+def _hand_over(limit: "ConcurrencyLimit", future: asyncio.Future):
+    if future.cancelled():
+        # the waiter gave up before the slot reached it, pass the slot on
+        limit.release()
+    else:
+        future.set_result(None)
+
+
+class ConcurrencyLimit:
+    """Caps how many holders run at once across threads and event loops. Waiters are served
+    first come first served and a released slot is handed straight to the next waiter.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: Deque = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                loop, future = self._waiters.popleft()
+                loop.call_soon_threadsafe(_hand_over, self, future)
+                return
+            self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class _Job:
+    def __init__(self, session_id: str, factory: Callable[[], Awaitable]):
+        self.session_id = session_id
+        self.factory = factory
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.task: Optional[asyncio.Task] = None
+
+
+_STREAM_END = object()
+
+
+class RequestScheduler:
+    """Runs the requests of every session on one background event loop.
+
+    Each session has its own queue and runs one request at a time, in order. Sessions take
+    turns when request slots free up, so a session with a backlog cannot starve the others.
+    ``executions`` and ``llm_calls`` cap sandbox executions and LLM calls across all
+    sessions. Queues are bounded, ``submit`` raises ``SchedulerFullError`` instead of
+    queueing more. Work of sessions for which ``session_is_active`` returns False is
+    cancelled.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_requests: int = 8,
+        max_concurrent_executions: int = 4,
+        max_concurrent_llm_calls: int = 8,
+        max_queued_per_session: int = 2,
+        max_queued: int = 64,
+        session_check_interval: float = 5.0,
+        session_is_active: Optional[Callable[[str], bool]] = None,
+    ):
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_queued_per_session = max_queued_per_session
+        self.max_queued = max_queued
+        self.session_check_interval = session_check_interval
+        self.session_is_active = session_is_active
+        self.executions = ConcurrencyLimit(max_concurrent_executions)
+        self.llm_calls = ConcurrencyLimit(max_concurrent_llm_calls)
+        self.cancelled_jobs = 0
+
+        self._queues: Dict[str, Deque[_Job]] = {}
+        self._ready: Deque[str] = deque()
+        self._running: Dict[str, _Job] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session_checks: Optional[asyncio.Task] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="request-scheduler", daemon=True).start()
+                if self.session_check_interval > 0:
+                    self._loop.call_soon_threadsafe(self._start_session_checks)
+            return self._loop
+
+    def submit(self, session_id: str, factory: Callable[[], Awaitable]) -> concurrent.futures.Future:
+        """Queue ``factory()`` to run on the scheduler loop once it is the session's turn."""
+        loop = self.loop
+        job = _Job(session_id, factory)
+        with self._lock:
+            session_queue = self._queues.setdefault(session_id, deque())
+            if len(session_queue) >= self.max_queued_per_session:
+                raise SchedulerFullError("You already have requests waiting, wait for them to finish.")
+            if self._queued() >= self.max_queued:
+                raise SchedulerFullError("The service is busy, try again shortly.")
+            session_queue.append(job)
+            if len(session_queue) == 1 and session_id not in self._running:
+                self._ready.append(session_id)
+        loop.call_soon_threadsafe(self._dispatch)
+        return job.future
+
+    def stream(self, session_id: str, factory: Callable[[], AsyncIterator]) -> Iterator:
+        """Iterate the async iterator ``factory()`` on the scheduler loop from a regular thread,
+        e.g. the Streamlit script thread. Leaving the loop early cancels the request.
+        """
+        items: queue.Queue = queue.Queue()
+
+        async def produce():
+            async for item in factory():
+                items.put(item)
+
+        future = self.submit(session_id, produce)
+        # also ends the stream of requests which are cancelled before they start
+        future.add_done_callback(lambda _: items.put(_STREAM_END))
+        try:
+            while (item := items.get()) is not _STREAM_END:
+                yield item
+            future.result()
+        finally:
+            if not future.done():
+                self.cancel(future)
+
+    async def astream(self, session_id: str, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """``stream`` for callers on another event loop, e.g. the HTTP API. Closing the iterator
+        early, or cancelling the task iterating it, cancels the request.
+        """
+        caller_loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+
+        def put(item):
+            try:
+                caller_loop.call_soon_threadsafe(items.put_nowait, item)
+            except RuntimeError:
+                # the caller's loop has closed, nobody is listening any more
+                pass
+
+        async def produce():
+            async for item in factory():
+                put(item)
+
+        future = self.submit(session_id, produce)
+        future.add_done_callback(lambda _: put(_STREAM_END))
+        try:
+            while (item := await items.get()) is not _STREAM_END:
+                yield item
+            future.result()
+        finally:
+            if not future.done():
+                self.cancel(future)
+
+    def cancel(self, future: concurrent.futures.Future):
+        self.loop.call_soon_threadsafe(self._cancel_jobs, lambda job: job.future is future)
+
+    def cancel_session(self, session_id: str):
+        self.loop.call_soon_threadsafe(self._cancel_jobs, lambda job: job.session_id == session_id)
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return self._queued()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "queued": self._queued(),
+                "running": len(self._running),
+                "sessions": len(set(self._running) | {sid for sid, q in self._queues.items() if q}),
+                "executions_running": self.executions.active,
+                "executions_waiting": self.executions.waiting,
+                "llm_calls_running": self.llm_calls.active,
+                "llm_calls_waiting": self.llm_calls.waiting,
+                "cancelled": self.cancelled_jobs,
+            }
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            self._cancel_jobs_threadsafe(loop)
+            loop.call_soon_threadsafe(loop.stop)
+
+    def _cancel_jobs_threadsafe(self, loop: asyncio.AbstractEventLoop):
+        done = threading.Event()
+
+        def cancel_all():
+            self._cancel_jobs(lambda job: True)
+            if self._session_checks is not None:
+                self._session_checks.cancel()
+            done.set()
+
+        loop.call_soon_threadsafe(cancel_all)
+        done.wait(timeout=5)
+
+    def _queued(self) -> int:
+        return sum(len(session_queue) for session_queue in self._queues.values())
+
+    def _dispatch(self):
+        with self._lock:
+            while self._ready and len(self._running) < self.max_concurrent_requests:
+                session_id = self._ready.popleft()
+                job = self._queues[session_id].popleft()
+                self._running[session_id] = job
+                job.task = asyncio.get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job: _Job):
+        if not job.future.set_running_or_notify_cancel():
+            self._finish(job)
+            return
+        try:
+            job.future.set_result(await job.factory())
+        except asyncio.CancelledError:
+            job.future.set_exception(concurrent.futures.CancelledError())
+        except BaseException as e:
+            job.future.set_exception(e)
+        finally:
+            self._finish(job)
+
+    def _finish(self, job: _Job):
+        with self._lock:
+            self._running.pop(job.session_id, None)
+            session_queue = self._queues.get(job.session_id)
+            if session_queue:
+                self._ready.append(job.session_id)
+            elif session_queue is not None:
+                del self._queues[job.session_id]
+        self._dispatch()
+
+    def _cancel_jobs(self, predicate: Callable[[_Job], bool]):
+        with self._lock:
+            queued = [job for q in self._queues.values() for job in q if predicate(job)]
+            running = [job for job in self._running.values() if predicate(job)]
+            for session_id, session_queue in list(self._queues.items()):
+                self._queues[session_id] = deque(job for job in session_queue if not predicate(job))
+                if not self._queues[session_id]:
+                    del self._queues[session_id]
+            self._ready = deque(sid for sid in self._ready if sid in self._queues)
+            self.cancelled_jobs += len(queued) + len(running)
+
+        for job in queued:
+            job.future.cancel()
+        for job in running:
+            job.task.cancel()
+
+    def _start_session_checks(self):
+        self._session_checks = asyncio.get_running_loop().create_task(self._check_sessions())
+
+    async def _check_sessions(self):
+        while True:
+            await asyncio.sleep(self.session_check_interval)
+            if self.session_is_active is None:
+                continue
+            with self._lock:
+                session_ids = set(self._running) | set(self._queues)
+            for session_id in session_ids:
+                if not self.session_is_active(session_id):
+                    Logger.info(f"Cancelling the requests of session {session_id}, it is no longer active")
+                    self._cancel_jobs(lambda job, session_id=session_id: job.session_id == session_id)
+
+
+class LimitedChatModel(BaseChatModel):
+    """Chat model which waits for a slot of ``limit`` before each asynchronous call of ``llm``."""
+
+    llm: BaseChatModel
+    limit: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return self.llm._llm_type
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return self.llm._identifying_params
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.llm._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        async with self.limit.slot():
+            return await self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async with self.limit.slot():
+            if type(self.llm)._astream is BaseChatModel._astream:
+                result = await self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                for generation in result.generations:
+                    message = generation.message
+                    chunk = AIMessageChunk(content=message.content, additional_kwargs=message.additional_kwargs)
+                    yield ChatGenerationChunk(message=chunk)
+                return
+            async for chunk in self.llm._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(settings: Settings) -> RequestScheduler:
+    """Process wide scheduler shared by every session."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(
+                max_concurrent_requests=settings.scheduler_max_concurrent_requests,
+                max_concurrent_executions=settings.scheduler_max_concurrent_executions,
+                max_concurrent_llm_calls=settings.scheduler_max_concurrent_llm_calls,
+                max_queued_per_session=settings.scheduler_max_queued_per_session,
+                max_queued=settings.scheduler_max_queued,
+                session_check_interval=settings.scheduler_session_check_interval,
+            )
+    return _scheduler
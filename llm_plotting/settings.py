@@ -1,3 +1,5 @@
+from typing import Literal, Optional
+
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
@@ -5,6 +7,94 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     openai_api_key: str
     e2b_api_key: str
+    openai_api_base: str = "https://api.openai.com/v1"
+
+    http_max_connections: int = 20
+    http_max_keepalive_connections: int = 10
+    http_timeout: float = 120.0
+
+    execution_backend: Literal["e2b", "local"] = "e2b"
+
+    sandbox_template: str = "my-agent-sandbox-test"
+    sandbox_pool_size: int = 2
+    sandbox_idle_timeout: float = 300.0
+    sandbox_health_check_interval: float = 60.0
+
+    local_executor_workers: int = 2
+    local_executor_cpu_time_limit: Optional[int] = 60
+    local_executor_memory_limit_mb: Optional[int] = 2048
+    local_executor_timeout: float = 120.0
+
+    # read-only pandas code answering questions runs in a forked child of the app process
+    # instead of the execution backend, code off the whitelist still goes to the backend
+    fast_path_enabled: bool = True
+    fast_path_cpu_time_limit: Optional[int] = 5
+    fast_path_memory_limit_mb: Optional[int] = 512
+    fast_path_timeout: float = 10.0
+
+    execution_cache_enabled: bool = True
+    # bounds the results in memory and, separately, the files in execution_cache_dir
+    execution_cache_max_mb: int = 256
+    execution_cache_dir: Optional[str] = None
+
+    validation_cache_enabled: bool = True
+    validation_cache_max_entries: int = 512
+    validation_cache_ttl: float = 3600.0
+    validation_cache_max_distance: int = 4
+
+    # figures kept per session for display, the size figures are rasterised at for validation
+    # and the size images are downscaled to before they are sent to the vision model
+    image_store_max_images: int = 20
+    image_store_max_mb: int = 50
+    validation_image_width: int = 800
+    validation_image_height: int = 600
+    validation_image_max_size: int = 1024
+
+    # whole answers to questions asked again about the same dataframe, replayed instead of
+    # running the agent when the session has no chat history yet. With verify on, the cached
+    # code is executed once more before it is replayed.
+    answer_cache_enabled: bool = True
+    answer_cache_max_entries: int = 256
+    answer_cache_max_mb: int = 128
+    answer_cache_verify: bool = False
+
+    # static checks of generated code before it is sent to the sandbox
+    code_checks_enabled: bool = True
+
+    # local legibility checks of the figure JSON, clean figures skip the vision model when
+    # auto accept is on
+    legibility_checks_enabled: bool = True
+    legibility_auto_accept: bool = False
+
+    # oversized traces are reduced in the sandbox before the figure is saved
+    plot_prep_enabled: bool = True
+    plot_prep_max_line_points: int = 5000
+    plot_prep_max_scatter_points: int = 20000
+    plot_prep_max_categories: int = 30
+
+    # tokens the dataframe metadata may take up in the agent prompt
+    metadata_token_budget: int = 2000
+    # tokens earlier turns of the conversation may take up in the agent prompt
+    memory_token_budget: int = 1500
+
+    # spans of every request are exported to a JSON lines file or replayed through an
+    # OpenTelemetry tracer, the latest request of each session is always kept for display
+    tracing_exporter: Optional[Literal["jsonl", "otel"]] = None
+    tracing_jsonl_path: str = "traces/spans.jsonl"
+
+    # process wide limits on concurrent requests, sandbox executions and LLM calls, and how
+    # many requests may wait. Work of sessions which have gone away is cancelled.
+    scheduler_max_concurrent_requests: int = 8
+    scheduler_max_concurrent_executions: int = 4
+    scheduler_max_concurrent_llm_calls: int = 8
+    scheduler_max_queued_per_session: int = 2
+    scheduler_max_queued: int = 64
+    scheduler_session_check_interval: float = 5.0
+
+    # the HTTP API stores uploaded CSVs under their content hash, point every replica at the
+    # same shared directory so any of them can answer questions about any upload
+    api_dataset_dir: str = "datasets"
+    api_max_upload_mb: int = 200
 
     class Config:
         env_file = ".env"
@@ -15,3 +105,12 @@ class AgentSettings(BaseModel):
     max_iterations: int = 5
     code_generation_llm_temperature: float = 0
     image_validation_llm_temperature: float = 0
+    image_format: Optional[Literal["png", "jpeg", "webp"]] = None
+    image_width: Optional[int] = None
+    image_height: Optional[int] = None
+    image_scale: Optional[float] = None
+    # speculative mode: tool calls planned per step, how many run at once and the temperature
+    # the candidates after the first are generated with
+    num_candidates: int = 1
+    max_parallel_candidates: int = 2
+    candidate_llm_temperature: float = 0.8
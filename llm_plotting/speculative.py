@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import streamlit as st
+from langchain.agents import AgentExecutor
+from langchain.agents.agent import BaseMultiActionAgent, BaseSingleActionAgent, RunnableAgent
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun
+from langchain_core.exceptions import OutputParserException
+from langchain_core.pydantic_v1 import root_validator
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+
+from llm_plotting.cache import normalise_code
+from llm_plotting.code_checks import STATIC_CHECKS_FAILED_MESSAGE
+from llm_plotting.prompts import IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE
+from llm_plotting.tools import SANDBOX_EXECUTION_ERROR_PREFIX
+
+Logger = logging.getLogger(st.__name__)
+
+
+def is_accepted(step: AgentStep) -> bool:
+    """A plot is accepted by the validator, code answering a question is accepted once it runs."""
+    observation = str(step.observation)
+    if isinstance(step.action.tool_input, dict) and not step.action.tool_input.get("plotting_code", True):
+        return not observation.startswith((SANDBOX_EXECUTION_ERROR_PREFIX, STATIC_CHECKS_FAILED_MESSAGE))
+    return IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE in observation
+
+
+class SpeculativeAgentExecutor(AgentExecutor):
+    """Agent executor which, while no plot has been accepted yet, plans ``num_candidates`` tool
+    calls for the same step and runs them concurrently, at most ``max_parallel_candidates`` at
+    a time. The first candidate accepted by the validator becomes the step and the others are
+    cancelled. When none is accepted the first planned candidate is used, so the agent carries
+    on with the validator feedback as it would without speculation.
+
+    Candidates after the first are planned by ``candidate_agent`` when given, usually the same
+    agent with a higher temperature so that candidates differ.
+    """
+
+    num_candidates: int = 1
+    max_parallel_candidates: int = 1
+    candidate_agent: Optional[Union[BaseSingleActionAgent, BaseMultiActionAgent, Runnable]] = None
+
+    @root_validator(pre=True)
+    def validate_runnable_candidate_agent(cls, values: Dict) -> Dict:
+        """Wrap a runnable candidate agent the way ``AgentExecutor`` wraps ``agent``."""
+        candidate_agent = values.get("candidate_agent")
+        if isinstance(candidate_agent, Runnable):
+            values["candidate_agent"] = RunnableAgent(runnable=candidate_agent)
+        return values
+
+    async def _aiter_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AsyncIterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        accepted = any(is_accepted(AgentStep(action=a, observation=o)) for a, o in intermediate_steps)
+        if self.num_candidates <= 1 or accepted:
+            async for chunk in super()._aiter_next_step(
+                name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+            ):
+                yield chunk
+            return
+
+        outcome = await self._run_candidates(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager)
+        if outcome is None:
+            # no candidate could be planned, let the regular path surface the parsing error
+            async for chunk in super()._aiter_next_step(
+                name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+            ):
+                yield chunk
+        elif isinstance(outcome, AgentFinish):
+            yield outcome
+        else:
+            yield outcome.action
+            yield outcome
+
+    async def _run_candidates(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun],
+    ) -> Optional[Union[AgentFinish, AgentStep]]:
+        semaphore = asyncio.Semaphore(max(self.max_parallel_candidates, 1))
+        planned_code = set()
+        steps = self._prepare_intermediate_steps(intermediate_steps)
+
+        async def run_candidate(index: int) -> Tuple[int, Optional[Union[AgentFinish, AgentStep]]]:
+            async with semaphore:
+                return index, await plan_and_perform(index)
+
+        async def plan_and_perform(index: int) -> Optional[Union[AgentFinish, AgentStep]]:
+            agent = self.agent if index == 0 or self.candidate_agent is None else self.candidate_agent
+            try:
+                output = await agent.aplan(steps, callbacks=run_manager.get_child() if run_manager else None, **inputs)
+            except OutputParserException as e:
+                Logger.info(f"Candidate {index} could not be parsed: {e}")
+                return None
+
+            if isinstance(output, AgentFinish):
+                return output
+            action = output if isinstance(output, AgentAction) else output[0]
+
+            code = action.tool_input.get("code") if isinstance(action.tool_input, dict) else None
+            if code is not None:
+                if normalise_code(code) in planned_code:
+                    Logger.info(f"Candidate {index} duplicates an earlier candidate, skipping it")
+                    return None
+                planned_code.add(normalise_code(code))
+            return await self._aperform_agent_action(name_to_tool_map, color_mapping, action, run_manager)
+
+        tasks = [asyncio.create_task(run_candidate(index)) for index in range(self.num_candidates)]
+        outcomes: Dict[int, Optional[Union[AgentFinish, AgentStep]]] = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, outcome = await next_done
+                outcomes[index] = outcome
+
+                if isinstance(outcome, AgentStep) and is_accepted(outcome):
+                    Logger.info(f"Accepted candidate {index} after {len(outcomes)} of {self.num_candidates} finished")
+                    return outcome
+                if index == 0 and isinstance(outcome, AgentFinish):
+                    return outcome
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        for index in range(self.num_candidates):
+            if isinstance(outcomes.get(index), AgentStep):
+                return outcomes[index]
+        return outcomes.get(0)
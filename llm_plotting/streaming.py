@@ -0,0 +1,243 @@
+import asyncio
+import contextlib
+import logging
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Literal, Optional, Set, Union
+from uuid import UUID
+
+import streamlit as st
+from langchain_core.callbacks import BaseCallbackHandler
+from pydantic import BaseModel
+
+Logger = logging.getLogger(st.__name__)
+
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class PartialJSONString:
+    """Decodes the string value of one key of a flat JSON object whose text arrives in pieces,
+    like the code argument of a streamed function call. Each character is looked at once, so
+    feeding a whole argument costs time linear in its length.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._state = "object"
+        self._key_chars = []
+        self._in_target = False
+        self._escape: Optional[str] = None
+        self._high_surrogate: Optional[str] = None
+
+    def feed(self, text: str) -> str:
+        """The characters of the value decoded from ``text``."""
+        decoded = []
+        for char in text:
+            state = self._state
+            if state == "string":
+                value = self._string_char(char)
+                if value and self._in_target:
+                    decoded.append(value)
+            elif state == "object":
+                if char in "{,":
+                    self._state = "key"
+            elif state == "key":
+                if char == '"':
+                    self._state, self._key_chars = "key_chars", []
+            elif state == "key_chars":
+                if char == '"':
+                    self._state, self._in_target = "colon", "".join(self._key_chars) == self.key
+                else:
+                    self._key_chars.append(char)
+            elif state == "colon":
+                if char == ":":
+                    self._state = "value"
+            elif state == "value":
+                if char == '"':
+                    self._state = "string"
+                elif not char.isspace():
+                    self._state = "object"
+        return "".join(decoded)
+
+    def _string_char(self, char: str) -> str:
+        if self._escape is None:
+            if char == "\\":
+                self._escape = ""
+                return ""
+            if char == '"':
+                self._state = "object"
+                return ""
+            return char
+
+        self._escape += char
+        if self._escape[0] != "u":
+            self._escape, escaped = None, JSON_ESCAPES.get(char, char)
+            return escaped
+        if len(self._escape) < 5:
+            return ""
+        code_point, self._escape = int(self._escape[1:], 16), None
+        if 0xD800 <= code_point < 0xDC00:
+            self._high_surrogate = chr(code_point)
+            return ""
+        if self._high_surrogate is not None and 0xDC00 <= code_point < 0xE000:
+            high, self._high_surrogate = self._high_surrogate, None
+            return (high + chr(code_point)).encode("utf-16", "surrogatepass").decode("utf-16")
+        return chr(code_point)
+
+
+class StreamDelta(BaseModel):
+    """Text an LLM call has generated since the previous delta: code of a tool call being
+    written, or the text of an answer.
+    """
+
+    run_id: str
+    kind: Literal["code", "text"]
+    text: str
+
+
+ToolCodeStart = Callable[[str, str], None]
+
+
+class TokenStream:
+    """Collects the deltas of the LLM calls of one request for the interface. As soon as the
+    code of a tool call is past its imports, ``on_tool_code_start`` is called with the name of
+    the tool and the import lines.
+    """
+
+    def __init__(self, on_tool_code_start: Optional[ToolCodeStart] = None):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.on_tool_code_start = on_tool_code_start
+
+    def put(self, item: Any):
+        self.queue.put_nowait(item)
+
+
+_current_token_stream: ContextVar[Optional[TokenStream]] = ContextVar("token_stream", default=None)
+
+
+class _RunStream:
+    def __init__(self, token_stream: TokenStream):
+        self.token_stream = token_stream
+        self.code = PartialJSONString("code")
+        self.tool: Optional[str] = None
+        self.import_lines: List[str] = []
+        self.partial_line = ""
+        self.code_started = False
+
+    def feed_code(self, code: str):
+        """Look for the end of the imports in the lines completed by ``code``."""
+        if self.code_started:
+            return
+        lines = (self.partial_line + code).split("\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            stripped = line.strip()
+            if stripped and not stripped.startswith(("import ", "from ", "#")):
+                self.code_started = True
+                if self.token_stream.on_tool_code_start is not None:
+                    self.token_stream.on_tool_code_start(self.tool, "\n".join(self.import_lines))
+                return
+            self.import_lines.append(line)
+
+
+class TokenStreamCallbackHandler(BaseCallbackHandler):
+    """Turns the tokens of streaming chat model calls into ``StreamDelta``s on the token stream
+    of the current request. Calls made outside a streamed request are ignored.
+    """
+
+    # run in the caller's context to see its token stream
+    run_inline = True
+
+    def __init__(self):
+        self._runs: Dict[UUID, _RunStream] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id: UUID, **kwargs: Any):
+        token_stream = _current_token_stream.get()
+        if token_stream is not None:
+            self._runs[run_id] = _RunStream(token_stream)
+
+    def on_llm_new_token(self, token: str, *, chunk=None, run_id: UUID, **kwargs: Any):
+        run = self._runs.get(run_id)
+        if run is None:
+            return
+        message = getattr(chunk, "message", None)
+        function_call = (message.additional_kwargs.get("function_call") if message is not None else None) or {}
+
+        if function_call.get("name") and run.tool is None:
+            run.tool = function_call["name"]
+        if function_call.get("arguments"):
+            code = run.code.feed(function_call["arguments"])
+            if code:
+                run.token_stream.put(StreamDelta(run_id=str(run_id), kind="code", text=code))
+                if run.tool is not None:
+                    run.feed_code(code)
+        elif token:
+            run.token_stream.put(StreamDelta(run_id=str(run_id), kind="text", text=token))
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        self._runs.pop(run_id, None)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._runs.pop(run_id, None)
+
+
+_DONE = object()
+
+
+async def astream_with_tokens(
+    chunks: AsyncIterator[Dict], on_tool_code_start: Optional[ToolCodeStart] = None
+) -> AsyncIterator[Union[Dict, StreamDelta]]:
+    """The chunks of an agent stream interleaved with the deltas of the LLM calls made while
+    the next chunk is produced. The agent runs in a task of its own, which is cancelled when
+    the stream is closed early.
+    """
+    token_stream = TokenStream(on_tool_code_start)
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                token_stream.put(chunk)
+        finally:
+            token_stream.put(_DONE)
+
+    # the task copies the current context, so the LLM calls of the agent see the token stream
+    context_token = _current_token_stream.set(token_stream)
+    try:
+        task = asyncio.create_task(produce())
+    finally:
+        _current_token_stream.reset(context_token)
+
+    try:
+        while True:
+            item = await token_stream.queue.get()
+            if item is _DONE:
+                break
+            yield item
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+
+class BackgroundCalls:
+    """Runs coroutines as tasks of their own, logging their errors. References to the running
+    tasks are kept so they are not garbage collected before they finish.
+    """
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, coroutine: Coroutine, name: str):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(lambda task: self._done(task, name))
+
+    async def wait(self):
+        """Wait for the running calls to finish."""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _done(self, task: asyncio.Task, name: str):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            Logger.warning(f"{name} failed: {task.exception()}")
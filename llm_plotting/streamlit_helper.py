@@ -1,21 +1,34 @@
-import base64
+import asyncio
 import logging
 import textwrap
+import time
+import uuid
 from io import BytesIO
-from typing import Callable, Dict, List
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union
 
 import numpy as np
-import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
 import streamlit as st
+from langchain_core.agents import AgentStep
+from langchain_core.language_models.chat_models import BaseChatModel
 from PIL import Image
 from pydantic import BaseModel
 from streamlit_modal import Modal
 
-from llm_plotting.agent import setup_agent_executor
+from llm_plotting.agent import build_agent_inputs, setup_agent_executor
 from llm_plotting.assets.streamlit_txt import TECHNICAL_INFO_1, TECHNICAL_INFO_2
-from llm_plotting.prompt_helper import extract_metadata
+from llm_plotting.cache import AnswerCache, CachedAnswer, get_answer_cache
+from llm_plotting.dataset import IngestedDataset, ingest_csv
+from llm_plotting.events import AgentEvent, chunk_to_events
+from llm_plotting.image_store import ImageStore
+from llm_plotting.rendering import PLOTLY_JSON_MIME_TYPE
+from llm_plotting.scheduler import RequestScheduler
 from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.speculative import is_accepted
+from llm_plotting.streaming import BackgroundCalls, StreamDelta, astream_with_tokens
 from llm_plotting.tools import CodeValidationTool
+from llm_plotting.tracing import Trace
 
 Logger = logging.getLogger(st.__name__)
 
@@ -38,13 +51,24 @@ def display_and_get_agent_settings():
             value=0.0,
             step=0.01,
         )
+        num_candidates = st.number_input("num_candidates", min_value=1, max_value=4, value=1, step=1)
         return AgentSettings(
             max_iterations=max_iterations,
             code_generation_llm_temperature=code_generation_llm_temperature,
             image_validation_llm_temperature=image_validation_llm_temperature,
+            num_candidates=num_candidates,
         )
 
 
+def display_dataset_memory_report(dataset: IngestedDataset):
+    report = dataset.memory_report
+    with st.sidebar.expander("Dataset Memory"):
+        st.write(f"CSV file: {report['file_mb']} MB")
+        st.write(f"Parsed: {report['parsed_mb']} MB")
+        st.write(f"After downcasting dtypes: {report['downcast_mb']} MB (saved {report['saved_mb']} MB)")
+        st.json(report["dtypes"], expanded=False)
+
+
 def display_popup_message():
 
     modal = Modal(key="modal key", title="Information")
@@ -73,25 +97,145 @@ def display_popup_message():
         st.write("done")
 
 
+def display_stored_figure(image_store: ImageStore, handle: str):
+    stored_figure = image_store.get(handle)
+    if stored_figure is None:
+        st.caption("This figure is no longer available, it was evicted from the session image store.")
+    elif stored_figure.mime_type == PLOTLY_JSON_MIME_TYPE:
+        st.plotly_chart(pio.from_json(stored_figure.data.decode("utf-8"), skip_invalid=True), use_container_width=True)
+    else:
+        st.image(stored_figure.data)
+
+
+def trace_waterfall_figure(trace: Trace) -> go.Figure:
+    """Gantt style view of a trace, one bar per span, nested spans indented below their parent."""
+    depths = {}
+    for span in trace.spans:
+        depths[span.span_id] = depths.get(span.parent_id, -1) + 1
+
+    start = trace.root.start
+    labels = [f"{'  ' * depths[span.span_id]}{span.name}" for span in trace.spans]
+    figure = go.Figure(
+        go.Bar(
+            y=labels,
+            x=[span.duration for span in trace.spans],
+            base=[span.start - start for span in trace.spans],
+            orientation="h",
+            marker_color=["crimson" if span.error else "steelblue" for span in trace.spans],
+            customdata=[str(span.attributes) for span in trace.spans],
+            hovertemplate="%{y}: %{x:.3f}s<br>%{customdata}<extra></extra>",
+        )
+    )
+    figure.update_layout(
+        height=120 + 22 * len(trace.spans),
+        margin=dict(l=0, r=0, t=10, b=0),
+        xaxis_title="seconds since the request started",
+        yaxis=dict(autorange="reversed", type="category"),
+    )
+    return figure
+
+
+def display_scheduler_stats(scheduler: RequestScheduler):
+    with st.sidebar.expander("Server Load"):
+        stats = scheduler.stats()
+        st.write(f"Requests running: {stats['running']}, queued: {stats['queued']}")
+        st.write(f"Sandbox executions running: {stats['executions_running']}, waiting: {stats['executions_waiting']}")
+        st.write(f"LLM calls running: {stats['llm_calls_running']}, waiting: {stats['llm_calls_waiting']}")
+
+
+def display_answer_cache(answer_cache: AnswerCache, dataset: Optional[IngestedDataset]):
+    with st.sidebar.expander("Answer Cache"):
+        stats = answer_cache.stats()
+        st.write(f"Hit rate: {stats['hit_rate']:.0%} ({stats['hits']} hits, {stats['misses']} misses)")
+        st.write(f"Cached answers: {stats['entries']}, {stats['bytes'] / 1024**2:.1f} MB")
+        if dataset is not None and st.button("Forget cached answers about this dataset"):
+            dropped = answer_cache.invalidate(dataset.sandbox_df.fingerprint)
+            st.write(f"Dropped {dropped} cached answers.")
+
+
+def display_latest_trace(st_agent_interface: Optional["STAgentInterface"]):
+    with st.sidebar.expander("Latest Request Timings"):
+        trace = st_agent_interface.latest_trace if st_agent_interface is not None else None
+        if trace is None:
+            st.write("Timings are shown here once a request has finished.")
+            return
+        st.write(f"Total: {trace.root.duration:.2f}s")
+        if "prompt_tokens" in trace.root.attributes:
+            st.write(
+                f"Prompt tokens: {trace.root.attributes['prompt_tokens']} over all LLM calls, earlier turns take "
+                f"{trace.root.attributes['memory_tokens']} of each prompt"
+            )
+        st.plotly_chart(trace_waterfall_figure(trace), use_container_width=True)
+
+
 class STFuncRepr(BaseModel):
     st_func: Callable
     args: List = []
     kwargs: Dict = {}
 
 
+class LivePreview:
+    """Placeholder showing the text of an LLM call while it is generated. Redrawing shows the
+    whole text so far, so it is redrawn at most every ``interval`` seconds.
+    """
+
+    def __init__(self, placeholder, kind: str, interval: float = 0.1):
+        self.placeholder = placeholder
+        self.kind = kind
+        self.interval = interval
+        self.parts: List[str] = []
+        self.last_drawn = 0.0
+
+    def append(self, text: str):
+        self.parts.append(text)
+        if time.monotonic() - self.last_drawn >= self.interval:
+            self.draw()
+
+    def draw(self):
+        text = "".join(self.parts)
+        if self.kind == "code":
+            self.placeholder.code(text, language="python")
+        else:
+            self.placeholder.markdown(text)
+        self.last_drawn = time.monotonic()
+
+
 class STAgentInterface:
     def __init__(
         self,
         settings: Settings,
         agent_settings: AgentSettings,
-        uploaded_file: BytesIO,
+        uploaded_file: Union[BytesIO, IngestedDataset],
         execute_st_funcs: bool = True,
+        llm: Optional[BaseChatModel] = None,
+        code_validation_tool: Optional[CodeValidationTool] = None,
+        session_id: Optional[str] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        tables: Optional[Dict[str, IngestedDataset]] = None,
     ):
-        df = pd.read_csv(uploaded_file)
+        dataset = uploaded_file if isinstance(uploaded_file, IngestedDataset) else ingest_csv(uploaded_file)
 
-        self.metadata_json = extract_metadata(df)
-        self.agent_executor = setup_agent_executor(settings, agent_settings, df)
+        self.dataset = dataset
+        self.tables = [table.as_table(name) for name, table in (tables or {}).items()]
+        self.metadata_token_budget = settings.metadata_token_budget
+        self.metadata_metrics: Dict[str, int] = {}
+        self.session_id = session_id or uuid.uuid4().hex
+        self.answer_cache = answer_cache
+        if self.answer_cache is None and settings.answer_cache_enabled:
+            self.answer_cache = get_answer_cache(settings)
+        self.verify_cached_answers = settings.answer_cache_verify
+        self.agent_executor = setup_agent_executor(
+            settings,
+            agent_settings,
+            dataset.df,
+            dataset.sandbox_df,
+            llm=llm,
+            code_validation_tool=code_validation_tool,
+            tables=self.tables,
+        )
         self.execute_st_funcs = execute_st_funcs
+        self.live_previews: Dict[str, LivePreview] = {}
+        self._background_calls = BackgroundCalls()
 
     @staticmethod
     def store_and_display_message(st_func: Callable, args: List = [], kwargs: Dict = {}, role: str = None):
@@ -118,91 +262,243 @@ class STAgentInterface:
     def code_validation_tool(self):
         return [tool for tool in self.agent_executor.tools if isinstance(tool, CodeValidationTool)][0]
 
+    @property
+    def latest_trace(self) -> Optional[Trace]:
+        return self.code_validation_tool.get_tracer().latest_trace(self.session_id)
+
     async def invoke(self, user_input: str):
         chunks = []
+        async for chunk in self.astream(user_input):
+            self.render_item(chunk)
+            chunks.append(chunk)
+        return chunks
 
-        async for chunk in self.agent_executor.astream({"user_input": user_input, "metadata_json": self.metadata_json}):
-            list_of_st_func_reprs = self.process_chunk(chunk)
-            if self.execute_st_funcs:
-                for st_func_repr in list_of_st_func_reprs:
-                    STAgentInterface.store_and_display_message(
-                        st_func_repr.st_func,
-                        st_func_repr.args,
-                        st_func_repr.kwargs,
-                    )
-                STAgentInterface.store_and_display_message(st.write, args=["---"])
-            chunks.append({"chunk": chunk, "st_func_reprs": list_of_st_func_reprs})
+    async def astream(self, user_input: str) -> AsyncIterator[Dict]:
+        """Agent chunks along with the Streamlit calls which display them. Nothing is rendered
+        here, so this can run on the scheduler loop away from the script thread. In between, the
+        text the model is generating arrives as items with an empty chunk and a ``delta``.
+        """
+        tracer = self.code_validation_tool.get_tracer()
 
-        return chunks
+        with tracer.span("request", session_id=self.session_id, user_input_chars=len(user_input)) as request_span:
+            agent_inputs, self.metadata_metrics = build_agent_inputs(
+                user_input,
+                self.dataset.df,
+                self.code_validation_tool.get_sandbox_df(),
+                self.metadata_token_budget,
+                tracer,
+                tables=self.tables,
+            )
 
-    def process_chunk(self, chunk) -> List[STFuncRepr]:
-        try:
-            if "actions" in chunk:
-                list_of_st_func_reprs = self._process_agent_action(chunk)
-            elif "steps" in chunk:
-                list_of_st_func_reprs = self._process_agent_observation(chunk)
-            elif "output" in chunk:
-                list_of_st_func_reprs = self._process_final_result(chunk)
-            return list_of_st_func_reprs
-        except Exception as e:
-            Logger.error(f"Error processing chunk: {e}")
-            return [STFuncRepr(st_func=st.error, args=["Error rendering chunk"])]
+            use_answer_cache = self._uses_answer_cache()
+            cached_answer = await self._cached_answer(user_input) if use_answer_cache else None
+            request_span.set(answer_cache_hit=cached_answer is not None)
+            if cached_answer is not None:
+                yield self._replay(user_input, cached_answer)
+                return
 
-    def _process_agent_action(self, chunk) -> List[STFuncRepr]:
-        action = chunk["actions"][0]
-        if action.tool != "CodeValidationTool":
-            raise ValueError("Tool not recognized")
+            n_chunks, accepted_step, output = 0, None, None
+            chunks = astream_with_tokens(self.agent_executor.astream(agent_inputs), self._on_tool_code_start)
+            try:
+                async for chunk in chunks:
+                    if isinstance(chunk, StreamDelta):
+                        yield {"chunk": {}, "delta": chunk, "st_func_reprs": []}
+                        continue
+                    with tracer.span("ui.process_chunk", chunk=next(iter(chunk), "")):
+                        list_of_st_func_reprs = self.process_chunk(chunk)
+                    accepted_step = next((step for step in chunk.get("steps", []) if is_accepted(step)), accepted_step)
+                    output = chunk.get("output", output)
+                    n_chunks += 1
+                    yield {"chunk": chunk, "st_func_reprs": list_of_st_func_reprs}
+            finally:
+                await self._background_calls.wait()
+                # a sandbox prewarmed for code which never ran goes back to the pool
+                await asyncio.to_thread(self.code_validation_tool.release_prewarmed)
+            trace = tracer.current_trace()
+            request_span.set(
+                chunks=n_chunks,
+                prompt_tokens=sum(
+                    span.attributes.get("prompt_tokens", 0) for span in trace.spans if span.name == "llm.generate"
+                ),
+                memory_tokens=self.agent_executor.memory.last_metrics.get("memory_tokens", 0),
+            )
+            if use_answer_cache and accepted_step is not None and output is not None:
+                self._store_answer(user_input, accepted_step, output)
 
-        return [
-            STFuncRepr(
-                st_func=st.subheader,
-                args=["Calling Tool:"],
-            ),
-            STFuncRepr(
-                st_func=st.write,
-                args=[f"`{action.tool}` with inputs:"],
-            ),
-            STFuncRepr(
-                st_func=st.markdown,
-                args=["**Code:**"],
-            ),
-            STFuncRepr(
-                st_func=st.code,
-                args=[textwrap.indent(action.tool_input["code"], "    ")],
-                kwargs={"language": "python"},
-            ),
-            STFuncRepr(
-                st_func=st.markdown,
-                args=["**Description:**"],
+    def _on_tool_code_start(self, tool_name: str, imports: str):
+        # the sandbox gets ready while the model is still writing the code
+        if tool_name == self.code_validation_tool.name:
+            self._background_calls.start(self.code_validation_tool.aprewarm(imports), "Sandbox prewarm")
+
+    def _uses_answer_cache(self) -> bool:
+        # answers depend on the conversation so far, only opening questions are cached
+        return self.answer_cache is not None and not self.agent_executor.memory.chat_memory.messages
+
+    @property
+    def answer_cache_fingerprint(self) -> str:
+        # answers about several tables depend on all of them
+        return ",".join(sandbox_df.fingerprint for sandbox_df in [self.dataset.sandbox_df, *self.tables])
+
+    async def _cached_answer(self, user_input: str) -> Optional[CachedAnswer]:
+        fingerprint = self.answer_cache_fingerprint
+        cached_answer = self.answer_cache.get(fingerprint, user_input)
+        if cached_answer is None or not self.verify_cached_answers:
+            return cached_answer
+
+        tool = self.code_validation_tool
+        with tool.get_tracer().span("answer_cache.verify") as span:
+            async with tool.get_scheduler().executions.slot():
+                result = await asyncio.to_thread(
+                    tool.get_execution_backend().execute,
+                    cached_answer.code,
+                    tool.referenced_sandbox_dfs(cached_answer.code),
+                    cached_answer.plotting_code,
+                )
+            span.set(exit_code=result.exit_code)
+        if result.exit_code != 0:
+            Logger.info("Cached answer no longer runs, answering the question again")
+            self.answer_cache.discard(fingerprint, user_input)
+            return None
+        return cached_answer
+
+    def _replay(self, user_input: str, cached_answer: CachedAnswer) -> Dict:
+        """The cached answer rendered like the steps of a run which accepted it straight away."""
+        figure_handle = None
+        if cached_answer.figure is not None:
+            figure_handle = self.code_validation_tool.get_image_store().put(
+                cached_answer.figure, cached_answer.figure_mime_type, key=cached_answer.code
+            )
+        events = [
+            AgentEvent(
+                event="action",
+                tool=self.code_validation_tool.name,
+                code=cached_answer.code,
+                description=cached_answer.description,
+                plotting_code=cached_answer.plotting_code,
             ),
-            STFuncRepr(
-                st_func=st.write,
-                args=[f"{action.tool_input['description']}"],
+            AgentEvent(
+                event="observation",
+                tool=self.code_validation_tool.name,
+                plotting_code=cached_answer.plotting_code,
+                text=cached_answer.observation,
+                figure_handle=figure_handle,
             ),
+            AgentEvent(event="answer", text=cached_answer.answer),
         ]
+        # later questions in the session see this exchange as if the agent had run
+        self.agent_executor.memory.save_turn(user_input, cached_answer.answer, code=cached_answer.code)
+        list_of_st_func_reprs = [STFuncRepr(st_func=st.caption, args=["Answered from the cache of earlier answers."])]
+        list_of_st_func_reprs += [st_func_repr for event in events for st_func_repr in self.event_st_func_reprs(event)]
+        return {"chunk": {"output": cached_answer.answer, "cached": True}, "st_func_reprs": list_of_st_func_reprs}
 
-    def _process_agent_observation(self, chunk) -> List[STFuncRepr]:
-        observation = chunk["steps"][0].observation
-        prior_tool_name = chunk["messages"][0].name
-        if prior_tool_name == "CodeValidationTool":
-            plotting_code = chunk["steps"][0].action.tool_input["plotting_code"]
-            if plotting_code:
-                image_in_base64 = self.code_validation_tool.image_in_base64_history[-1]
-                image_in_bytes = base64.b64decode(image_in_base64)
+    def _store_answer(self, user_input: str, step: AgentStep, output: str):
+        tool_input = step.action.tool_input
+        if not isinstance(tool_input, dict) or "code" not in tool_input:
+            return
+        plotting_code = tool_input.get("plotting_code", True)
+        stored_figure = None
+        if plotting_code:
+            image_store = self.code_validation_tool.get_image_store()
+            handle = image_store.latest_handle_for(tool_input["code"])
+            stored_figure = image_store.get(handle) if handle is not None else None
+            if stored_figure is None:
+                return
+        self.answer_cache.put(
+            self.answer_cache_fingerprint,
+            user_input,
+            CachedAnswer(
+                code=tool_input["code"],
+                description=tool_input.get("description", ""),
+                plotting_code=plotting_code,
+                observation=str(step.observation),
+                answer=str(output),
+                figure=stored_figure.data if stored_figure is not None else None,
+                figure_mime_type=stored_figure.mime_type if stored_figure is not None else None,
+            ),
+        )
 
+    def render(self, list_of_st_func_reprs: List[STFuncRepr]):
+        if not self.execute_st_funcs:
+            return
+        for st_func_repr in list_of_st_func_reprs:
+            STAgentInterface.store_and_display_message(
+                st_func_repr.st_func,
+                st_func_repr.args,
+                st_func_repr.kwargs,
+            )
+        STAgentInterface.store_and_display_message(st.write, args=["---"])
+
+    def render_item(self, item: Dict):
+        """Render an item of ``astream``. Deltas update a live preview of their LLM call, which
+        is removed once the step it belongs to is rendered in full.
+        """
+        if not self.execute_st_funcs:
+            return
+        delta: Optional[StreamDelta] = item.get("delta")
+        if delta is None:
+            for live_preview in self.live_previews.values():
+                live_preview.placeholder.empty()
+            self.live_previews = {}
+            self.render(item["st_func_reprs"])
+            return
+        if delta.run_id not in self.live_previews:
+            self.live_previews[delta.run_id] = LivePreview(st.empty(), delta.kind)
+        self.live_previews[delta.run_id].append(delta.text)
+
+    def process_chunk(self, chunk) -> List[STFuncRepr]:
+        try:
+            events = chunk_to_events(chunk, self.code_validation_tool.get_image_store())
+            return [st_func_repr for event in events for st_func_repr in self.event_st_func_reprs(event)]
+        except Exception as e:
+            Logger.error(f"Error processing chunk: {e}")
+            return [STFuncRepr(st_func=st.error, args=["Error rendering chunk"])]
+
+    def event_st_func_reprs(self, event: AgentEvent) -> List[STFuncRepr]:
+        if event.event == "action":
+            return [
+                STFuncRepr(
+                    st_func=st.subheader,
+                    args=["Calling Tool:"],
+                ),
+                STFuncRepr(
+                    st_func=st.write,
+                    args=[f"`{event.tool}` with inputs:"],
+                ),
+                STFuncRepr(
+                    st_func=st.markdown,
+                    args=["**Code:**"],
+                ),
+                STFuncRepr(
+                    st_func=st.code,
+                    args=[textwrap.indent(event.code, "    ")],
+                    kwargs={"language": "python"},
+                ),
+                STFuncRepr(
+                    st_func=st.markdown,
+                    args=["**Description:**"],
+                ),
+                STFuncRepr(
+                    st_func=st.write,
+                    args=[f"{event.description}"],
+                ),
+            ]
+
+        if event.event == "observation":
+            if event.plotting_code:
                 return [
                     STFuncRepr(st_func=st.subheader, args=["Tool Result:"]),
-                    STFuncRepr(st_func=st.image, kwargs={"image": image_in_bytes}),
-                    STFuncRepr(st_func=st.write, args=[f"{observation}"]),
-                ]
-            else:
-                return [
-                    STFuncRepr(st_func=st.subheader, args=["Tool Result:"]),
-                    STFuncRepr(st_func=st.write, args=[f"{observation}"]),
+                    STFuncRepr(
+                        st_func=display_stored_figure,
+                        args=[self.code_validation_tool.get_image_store(), event.figure_handle],
+                    ),
+                    STFuncRepr(st_func=st.write, args=[f"{event.text}"]),
                 ]
+            return [
+                STFuncRepr(st_func=st.subheader, args=["Tool Result:"]),
+                STFuncRepr(st_func=st.write, args=[f"{event.text}"]),
+            ]
 
-    def _process_final_result(self, chunk) -> List[STFuncRepr]:
         return [
             STFuncRepr(st_func=st.subheader, args=["Final Output:"]),
-            STFuncRepr(st_func=st.write, args=[f'{chunk["output"]}']),
+            STFuncRepr(st_func=st.write, args=[f"{event.text}"]),
         ]
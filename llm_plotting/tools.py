@@ -1,33 +1,49 @@
 # Import things that are needed generically
-import base64
+import asyncio
+import json
 import logging
-from io import StringIO
-from typing import List, Optional, Type
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
 
 import pandas as pd
-import requests
 import streamlit as st
-from e2b import Sandbox
 from langchain.callbacks.manager import AsyncCallbackManagerForToolRun, CallbackManagerForToolRun
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import BaseTool
 
-from llm_plotting.prompts import CODE_VALIDATION_TOOL_DESCRIPTION, IMAGE_SAVE_PATH, generate_validation_llm_messages
+from llm_plotting.cache import (
+    ExecutionCache,
+    ValidationCache,
+    execution_cache_key,
+    get_execution_cache,
+    get_validation_cache,
+    perceptual_hash,
+)
+from llm_plotting.code_checks import CodeChecker, CodeIssue, format_issues, module_names, referenced_files
+from llm_plotting.dataset import SandboxDataFrame
+from llm_plotting.e2b.plot_prep import PLOT_PREP_MARKER
+from llm_plotting.executors import ExecutionBackend, ExecutionResult, create_execution_backend
+from llm_plotting.fast_path import FastPathEvaluator, get_fast_path_evaluator, may_take_fast_path
+from llm_plotting.http_clients import get_async_http_client, get_http_session
+from llm_plotting.image_store import ImageStore, prepare_validation_image
+from llm_plotting.legibility import LegibilityChecker
+from llm_plotting.prompts import (
+    AVAILABLE_LIBRARIES,
+    CODE_VALIDATION_TOOL_DESCRIPTION,
+    FIGURE_SAVE_PATH,
+    IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE,
+    generate_validation_llm_messages,
+)
+from llm_plotting.rendering import PLOTLY_JSON_MIME_TYPE, FigureRenderer
+from llm_plotting.sandbox import SandboxPool
+from llm_plotting.scheduler import RequestScheduler, get_scheduler
 from llm_plotting.settings import Settings
+from llm_plotting.tracing import Span, Tracer, get_tracer
 
 Logger = logging.getLogger(st.__name__)
 
 
-class NamedStringIO(StringIO):
-    """Custom StringIO class with name attribute to circumvent e2b .upload_file()
-    method needing file to be saved locally.
-    """
-
-    def __init__(self, *args, **kwargs):
-        self.name = kwargs.pop("name", "untitled")
-        super().__init__(*args, **kwargs)
-
-
 class CodeValidationToolInput(BaseModel):
     code: str = Field(description="python code to generate plots")
     description: str = Field(description="description of the plot in context of the data")
@@ -36,22 +52,46 @@ class CodeValidationToolInput(BaseModel):
     )
 
 
+SANDBOX_EXECUTION_ERROR_PREFIX = "Failed to execute code with error:"
+
+
 class SandboxExecutionError(Exception):
     pass
 
 
+def _token_usage(response_json: Dict) -> Dict[str, int]:
+    usage = response_json.get("usage") or {}
+    return {key: value for key, value in usage.items() if isinstance(value, int)}
+
+
 class CodeValidationTool(BaseTool):
     name = "CodeValidationTool"
     description = CODE_VALIDATION_TOOL_DESCRIPTION
     args_schema: Type[BaseModel] = CodeValidationToolInput
 
-    binary = "python3"
-    filepath = "/index.py"
-    image_in_base64_history: List[str] = []
-
-    settings = Settings()
+    settings: Settings = Field(default_factory=Settings)
     temperature = 0.0
-    df = pd.DataFrame()
+    # the rendered output, the vision model gets images of the validation size
+    image_format: Optional[str] = None
+    image_width: Optional[int] = None
+    image_height: Optional[int] = None
+    image_scale: Optional[float] = None
+    df: pd.DataFrame = Field(default_factory=pd.DataFrame)
+    sandbox_df: Optional[SandboxDataFrame] = None
+    # further dataframes of the session, each stored under its own name in the sandbox
+    tables: List[SandboxDataFrame] = []
+    sandbox_pool: Optional[SandboxPool] = None
+    execution_backend: Optional[ExecutionBackend] = None
+    execution_cache: Optional[ExecutionCache] = None
+    validation_cache: Optional[ValidationCache] = None
+    image_store: Optional[ImageStore] = None
+    figure_renderer: Optional[FigureRenderer] = None
+    validation_renderer: Optional[FigureRenderer] = None
+    code_checker: Optional[CodeChecker] = None
+    fast_path_evaluator: Optional[FastPathEvaluator] = None
+    legibility_checker: Optional[LegibilityChecker] = None
+    tracer: Optional[Tracer] = None
+    scheduler: Optional[RequestScheduler] = None
 
     def _run(
         self,
@@ -62,62 +102,342 @@ class CodeValidationTool(BaseTool):
     ) -> str:
         """Use the tool."""
 
-        try:
-            code_output = self._execute_code(code, plotting_code)
-            if not plotting_code:
-                return code_output
-        except SandboxExecutionError as e:
-            return str(e)
-
-        self.image_in_base64_history.append(code_output)
-        return self._validate_image(code_output, description, code)
-
-    def _execute_code(self, code: str, plotting_code: bool) -> str:
-
-        with Sandbox(template="my-agent-sandbox-test", api_key=self.settings.e2b_api_key) as sandbox:
-            self._upload_df_to_sandbox(self.df, sandbox)
-            code = self._modify_code(code) if plotting_code else code
-            sandbox.filesystem.write(self.filepath, code)
-
-            output = sandbox.process.start_and_wait(cmd=f"{self.binary} {self.filepath}")
-
-            Logger.info(f"E2B Sandbox stdout: {output.stdout}")
-            Logger.info(f"E2B Sandbox stderr: {output.stderr}")
-
-            if output.exit_code != 0:
-                raise SandboxExecutionError(f"Failed to execute code with error: {output.stderr}")
-
-            return self._handle_execute_code_output(output, plotting_code, sandbox)
-
-    def _handle_execute_code_output(self, output, plotting_code, sandbox):
+        with self._tool_span(code, plotting_code) as span:
+            issues = self._check_code(code, plotting_code)
+            if issues:
+                span.set(outcome="static_checks_failed")
+                return format_issues(issues)
+
+            try:
+                code_output = self._execute_code(code, plotting_code)
+                if not plotting_code:
+                    span.set(outcome="executed")
+                    return code_output
+            except SandboxExecutionError as e:
+                span.set(outcome="execution_failed")
+                return str(e)
+
+            self._store_figure(code_output, code)
+            verdict = self._check_legibility(code_output)
+            if verdict is None:
+                image_in_bytes, mime_type = self._figure_image(code_output)
+                verdict = self._validate_image(image_in_bytes, description, code, mime_type)
+            span.set(outcome="validated")
+            return self._report_plot_prep(verdict, code_output)
+
+    @contextmanager
+    def _tool_span(self, code: str, plotting_code: bool) -> Iterator[Span]:
+        tracer = self.get_tracer()
+        trace = tracer.current_trace()
+        iteration = trace.count("tool.call") if trace is not None else 0
+        with tracer.span("tool.call", iteration=iteration, plotting_code=plotting_code, code_bytes=len(code)) as span:
+            yield span
+
+    def _check_code(self, code: str, plotting_code: bool) -> List[CodeIssue]:
+        code_checker = self.get_code_checker()
+        if code_checker is None:
+            return []
+
+        with self.get_tracer().span("tool.static_checks") as span:
+            issues = code_checker.check(code, plotting_code)
+            span.set(issues=len(issues))
+        if issues:
+            Logger.info(f"Static checks rejected code without a sandbox call: {code_checker.stats()}")
+        return issues
+
+    def _execute_code(self, code: str, plotting_code: bool) -> Union[str, ExecutionResult]:
+        sandbox_dfs = self.referenced_sandbox_dfs(code)
+        execution_cache = self.get_execution_cache()
+        code = self._modify_code(code) if plotting_code else code
+        fingerprints = ",".join(sandbox_df.fingerprint for sandbox_df in sandbox_dfs)
+        cache_key = execution_cache_key(code, plotting_code, fingerprints)
+
+        with self.get_tracer().span("tool.execute", code_bytes=len(code), tables=len(sandbox_dfs)) as span:
+            result = execution_cache.get(cache_key) if execution_cache is not None else None
+            span.set(cache_hit=result is not None)
+            if result is not None:
+                Logger.info(f"Execution cache hit: {execution_cache.stats()}")
+            if result is None and not plotting_code:
+                result = self._run_fast_path(code, sandbox_dfs)
+                span.set(fast_path=result is not None)
+            if result is not None:
+                # answered without the sandbox a prewarm may hold
+                self.release_prewarmed()
+            else:
+                start = time.perf_counter()
+                result = self.get_execution_backend().execute(code, sandbox_dfs, plotting_code)
+                if not plotting_code and self.get_fast_path_evaluator() is not None:
+                    self.get_fast_path_evaluator().record_sandbox_time(time.perf_counter() - start)
+                if execution_cache is not None:
+                    execution_cache.put(cache_key, result)
+            span.set(exit_code=result.exit_code, figure_bytes=len(result.figure_json or result.image or b""))
+
+        Logger.info(f"Sandbox stdout: {result.stdout}")
+        Logger.info(f"Sandbox stderr: {result.stderr}")
+
+        if result.exit_code != 0:
+            raise SandboxExecutionError(f"{SANDBOX_EXECUTION_ERROR_PREFIX} {result.stderr}")
+
+        return self._handle_execute_code_output(result, plotting_code)
+
+    def _run_fast_path(self, code: str, sandbox_dfs: List[SandboxDataFrame]) -> Optional[ExecutionResult]:
+        """Result of read-only code evaluated in process, None when it has to go to the backend."""
+        fast_path_evaluator = self.get_fast_path_evaluator()
+        if fast_path_evaluator is None:
+            return None
+        plan = fast_path_evaluator.plan(code, sandbox_dfs)
+        if plan is None:
+            return None
+        result = fast_path_evaluator.evaluate(plan, sandbox_dfs)
+        Logger.info(f"Fast path: {fast_path_evaluator.stats()}")
+        return result
+
+    def _handle_execute_code_output(self, result: ExecutionResult, plotting_code: bool) -> Union[str, ExecutionResult]:
         if plotting_code:
-            image_in_bytes = sandbox.download_file("/home/user/{}".format(IMAGE_SAVE_PATH))
-            return base64.b64encode(image_in_bytes).decode("utf-8")
+            return result
         else:
-            return output.stdout
+            return result.stdout
 
     def _modify_code(self, code):
 
         lines = code.split("\n")
 
+        if self.settings.plot_prep_enabled:
+            lines.extend(
+                [
+                    "try:",
+                    "    from plot_prep import prepare_figure as _prepare_figure",
+                    "except ImportError:",
+                    "    _prepare_figure = None",
+                    "if _prepare_figure is not None:",
+                    (
+                        "    fig = _prepare_figure(fig, "
+                        f"max_line_points={self.settings.plot_prep_max_line_points}, "
+                        f"max_scatter_points={self.settings.plot_prep_max_scatter_points}, "
+                        f"max_categories={self.settings.plot_prep_max_categories})"
+                    ),
+                ]
+            )
         lines.extend(
             [
                 "import plotly.io as pio",
-                f"pio.write_image(fig, '{IMAGE_SAVE_PATH }')",
+                f"pio.write_json(fig, '{FIGURE_SAVE_PATH }')",
             ]
         )
 
         return "\n".join(lines)
 
-    def _upload_df_to_sandbox(self, df, sandbox):
-        csv_buffer = NamedStringIO(name="df.csv")
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
-
-        sandbox.upload_file(csv_buffer)
-
-    def _validate_image(self, image_in_base64: str, description: str, code: str) -> str:
+    def _check_legibility(self, result: ExecutionResult) -> Optional[str]:
+        """Verdict from the local legibility checks, None when the vision model has to decide."""
+        legibility_checker = self.get_legibility_checker()
+        if legibility_checker is None or result.figure_json is None:
+            return None
+
+        with self.get_tracer().span("tool.legibility_checks", figure_bytes=len(result.figure_json)) as span:
+            figure = json.loads(result.figure_json)
+            report = legibility_checker.check(figure)
+            span.set(issues=len(report.issues), warnings=len(report.warnings))
+        Logger.info(f"Legibility checks: {legibility_checker.stats()}")
+        if report.issues:
+            return "\n".join(
+                ["The plot is not legible yet, fix these problems and validate again:"]
+                + [f"- {issue}" for issue in report.issues]
+            )
+        if legibility_checker.accepts(figure, report):
+            return f"{IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE}, it passed the local legibility checks."
+        return None
+
+    def _report_plot_prep(self, verdict: str, result: ExecutionResult) -> str:
+        """Tell the agent which traces were reduced, so it does not try to undo it."""
+        reductions = [
+            line.removeprefix(PLOT_PREP_MARKER).strip()
+            for line in result.stdout.splitlines()
+            if line.startswith(PLOT_PREP_MARKER)
+        ]
+        if not reductions:
+            return verdict
+        return "\n".join(
+            [verdict, "", "The figure was too large to render as is, so before rendering:"]
+            + [f"- {reduction}" for reduction in reductions]
+        )
 
+    def _store_figure(self, result: ExecutionResult, code: str) -> str:
+        if result.figure_json is not None:
+            return self.get_image_store().put(result.figure_json, PLOTLY_JSON_MIME_TYPE, key=code)
+        return self.get_image_store().put(result.image, key=code)
+
+    def _figure_image(self, result: ExecutionResult) -> Tuple[bytes, str]:
+        """Pixels for the vision model, the figure JSON is only rasterised here."""
+        if result.image is not None:
+            return result.image, "image/png"
+        figure_renderer = self.get_validation_renderer()
+        with self.get_tracer().span("tool.rasterise", figure_bytes=len(result.figure_json)) as span:
+            image_in_bytes = figure_renderer.render(result.figure_json)
+            span.set(image_bytes=len(image_in_bytes))
+        return image_in_bytes, figure_renderer.mime_type
+
+    def get_sandbox_df(self) -> SandboxDataFrame:
+        if self.sandbox_df is None or self.sandbox_df.df is not self.df:
+            self.sandbox_df = SandboxDataFrame(self.df)
+        return self.sandbox_df
+
+    async def aprewarm(self, imports: str):
+        """Lease a sandbox and upload the dataframe while the code of a call of this tool is
+        still streaming in, so execution starts as soon as it is complete. Code which may take
+        the fast path, going by its ``imports``, is left alone. Holds an execution slot meanwhile.
+        """
+        if self.get_fast_path_evaluator() is not None and may_take_fast_path(imports):
+            return
+        with self.get_tracer().span("tool.prewarm"):
+            async with self.get_scheduler().executions.slot():
+                await asyncio.to_thread(self.get_execution_backend().prewarm, [self.get_sandbox_df()])
+
+    def release_prewarmed(self):
+        """Hand a prewarmed sandbox back to the pool when no execution needed it."""
+        if self.execution_backend is not None:
+            self.execution_backend.release_prewarmed()
+
+    def get_sandbox_dfs(self) -> List[SandboxDataFrame]:
+        return [self.get_sandbox_df()] + list(self.tables)
+
+    def referenced_sandbox_dfs(self, code: str) -> List[SandboxDataFrame]:
+        """The dataframe along with the tables the code reads, all tables when that cannot be told."""
+        filenames = referenced_files(code)
+        if filenames is None:
+            return self.get_sandbox_dfs()
+        return [self.get_sandbox_df()] + [table for table in self.tables if table.filename in filenames]
+
+    def get_execution_backend(self) -> ExecutionBackend:
+        if self.execution_backend is None:
+            self.execution_backend = create_execution_backend(self.settings, self.get_sandbox_df(), self.sandbox_pool)
+        return self.execution_backend
+
+    def get_execution_cache(self) -> Optional[ExecutionCache]:
+        if self.execution_cache is None and self.settings.execution_cache_enabled:
+            self.execution_cache = get_execution_cache(self.settings)
+        return self.execution_cache
+
+    def get_fast_path_evaluator(self) -> Optional[FastPathEvaluator]:
+        if self.fast_path_evaluator is None and self.settings.fast_path_enabled:
+            self.fast_path_evaluator = get_fast_path_evaluator(self.settings)
+        return self.fast_path_evaluator
+
+    def get_code_checker(self) -> Optional[CodeChecker]:
+        if self.code_checker is None and self.settings.code_checks_enabled:
+            self.code_checker = CodeChecker(
+                columns=self.df.columns,
+                dataframe_filename=self.get_sandbox_df().filename,
+                available_modules=module_names(AVAILABLE_LIBRARIES),
+                tables={table.filename: table.df.columns for table in self.tables},
+            )
+        return self.code_checker
+
+    def get_legibility_checker(self) -> Optional[LegibilityChecker]:
+        if self.legibility_checker is None and self.settings.legibility_checks_enabled:
+            self.legibility_checker = LegibilityChecker(
+                plot_width=self.settings.validation_image_width,
+                auto_accept=self.settings.legibility_auto_accept,
+            )
+        return self.legibility_checker
+
+    def get_image_store(self) -> ImageStore:
+        if self.image_store is None:
+            self.image_store = ImageStore(
+                max_images=self.settings.image_store_max_images,
+                max_bytes=self.settings.image_store_max_mb * 1024**2,
+            )
+        return self.image_store
+
+    def get_figure_renderer(self) -> FigureRenderer:
+        if self.figure_renderer is None:
+            self.figure_renderer = FigureRenderer(
+                image_format=self.image_format or "png",
+                width=self.image_width or self.settings.validation_image_width,
+                height=self.image_height or self.settings.validation_image_height,
+                scale=self.image_scale,
+            )
+        return self.figure_renderer
+
+    def get_validation_renderer(self) -> FigureRenderer:
+        """Renderer of the images sent to the vision model, independent of the output size."""
+        if self.validation_renderer is None:
+            self.validation_renderer = FigureRenderer(
+                width=self.settings.validation_image_width, height=self.settings.validation_image_height
+            )
+        return self.validation_renderer
+
+    def get_tracer(self) -> Tracer:
+        if self.tracer is None:
+            self.tracer = get_tracer(self.settings)
+        return self.tracer
+
+    def get_scheduler(self) -> RequestScheduler:
+        if self.scheduler is None:
+            self.scheduler = get_scheduler(self.settings)
+        return self.scheduler
+
+    def get_validation_cache(self) -> Optional[ValidationCache]:
+        if self.validation_cache is None and self.settings.validation_cache_enabled:
+            self.validation_cache = get_validation_cache(self.settings)
+        return self.validation_cache
+
+    def _validate_image(self, image_in_bytes: bytes, description: str, code: str, mime_type: str = "image/png") -> str:
+        with self.get_tracer().span("tool.vision_validation", image_bytes=len(image_in_bytes)) as span:
+            image_hash, verdict = self._lookup_validation_cache(image_in_bytes, description)
+            span.set(cache_hit=verdict is not None)
+            if verdict is not None:
+                return verdict
+
+            url, headers, payload = self._image_validation_request(image_in_bytes, description, code, mime_type)
+            response = get_http_session(self.settings).post(url, headers=headers, json=payload)
+            response.raise_for_status()
+            verdict = response.json()["choices"][0]["message"]["content"]
+            span.set(request_bytes=len(response.request.body or b""), **_token_usage(response.json()))
+
+        self._store_validation_verdict(image_hash, description, verdict)
+        return verdict
+
+    async def _avalidate_image(
+        self, image_in_bytes: bytes, description: str, code: str, mime_type: str = "image/png"
+    ) -> str:
+        with self.get_tracer().span("tool.vision_validation", image_bytes=len(image_in_bytes)) as span:
+            image_hash, verdict = self._lookup_validation_cache(image_in_bytes, description)
+            span.set(cache_hit=verdict is not None)
+            if verdict is not None:
+                return verdict
+
+            url, headers, payload = self._image_validation_request(image_in_bytes, description, code, mime_type)
+            response = await get_async_http_client(self.settings).post(url, headers=headers, json=payload)
+            response.raise_for_status()
+            verdict = response.json()["choices"][0]["message"]["content"]
+            span.set(request_bytes=len(response.request.content), **_token_usage(response.json()))
+
+        self._store_validation_verdict(image_hash, description, verdict)
+        return verdict
+
+    def _lookup_validation_cache(self, image_in_bytes: bytes, description: str) -> Tuple[Optional[int], Optional[str]]:
+        validation_cache = self.get_validation_cache()
+        if validation_cache is None:
+            return None, None
+
+        image_hash = perceptual_hash(image_in_bytes)
+        verdict = validation_cache.get(image_hash, description)
+        if verdict is not None:
+            Logger.info(f"Validation cache hit: {validation_cache.stats()}")
+        return image_hash, verdict
+
+    def _store_validation_verdict(self, image_hash: Optional[int], description: str, verdict: str):
+        # a fix such as rotated tick labels barely changes the hash, so a rejection would be served
+        # again for the fixed figure, only acceptances are reused
+        if image_hash is not None and IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE in verdict:
+            self.get_validation_cache().put(image_hash, description, verdict)
+
+    def _image_validation_request(
+        self, image_in_bytes: bytes, description: str, code: str, mime_type: str = "image/png"
+    ):
+        image_in_base64, mime_type = prepare_validation_image(
+            image_in_bytes, mime_type, self.settings.validation_image_max_size
+        )
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.settings.openai_api_key}",
@@ -125,14 +445,12 @@ class CodeValidationTool(BaseTool):
 
         payload = {
             "model": "gpt-4-vision-preview",
-            "messages": generate_validation_llm_messages(image_in_base64, description, code),
+            "messages": generate_validation_llm_messages(image_in_base64, description, code, mime_type),
             "max_tokens": 1000,
             "temperature": self.temperature,
         }
 
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+        return f"{self.settings.openai_api_base}/chat/completions", headers, payload
 
     async def _arun(
         self,
@@ -141,7 +459,30 @@ class CodeValidationTool(BaseTool):
         plotting_code: bool,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
-        """operations of tool are sequential and depend on eachother so no async implmentation."""
-        output = self._run(code, description, plotting_code)
-
-        return output
+        """Use the tool asynchronously. Execution backends are blocking so code runs in a worker
+        thread, image validation uses the shared async HTTP client.
+        """
+
+        with self._tool_span(code, plotting_code) as span:
+            issues = self._check_code(code, plotting_code)
+            if issues:
+                span.set(outcome="static_checks_failed")
+                return format_issues(issues)
+
+            try:
+                async with self.get_scheduler().executions.slot():
+                    code_output = await asyncio.to_thread(self._execute_code, code, plotting_code)
+                if not plotting_code:
+                    span.set(outcome="executed")
+                    return code_output
+            except SandboxExecutionError as e:
+                span.set(outcome="execution_failed")
+                return str(e)
+
+            self._store_figure(code_output, code)
+            verdict = self._check_legibility(code_output)
+            if verdict is None:
+                image_in_bytes, mime_type = await asyncio.to_thread(self._figure_image, code_output)
+                verdict = await self._avalidate_image(image_in_bytes, description, code, mime_type)
+            span.set(outcome="validated")
+            return self._report_plot_prep(verdict, code_output)
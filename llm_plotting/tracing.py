@@ -0,0 +1,271 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+
+import streamlit as st
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from pydantic import BaseModel, Field
+
+from llm_plotting.prompt_helper import count_tokens
+from llm_plotting.settings import Settings
+
+Logger = logging.getLogger(st.__name__)
+
+
+class Span(BaseModel):
+    name: str
+    trace_id: str
+    span_id: str = Field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: Optional[str] = None
+    start: float = Field(default_factory=time.time)
+    end: Optional[float] = None
+    attributes: Dict[str, Any] = {}
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    """Spans of one request, in the order they were started."""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name: str) -> int:
+        with self._lock:
+            return sum(span.name == name for span in self.spans)
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+
+class SpanExporter:
+    def export(self, trace: Trace):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSpanExporter(SpanExporter):
+    """Appends every span of a finished trace to a JSON lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace):
+        lines = "".join(span.model_dump_json() + "\n" for span in trace.spans)
+        with self._lock, open(self.path, "a") as file:
+            file.write(lines)
+
+
+class OpenTelemetrySpanExporter(SpanExporter):
+    """Replays finished traces through an OpenTelemetry tracer, so they reach whichever
+    exporter the OpenTelemetry SDK is configured with, e.g. OTLP.
+    """
+
+    def __init__(self, tracer_name: str = "llm_plotting"):
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("Exporting spans to OpenTelemetry requires `pip install opentelemetry-sdk`") from e
+        self._trace = trace
+        self._tracer = trace.get_tracer(tracer_name)
+
+    def export(self, trace: Trace):
+        otel_spans = {}
+        for span in trace.spans:
+            parent = otel_spans.get(span.parent_id)
+            context = self._trace.set_span_in_context(parent) if parent is not None else None
+            otel_span = self._tracer.start_span(
+                span.name,
+                context=context,
+                start_time=int(span.start * 1e9),
+                attributes={k: v for k, v in span.attributes.items() if isinstance(v, (str, bool, int, float))},
+            )
+            if span.error is not None:
+                otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+            otel_spans[span.span_id] = otel_span
+        for span in trace.spans:
+            otel_spans[span.span_id].end(end_time=int((span.end or span.start) * 1e9))
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Records nested spans around the stages of a request. The current span is kept in a
+    context variable, so spans opened in ``asyncio.to_thread`` workers nest correctly. A span
+    opened outside any trace starts a new one, which is exported when that span ends. The
+    latest finished trace of each session is kept for display.
+    """
+
+    def __init__(self, exporter: Optional[SpanExporter] = None, max_sessions: int = 100):
+        self.exporter = exporter
+        self.max_sessions = max_sessions
+        self._latest_traces: "OrderedDict[str, Trace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, **attributes) -> Span:
+        """Start a span under the current one without making it current, for callbacks which
+        see the start and end of a stage as separate events.
+        """
+        trace, parent = _current_trace.get(), _current_span.get()
+        if trace is None:
+            trace = Trace(uuid.uuid4().hex)
+        span = Span(
+            name=name,
+            trace_id=trace.trace_id,
+            parent_id=parent.span_id if parent is not None else None,
+            attributes=attributes,
+        )
+        trace.add(span)
+        return span
+
+    def end_span(self, span: Span, trace: Optional[Trace] = None, error: Optional[BaseException] = None):
+        span.end = time.time()
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        if span.parent_id is None and trace is not None:
+            self._finish(trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        trace = _current_trace.get()
+        trace_token = None
+        if trace is None:
+            trace = Trace(uuid.uuid4().hex)
+            trace_token = _current_trace.set(trace)
+
+        span = self.start_span(name, **attributes)
+        span_token = _current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(span_token)
+            if trace_token is not None:
+                _current_trace.reset(trace_token)
+            self.end_span(span, trace, error)
+
+    def current_trace(self) -> Optional[Trace]:
+        return _current_trace.get()
+
+    def latest_trace(self, session_id: str) -> Optional[Trace]:
+        with self._lock:
+            return self._latest_traces.get(session_id)
+
+    def _finish(self, trace: Trace):
+        session_id = trace.root.attributes.get("session_id")
+        if session_id is not None:
+            with self._lock:
+                self._latest_traces[session_id] = trace
+                self._latest_traces.move_to_end(session_id)
+                while len(self._latest_traces) > self.max_sessions:
+                    self._latest_traces.popitem(last=False)
+
+        if self.exporter is not None:
+            try:
+                self.exporter.export(trace)
+            except Exception as e:
+                Logger.warning(f"Failed to export trace {trace.trace_id}: {e}")
+
+
+def _message_text(message) -> str:
+    function_call = message.additional_kwargs.get("function_call") or {}
+    return f"{message.content}{function_call.get('arguments', '')}"
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records a span for every chat model call with its token counts. Streaming responses
+    carry no usage, so their counts are computed from the messages instead.
+    """
+
+    # run in the caller's context so spans nest under the span which is current there
+    run_inline = True
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self.spans: Dict[UUID, Span] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id: UUID, **kwargs: Any):
+        trace = self.tracer.current_trace()
+        self.spans[run_id] = self.tracer.start_span(
+            "llm.generate",
+            iteration=trace.count("llm.generate") if trace is not None else 0,
+            model=(kwargs.get("invocation_params") or {}).get("model_name", ""),
+            prompt_messages=sum(len(batch) for batch in messages),
+            prompt_tokens=sum(count_tokens(_message_text(message)) for batch in messages for message in batch),
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        span = self.spans.pop(run_id, None)
+        if span is None:
+            return
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if not token_usage:
+            token_usage = {
+                "completion_tokens": sum(
+                    count_tokens(
+                        _message_text(generation.message) if hasattr(generation, "message") else generation.text
+                    )
+                    for generations in response.generations
+                    for generation in generations
+                )
+            }
+        span.set(**{key: value for key, value in token_usage.items() if isinstance(value, int)})
+        self.tracer.end_span(span)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        span = self.spans.pop(run_id, None)
+        if span is not None:
+            self.tracer.end_span(span, error=error)
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def create_span_exporter(settings: Settings) -> Optional[SpanExporter]:
+    if settings.tracing_exporter == "jsonl":
+        os.makedirs(os.path.dirname(os.path.abspath(settings.tracing_jsonl_path)), exist_ok=True)
+        return JsonlSpanExporter(settings.tracing_jsonl_path)
+    if settings.tracing_exporter == "otel":
+        return OpenTelemetrySpanExporter()
+    return None
+
+
+def get_tracer(settings: Optional[Settings] = None) -> Tracer:
+    """Process wide tracer, the exporter is configured by the first call which passes settings."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+        if _tracer.exporter is None and settings is not None:
+            _tracer.exporter = create_span_exporter(settings)
+    return _tracer
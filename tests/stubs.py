@@ -0,0 +1,186 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from PIL import Image
+
+from llm_plotting.executors import ExecutionBackend, ExecutionResult
+from llm_plotting.prompts import IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE
+
+
+class _VisionStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.record_request(self.client_address)
+        time.sleep(self.server.latency)
+
+        content = self.server.verdict(payload) if callable(self.server.verdict) else self.server.verdict
+        body = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class VisionStubServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI chat completions endpoint used for image validation. Every
+    request is answered with ``verdict`` after ``latency`` seconds, ``verdict`` can also be a
+    function of the request payload.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        verdict: Union[str, Callable[[Dict], str]] = IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE,
+        latency: float = 0.0,
+    ):
+        super().__init__(("127.0.0.1", 0), _VisionStubHandler)
+        self.verdict = verdict
+        self.latency = latency
+        self.requests_received = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+    def record_request(self, client_address):
+        with self._lock:
+            self.requests_received += 1
+            self.connections.add(client_address)
+
+    def start(self) -> "VisionStubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def tool_call_message(code: str, description: str = "plot", plotting_code: bool = True) -> AIMessage:
+    arguments = json.dumps({"code": code, "description": description, "plotting_code": plotting_code})
+    return AIMessage(
+        content="", additional_kwargs={"function_call": {"name": "CodeValidationTool", "arguments": arguments}}
+    )
+
+
+def _pieces(text: str, size: int) -> Iterator[str]:
+    for start in range(0, len(text), size):
+        end = start + size
+        yield text[start:end]
+
+
+def message_chunks(message: BaseMessage, chunk_size: int) -> Iterator[ChatGenerationChunk]:
+    """The message split like a streamed response: a function call sends its name first and
+    then its arguments in pieces of ``chunk_size`` characters.
+    """
+    function_call = message.additional_kwargs.get("function_call")
+    if function_call is None:
+        for piece in _pieces(message.content, chunk_size):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        return
+
+    yield ChatGenerationChunk(
+        message=AIMessageChunk(
+            content="", additional_kwargs={"function_call": {"name": function_call["name"], "arguments": ""}}
+        )
+    )
+    for piece in _pieces(function_call["arguments"], chunk_size):
+        yield ChatGenerationChunk(
+            message=AIMessageChunk(content="", additional_kwargs={"function_call": {"arguments": piece}})
+        )
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Offline chat model which answers each call with the next scripted message, e.g. from
+    ``tool_call_message``. The last message is repeated once the script runs out. With
+    ``stream_chunk_size`` set, streamed calls send the message in pieces of that many characters,
+    ``stream_chunk_delay`` seconds apart, like a streaming API.
+    """
+
+    responses: List[BaseMessage]
+    latency: float = 0.0
+    calls: int = 0
+    stream_chunk_size: Optional[int] = None
+    stream_chunk_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        with _scripted_chat_model_lock:
+            response = self.responses[min(self.calls, len(self.responses) - 1)]
+            self.calls += 1
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        result = await self._agenerate(messages, stop=stop, **kwargs)
+        message = result.generations[0].message
+        if self.stream_chunk_size is None:
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content=message.content, additional_kwargs=message.additional_kwargs)
+            )
+            return
+        for chunk in message_chunks(message, self.stream_chunk_size):
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(self.stream_chunk_delay)
+
+
+_scripted_chat_model_lock = threading.Lock()
+
+
+class CountingBackend(ExecutionBackend):
+    def __init__(self):
+        self.calls = 0
+
+    def execute(self, code, sandbox_dfs, plotting_code):
+        self.calls += 1
+        return ExecutionResult(stdout=str(self.calls))
+
+
+class StaticImageBackend(ExecutionBackend):
+    def execute(self, code, sandbox_dfs, plotting_code):
+        image = Image.new("RGB", (64, 64), "white")
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        return ExecutionResult(image=buffer.getvalue())
@@ -0,0 +1,157 @@
+import json
+
+import pandas as pd
+import pytest
+import pytest_asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from langchain_core.messages import AIMessage
+
+from llm_plotting.api import AGENT_SETTINGS_LIMITS, AgentService, create_app
+from llm_plotting.dataset import ingest_csv
+from llm_plotting.executors import ExecutionBackend
+from llm_plotting.rendering import PLOTLY_JSON_MIME_TYPE
+from llm_plotting.scheduler import RequestScheduler
+from llm_plotting.settings import AgentSettings, Settings
+from tests.stubs import ScriptedChatModel, tool_call_message
+
+
+class ClosingBackend(ExecutionBackend):
+    def __init__(self):
+        self.closed = False
+
+    def execute(self, code, sandbox_dfs, plotting_code):
+        raise NotImplementedError
+
+    def close(self):
+        self.closed = True
+
+
+PLOTTING_CODE = "\n".join(
+    [
+        "import pandas as pd",
+        "import plotly.express as px",
+        "df = pd.read_parquet('df.parquet')",
+        "fig = px.bar(df, x='job_title', y='salary', title='Salaries')",
+        "fig.update_layout(xaxis_title='job title', yaxis_title='salary')",
+    ]
+)
+
+
+def parse_events(body: str):
+    events = []
+    for message in body.strip().split("\n\n"):
+        event, data = message.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+@pytest_asyncio.fixture
+async def client(tmp_path, vision_stub_server):
+    settings = Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        openai_api_base=vision_stub_server.api_base,
+        execution_backend="local",
+        execution_cache_enabled=False,
+        validation_cache_enabled=False,
+        api_dataset_dir=str(tmp_path / "datasets"),
+    )
+    scheduler = RequestScheduler(session_check_interval=0)
+    service = AgentService(
+        settings,
+        scheduler=scheduler,
+        llm_factory=lambda: ScriptedChatModel(
+            responses=[tool_call_message(PLOTTING_CODE, "salaries"), AIMessage(content="Here are the salaries.")]
+        ),
+    )
+    async with TestClient(TestServer(create_app(service))) as client:
+        yield client
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_upload_and_stream_answer(client):
+    csv = pd.DataFrame({"job_title": ["a", "b"], "salary": [1.0, 2.0]}).to_csv(index=False)
+    response = await client.post("/datasets", data=csv.encode("utf-8"))
+    assert response.status == 200
+    upload = await response.json()
+    assert upload["rows"] == 2 and upload["columns"] == ["job_title", "salary"]
+
+    response = await client.post(f"/datasets/{upload['fingerprint']}/questions", json={"question": "plot salaries"})
+    assert response.headers["Content-Type"] == "text/event-stream"
+    events = parse_events(await response.text())
+
+    assert [event for event, _ in events] == ["action", "observation", "image", "answer", "done"]
+    assert events[0][1]["code"] == PLOTTING_CODE
+    assert events[2][1]["mime_type"] == PLOTLY_JSON_MIME_TYPE
+    assert events[2][1]["handle"] == events[1][1]["figure_handle"]
+    assert events[3][1]["text"] == "Here are the salaries."
+
+
+@pytest.mark.asyncio
+async def test_unknown_dataset_and_bad_requests(client):
+    response = await client.post(f"/datasets/{'0' * 64}/questions", json={"question": "plot"})
+    assert response.status == 404
+    response = await client.post("/datasets/../../etc/questions", json={"question": "plot"})
+    assert response.status == 404
+    response = await client.post(f"/datasets/{'0' * 64}/questions", json={"no_question": True})
+    assert response.status == 400
+
+
+@pytest.mark.asyncio
+async def test_agent_settings_are_clamped(client):
+    csv = pd.DataFrame({"salary": [1.0, 2.0]}).to_csv(index=False)
+    upload = await (await client.post("/datasets", data=csv.encode("utf-8"))).json()
+    requested = []
+
+    async def answer(dataset, question, agent_settings):
+        requested.append(agent_settings)
+        yield b""
+
+    client.server.app["service"].answer = answer
+    agent_settings = {
+        "max_iterations": 1000,
+        "num_candidates": 1000,
+        "max_parallel_candidates": 0,
+        "candidate_llm_temperature": 50,
+        "image_width": 10**6,
+        "image_scale": 100,
+    }
+    for settings in [agent_settings, {}]:
+        response = await client.post(
+            f"/datasets/{upload['fingerprint']}/questions", json={"question": "plot", "agent_settings": settings}
+        )
+        assert response.status == 200
+
+    assert requested[0].max_iterations == 10
+    assert requested[0].num_candidates == 4
+    assert requested[0].max_parallel_candidates == 1
+    assert requested[0].candidate_llm_temperature == 2.0
+    assert requested[0].image_width == 2000 and requested[0].image_scale == 2.0
+    assert requested[1] == AgentSettings()
+    # every number a client can set is bounded
+    numeric_fields = {
+        name
+        for name, value in AgentSettings(image_width=1, image_height=1, image_scale=1).model_dump().items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+    assert numeric_fields == set(AGENT_SETTINGS_LIMITS)
+
+
+def test_AgentService_closes_evicted_backends_once_unused(settings, monkeypatch):
+    monkeypatch.setattr("llm_plotting.api.create_execution_backend", lambda settings, sandbox_df: ClosingBackend())
+    service = AgentService(settings, scheduler=RequestScheduler(session_check_interval=0), max_backends=1)
+    first, second = ingest_csv(b"salary\n1\n"), ingest_csv(b"salary\n2\n")
+
+    with service.execution_backend(first) as first_backend:
+        with service.execution_backend(second) as second_backend:
+            # the request about the first dataset is still running
+            assert not first_backend.closed
+        assert not second_backend.closed
+    assert first_backend.closed
+
+    with service.execution_backend(second) as backend:
+        assert backend is second_backend
+    service.close()
+    assert second_backend.closed
+    service.scheduler.close()
@@ -0,0 +1,107 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+
+from llm_plotting.batch import BatchRunner, read_jobs
+from llm_plotting.settings import AgentSettings, Settings
+from tests.stubs import ScriptedChatModel, VisionStubServer, tool_call_message
+
+
+def scripted_llm(job):
+    code = "\n".join(
+        [
+            "import pandas as pd",
+            "import plotly.express as px",
+            "df = pd.read_parquet('df.parquet')",
+            "fig = px.bar(df, x='job_title', y='salary', title=f'{len(df)} jobs')",
+            "fig.update_layout(xaxis_title='job title', yaxis_title='salary')",
+        ]
+    )
+    return ScriptedChatModel(responses=[tool_call_message(code, "salaries"), AIMessage(content=f"answer {job.id}")])
+
+
+@pytest.fixture
+def jobs_file(tmp_path):
+    dataset = tmp_path / "salaries.csv"
+    pd.DataFrame({"job_title": ["a", "b", "c"], "salary": [1.0, 2.0, 3.0]}).to_csv(dataset, index=False)
+    jobs_file = tmp_path / "jobs.jsonl"
+    jobs_file.write_text(
+        "\n".join(
+            json.dumps({"id": f"job-{i}", "dataset": str(dataset), "question": "plot salaries"}) for i in range(3)
+        )
+    )
+    return str(jobs_file)
+
+
+@pytest.fixture
+def runner_factory(tmp_path):
+    server = VisionStubServer().start()
+    settings = Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        openai_api_base=server.api_base,
+        execution_backend="local",
+        execution_cache_enabled=False,
+        validation_cache_enabled=False,
+    )
+    yield lambda: BatchRunner(
+        settings, AgentSettings(max_iterations=2), str(tmp_path / "out"), concurrency=2, llm_factory=scripted_llm
+    )
+    server.stop()
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_writes_results_and_shares_datasets(jobs_file, runner_factory):
+    runner = runner_factory()
+    results = await runner.run(read_jobs(jobs_file))
+
+    assert [result.status for result in results] == ["done"] * 3
+    assert [result.answer for result in results] == ["answer job-0", "answer job-1", "answer job-2"]
+    assert "px.bar" in results[0].code
+    assert results[0].timings["tool.call"] > 0
+    assert len(runner._datasets) == 1
+    for result in results:
+        assert result.figure_files
+        for filename in result.figure_files:
+            assert os.path.getsize(os.path.join(runner.output_dir, result.id, filename)) > 0
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_resumes_unfinished_jobs(jobs_file, runner_factory):
+    jobs = read_jobs(jobs_file)
+    await runner_factory().run(jobs[:1])
+
+    runner = runner_factory()
+    llm_calls = []
+    llm_factory = runner.llm_factory
+    runner.llm_factory = lambda job: llm_calls.append(job.id) or llm_factory(job)
+    results = await runner.run(jobs)
+
+    assert llm_calls == ["job-1", "job-2"]
+    assert [result.status for result in results] == ["done"] * 3
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_fails_jobs_without_accepted_figure(jobs_file, runner_factory):
+    jobs = read_jobs(jobs_file)[:2]
+    broken_code = "import pandas as pd\nprint(undefined_name)"
+    broken_llms = {
+        # keeps calling the tool with broken code until it runs out of iterations
+        "job-0": ScriptedChatModel(responses=[tool_call_message(broken_code, "salaries")]),
+        "job-1": ScriptedChatModel(responses=[AIMessage(content="I would rather not plot this.")]),
+    }
+    runner = runner_factory()
+    runner.llm_factory = lambda job: broken_llms[job.id]
+    results = await runner.run(jobs)
+
+    assert [result.status for result in results] == ["failed", "failed"]
+    assert results[0].error.startswith("Stopped after 2 iterations")
+    assert results[1].error == "No plotting code was accepted"
+
+    runner = runner_factory()
+    runner.retry_failed = True
+    results = await runner.run(jobs)
+    assert [result.status for result in results] == ["done", "done"]
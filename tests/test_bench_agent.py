@@ -0,0 +1,16 @@
+import pytest
+
+from benchmarks.bench_agent import run_scenario
+
+
+@pytest.mark.asyncio
+async def test_run_scenario_drives_sessions_offline():
+    result = await run_scenario(n_rows=200, iterations=2, sessions=2)
+
+    assert result["completed_sessions"] == 2
+    assert result["vision_requests"] == 4
+    assert result["stages"]["request"]["count"] == 2
+    assert result["stages"]["tool.execute"]["count"] == 4
+    assert result["stages"]["sandbox.run"]["count"] == 4
+    assert result["stages"]["llm.generate"]["count"] == 6
+    assert result["requests_per_s"] > 0
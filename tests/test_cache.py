@@ -0,0 +1,223 @@
+import os
+from io import BytesIO
+
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+from PIL import Image, ImageDraw
+
+from llm_plotting.cache import (
+    AnswerCache,
+    CachedAnswer,
+    ExecutionCache,
+    ValidationCache,
+    execution_cache_key,
+    normalise_question,
+    perceptual_hash,
+)
+from llm_plotting.dataset import ingest_csv
+from llm_plotting.executors import ExecutionResult
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.streamlit_helper import STAgentInterface
+from llm_plotting.tools import CodeValidationTool
+from tests.stubs import CountingBackend, ScriptedChatModel, tool_call_message
+
+
+def draw_bar_chart(heights, title_width=40):
+    image = Image.new("RGB", (400, 300), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([150, 10, 150 + title_width, 20], fill="black")
+    for i, height in enumerate(heights):
+        draw.rectangle([40 + i * 60, 280 - height, 80 + i * 60, 280], fill="blue")
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_execution_cache_key_ignores_formatting():
+    code = "x = df['salary'].mean()\nprint(x)"
+    reformatted = "# average salary\nx = df[ 'salary' ].mean()\n\nprint( x )\n"
+
+    assert execution_cache_key(code, False, "abc") == execution_cache_key(reformatted, False, "abc")
+    assert execution_cache_key(code, False, "abc") != execution_cache_key(code, True, "abc")
+    assert execution_cache_key(code, False, "abc") != execution_cache_key(code, False, "def")
+
+
+def test_ExecutionCache_lru_byte_budget():
+    execution_cache = ExecutionCache(max_bytes=10)
+    execution_cache.put("a", ExecutionResult(stdout="aaaa"))
+    execution_cache.put("b", ExecutionResult(stdout="bbbb"))
+    execution_cache.get("a")
+    execution_cache.put("c", ExecutionResult(stdout="cccc"))
+
+    assert execution_cache.get("b") is None
+    assert execution_cache.get("a").stdout == "aaaa"
+    assert execution_cache.size_bytes == 8
+    assert execution_cache.stats()["hits"] == 2
+    assert execution_cache.stats()["misses"] == 1
+
+    execution_cache.put("failed", ExecutionResult(stderr="error", exit_code=1))
+    assert execution_cache.get("failed") is None
+
+
+def test_ExecutionCache_disk_tier(tmp_path):
+    ExecutionCache(disk_dir=str(tmp_path)).put("key", ExecutionResult(image=b"\x89PNG"))
+
+    restarted_cache = ExecutionCache(disk_dir=str(tmp_path))
+
+    assert restarted_cache.get("key").image == b"\x89PNG"
+
+
+def test_ExecutionCache_disk_tier_evicts_least_recently_used(tmp_path):
+    result = ExecutionResult(stdout="x" * 1000)
+    execution_cache = ExecutionCache(max_bytes=2500, disk_dir=str(tmp_path))
+    execution_cache.put("a", result)
+    execution_cache.put("b", result)
+    execution_cache.clear()
+    assert execution_cache.get("a") is not None
+    execution_cache.put("c", result)
+
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+    assert sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)) <= 2500
+
+    # the budget also applies to the files left by an earlier run with a larger one
+    ExecutionCache(max_bytes=1500, disk_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == ["c.json"]
+
+
+def test_CodeValidationTool_uses_execution_cache(settings):
+    settings.fast_path_enabled = False
+    backend = CountingBackend()
+    code_validation_tool = CodeValidationTool(
+        settings=settings,
+        df=pd.DataFrame({"salary": [1, 2]}),
+        execution_backend=backend,
+        execution_cache=ExecutionCache(),
+    )
+
+    assert code_validation_tool._execute_code("print(1)", plotting_code=False) == "1"
+    assert code_validation_tool._execute_code("print( 1 )  # again", plotting_code=False) == "1"
+    assert backend.calls == 1
+
+
+def test_ValidationCache_matches_similar_images():
+    validation_cache = ValidationCache(max_distance=4)
+    image_hash = perceptual_hash(draw_bar_chart([100, 200, 50, 150]))
+    validation_cache.put(image_hash, "Average salary per job", "The plot is legible")
+
+    retitled_hash = perceptual_hash(draw_bar_chart([100, 200, 50, 150], title_width=44))
+    different_hash = perceptual_hash(draw_bar_chart([200, 50, 150, 100]))
+
+    assert validation_cache.get(retitled_hash, "average salary  per job") == "The plot is legible"
+    assert validation_cache.get(different_hash, "Average salary per job") is None
+    assert validation_cache.get(image_hash, "Median salary per job") is None
+    assert validation_cache.stats()["hits"] == 1
+
+    validation_cache.ttl = 0.0
+    assert validation_cache.get(image_hash, "Average salary per job") is None
+    assert validation_cache.stats()["expired"] == 1
+
+
+def test_CodeValidationTool_skips_vision_call_for_validated_image(vision_stub_server):
+    settings = Settings(openai_api_key="key", e2b_api_key="key", openai_api_base=vision_stub_server.api_base)
+    code_validation_tool = CodeValidationTool(settings=settings, validation_cache=ValidationCache())
+    image_in_bytes = draw_bar_chart([100, 200, 50, 150])
+
+    for _ in range(2):
+        verdict = code_validation_tool._validate_image(image_in_bytes, "Average salary per job", "code")
+        assert verdict == "The plot is legible"
+
+    assert vision_stub_server.requests_received == 1
+
+
+def test_CodeValidationTool_does_not_reuse_rejections(vision_stub_server):
+    vision_stub_server.verdict = "The tick labels overlap, rotate them"
+    settings = Settings(openai_api_key="key", e2b_api_key="key", openai_api_base=vision_stub_server.api_base)
+    validation_cache = ValidationCache()
+    code_validation_tool = CodeValidationTool(settings=settings, validation_cache=validation_cache)
+
+    for title_width in [40, 44]:
+        code_validation_tool._validate_image(draw_bar_chart([100, 200, 50, 150], title_width), "Salaries", "code")
+
+    assert vision_stub_server.requests_received == 2
+    assert validation_cache.stats()["entries"] == 0
+
+
+def test_AnswerCache_normalises_questions_and_invalidates_per_dataset():
+    assert normalise_question("Plot the average salary of the top 20 jobs!") == normalise_question(
+        "plot the  Average salary\nof the top 20 jobs"
+    )
+    assert normalise_question("top 20 jobs") != normalise_question("top 10 jobs")
+    assert normalise_question("plot salary > 100000") != normalise_question("plot salary < 100000")
+    assert normalise_question("plot salary >= 100000") != normalise_question("plot salary = 100000")
+    assert normalise_question("plot salary, not bonus") != normalise_question("plot salary not bonus")
+    assert normalise_question("can you plot it for me") != normalise_question("plot it")
+
+    answer_cache = AnswerCache(max_entries=2)
+    answer = CachedAnswer(code="print(1)", description="", plotting_code=False, observation="1", answer="one")
+    answer_cache.put("df-a", "How many rows?", answer)
+    answer_cache.put("df-a", "How many columns?", answer)
+    answer_cache.put("df-b", "How many rows?", answer)
+
+    assert answer_cache.get("df-a", "how many rows") is None
+    assert answer_cache.get("df-b", "how many rows") == answer
+    assert answer_cache.invalidate("df-a") == 1
+    assert answer_cache.get("df-a", "How many columns?") is None
+    assert answer_cache.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "hit_rate": 0.3333,
+        "invalidated": 1,
+        "entries": 1,
+        "bytes": answer.size,
+    }
+
+
+@pytest.mark.asyncio
+async def test_STAgentInterface_replays_cached_answer(vision_stub_server):
+    settings = Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        openai_api_base=vision_stub_server.api_base,
+        execution_backend="local",
+        execution_cache_enabled=False,
+        validation_cache_enabled=False,
+        answer_cache_verify=True,
+    )
+    dataset = ingest_csv(b"job_title,salary\na,1.0\nb,2.0\n")
+    code = "\n".join(
+        [
+            "import pandas as pd",
+            "import plotly.express as px",
+            dataset.sandbox_df.load_code,
+            "fig = px.bar(df, x='job_title', y='salary', title='Salaries')",
+            "fig.update_layout(xaxis_title='job title', yaxis_title='salary')",
+        ]
+    )
+    answer_cache = AnswerCache()
+
+    def make_interface():
+        llm = ScriptedChatModel(responses=[tool_call_message(code), AIMessage(content="Here are the salaries.")])
+        st_agent_interface = STAgentInterface(
+            settings, AgentSettings(), dataset, execute_st_funcs=False, llm=llm, answer_cache=answer_cache
+        )
+        return llm, st_agent_interface
+
+    llm, st_agent_interface = make_interface()
+    try:
+        await st_agent_interface.invoke("Plot the salaries")
+    finally:
+        st_agent_interface.code_validation_tool.get_execution_backend().close()
+
+    llm, st_agent_interface = make_interface()
+    try:
+        chunks = await st_agent_interface.invoke("plot the  salaries?")
+    finally:
+        st_agent_interface.code_validation_tool.get_execution_backend().close()
+
+    assert llm.calls == 0
+    assert chunks[0]["chunk"] == {"output": "Here are the salaries.", "cached": True}
+    assert st_agent_interface.code_validation_tool.get_image_store().latest_handle_for(code) is not None
+    assert st_agent_interface.latest_trace.count("answer_cache.verify") == 1
+    assert answer_cache.stats()["hits"] == 1
@@ -0,0 +1,133 @@
+import pandas as pd
+import pytest
+
+from llm_plotting.code_checks import CodeChecker, module_names, referenced_files
+from llm_plotting.prompts import AVAILABLE_LIBRARIES
+from llm_plotting.tools import CodeValidationTool
+from tests.stubs import CountingBackend
+
+
+@pytest.fixture
+def code_checker():
+    return CodeChecker(
+        columns=["job_title", "salary_in_usd"],
+        dataframe_filename="df.parquet",
+        available_modules=module_names(AVAILABLE_LIBRARIES),
+    )
+
+
+def checks_failed(code_checker, code, plotting_code=True):
+    return [issue.check for issue in code_checker.check(code, plotting_code)]
+
+
+def test_CodeChecker_accepts_valid_code(code_checker):
+    code = (
+        "import json\n"
+        "import pandas as pd\n"
+        "import plotly.express as px\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "df['salary_k'] = df['salary_in_usd'] / 1000\n"
+        "avg = df.groupby('job_title', as_index=False).agg(mean_salary=('salary_k', 'mean'))\n"
+        "counts = df['job_title'].value_counts().reset_index(name='count')\n"
+        "fig = px.bar(avg, x='job_title', y='mean_salary')\n"
+        "fig.update_layout(title=df.columns[0])"
+    )
+
+    assert checks_failed(code_checker, code) == []
+    assert code_checker.stats() == {"checks_run": 1, "sandbox_calls_saved": 0}
+
+
+@pytest.mark.parametrize(
+    "code, plotting_code, expected",
+    [
+        ("fig = px.bar(df, x='job_title'", True, ["syntax"]),
+        ("import seaborn as sns\nfig = sns.barplot()", True, ["import"]),
+        ("import pandas as pd\ndf = pd.read_csv('df.csv')\nprint(len(df))", False, ["data_file"]),
+        ("import pandas as pd\ndf = pd.read_parquet('df.parquet')\nprint(df['salary'].mean())", False, ["column"]),
+        (
+            "import pandas as pd\nimport plotly.express as px\ndf = pd.read_parquet('df.parquet')\n"
+            "figure = px.bar(df, x='job_title', y='salary_in_usd')",
+            True,
+            ["figure"],
+        ),
+    ],
+)
+def test_CodeChecker_rejects_common_mistakes(code_checker, code, plotting_code, expected):
+    assert checks_failed(code_checker, code, plotting_code) == expected
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        "df.columns = df.columns.str.upper()",
+        "df.columns.values[1] = 'SALARY'",
+        "df.rename(columns={'salary_in_usd': 'SALARY'}, inplace=True)",
+        "df.set_axis(['job', 'SALARY'], axis=1, inplace=True)",
+        "df = df.set_axis(['job', 'SALARY'], axis=1)",
+    ],
+)
+def test_CodeChecker_skips_columns_of_changed_frames(code_checker, change):
+    code = f"import pandas as pd\ndf = pd.read_parquet('df.parquet')\n{change}\nprint(df['SALARY'].mean())"
+
+    assert checks_failed(code_checker, code, plotting_code=False) == []
+
+
+def test_CodeChecker_suggests_close_column_names(code_checker):
+    code = (
+        "import pandas as pd\n"
+        "import plotly.express as px\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "fig = px.bar(df, x='jobtitle')"
+    )
+
+    (issue,) = code_checker.check(code, plotting_code=True)
+
+    assert issue.line == 4
+    assert "`job_title`" in issue.message
+
+
+def test_CodeValidationTool_skips_sandbox_for_rejected_code(settings):
+    backend = CountingBackend()
+    code_validation_tool = CodeValidationTool(settings=settings, df=pd.DataFrame({"a": [1]}), execution_backend=backend)
+
+    output = code_validation_tool._run("print(df['b'']", description="b", plotting_code=False)
+
+    assert output.startswith("The code was not executed")
+    assert "syntax error" in output
+    assert backend.calls == 0
+    assert code_validation_tool.get_code_checker().stats()["sandbox_calls_saved"] == 1
+
+
+def test_referenced_files():
+    code = (
+        "import pandas as pd\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "companies = pd.read_parquet(path='companies.parquet')\n"
+        "print(df.merge(companies, on='company_id'))"
+    )
+
+    assert referenced_files(code) == {"df.parquet", "companies.parquet"}
+    assert referenced_files("print(1)") == set()
+    assert referenced_files("import pandas as pd\nname = 'df.parquet'\ndf = pd.read_parquet(name)") is None
+    assert referenced_files("print(df['b'']") is None
+
+
+def test_CodeChecker_checks_columns_per_table():
+    code_checker = CodeChecker(
+        columns=["company_id", "salary"],
+        dataframe_filename="df.parquet",
+        available_modules=module_names(AVAILABLE_LIBRARIES),
+        tables={"companies.parquet": ["company_id", "company_name"]},
+    )
+    code = (
+        "import pandas as pd\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "companies = pd.read_parquet('companies.parquet')\n"
+        "print(companies['company_name'].nunique(), df['salary'].sum())"
+    )
+    assert checks_failed(code_checker, code, plotting_code=False) == []
+
+    code = code.replace("companies['company_name']", "companies['salary']")
+    (issue,) = code_checker.check(code, plotting_code=False)
+    assert issue.check == "column"
+    assert issue.line == 4
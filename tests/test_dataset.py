@@ -0,0 +1,123 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+from llm_plotting import dataset
+from llm_plotting.dataset import SandboxDataFrame, downcast_dataframe, fingerprint_dataframe, ingest_csv
+from llm_plotting.sandbox import LocalSandbox, SandboxPool
+from llm_plotting.tools import CodeValidationTool
+
+
+def test_fingerprint_dataframe():
+    df = pd.DataFrame({"job_title": ["a", "b"], "salary": [1, 2]})
+
+    assert fingerprint_dataframe(df) == fingerprint_dataframe(df.copy())
+    assert fingerprint_dataframe(df) != fingerprint_dataframe(df.assign(salary=[1, 3]))
+    assert fingerprint_dataframe(df) != fingerprint_dataframe(df.rename(columns={"salary": "pay"}))
+
+
+def test_SandboxDataFrame_serialisation():
+    sandbox_df = SandboxDataFrame(pd.DataFrame({"salary": [1, 2]}))
+    assert sandbox_df.filename == "df.parquet"
+    assert sandbox_df.load_code == "df = pd.read_parquet('df.parquet')"
+
+    unserialisable_df = SandboxDataFrame(pd.DataFrame({"mixed": [1, "a"]}))
+    assert unserialisable_df.filename == "df.csv"
+    assert unserialisable_df.load_code == "df = pd.read_csv('df.csv')"
+
+
+def test_CodeValidationTool_uploads_df_once_per_sandbox(settings):
+    settings.fast_path_enabled = False
+    uploads = []
+
+    class CountingSandbox(LocalSandbox):
+        def upload_file(self, file, timeout=None):
+            uploads.append(file.name)
+            return super().upload_file(file, timeout)
+
+    sandbox_pool = SandboxPool(sandbox_factory=CountingSandbox, size=1)
+    code_validation_tool = CodeValidationTool(
+        settings=settings,
+        df=pd.DataFrame({"salary": [1, 2, 3]}),
+        sandbox_pool=sandbox_pool,
+    )
+
+    for _ in range(2):
+        output = code_validation_tool._execute_code("print(1)", plotting_code=False)
+        assert output == "1"
+    assert uploads == ["df.parquet"]
+
+    code_validation_tool.df = pd.DataFrame({"salary": [4]})
+    code_validation_tool._execute_code("print(1)", plotting_code=False)
+    assert uploads == ["df.parquet", "df.parquet"]
+    sandbox_pool.close()
+
+
+def test_downcast_dataframe():
+    df = pd.DataFrame(
+        {
+            "work_year": [2020, 2021, 2022, 2023],
+            "salary": [1.5, 2.25, None, 3.0],
+            "salary_exact": [0.1, 0.2, 0.3, 0.4],
+            "job_title": ["analyst", "analyst", "engineer", "analyst"],
+            "job_id": ["a", "b", "c", "d"],
+        }
+    )
+
+    downcast = downcast_dataframe(df)
+
+    assert downcast.dtypes.astype(str).to_dict() == {
+        "work_year": "int16",
+        "salary": "float32",
+        "salary_exact": "float64",
+        "job_title": "category",
+        "job_id": "object",
+    }
+    pd.testing.assert_frame_equal(downcast.astype(df.dtypes), df)
+
+
+def test_ingest_csv_parses_once_and_shares_frame(df):
+    csv_buffer = BytesIO()
+    df.to_csv(csv_buffer, index=False)
+    csv_bytes = csv_buffer.getvalue()
+
+    ingested = ingest_csv(csv_bytes)
+
+    assert ingest_csv(BytesIO(csv_bytes)) is ingested
+    assert ingested.memory_report["downcast_mb"] < ingested.memory_report["parsed_mb"]
+    assert len(ingested.df) == len(df)
+    assert pd.read_parquet(BytesIO(ingested.sandbox_df.payload)).dtypes.equals(df.dtypes)
+
+
+def test_ingest_csv_shares_frame_read_only():
+    ingested = ingest_csv(b"job_title,salary,rate\n" + b"analyst,1000,0.5\nengineer,2000,1.5\n" * 50)
+    df = ingested.df
+    assert df.dtypes.astype(str).tolist() == ["category", "int16", "float32"]
+
+    for column, value in [("job_title", "engineer"), ("salary", 0), ("rate", 0.0)]:
+        with pytest.raises(ValueError, match="read-only"):
+            df.loc[0, column] = value
+    with pytest.raises(ValueError, match="read-only"):
+        df["salary"] += 1
+    derived = df.assign(salary_k=df["salary"] / 1000)
+    derived.loc[0, "salary"] = 0
+
+    assert df["salary"].tolist()[:2] == [1000, 2000] and "salary_k" not in df
+    assert not pd.get_option("mode.copy_on_write")
+
+
+def test_ingest_csv_chunked_fallback(monkeypatch):
+    read_csv = pd.read_csv
+
+    def read_csv_without_pyarrow(*args, engine=None, **kwargs):
+        if engine == "pyarrow":
+            raise ImportError("pyarrow is not installed")
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(dataset.pd, "read_csv", read_csv_without_pyarrow)
+
+    ingested = ingest_csv(b"job_title,salary\nanalyst,1\nanalyst,2\nengineer,3\nanalyst,4\n", chunk_size=3)
+
+    assert ingested.df["salary"].tolist() == [1, 2, 3, 4]
+    assert ingested.df.dtypes.astype(str).to_dict() == {"job_title": "category", "salary": "int8"}
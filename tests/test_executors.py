@@ -0,0 +1,121 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from llm_plotting.dataset import SandboxDataFrame
+from llm_plotting.executors import LocalProcessExecutionBackend
+from llm_plotting.tools import CodeValidationTool
+
+
+@pytest.fixture(scope="module")
+def sandbox_df():
+    return SandboxDataFrame(pd.DataFrame({"job_title": ["a", "b", "a"], "salary": [1, 2, 3]}))
+
+
+@pytest.fixture(scope="module")
+def local_backend(sandbox_df):
+    backend = LocalProcessExecutionBackend(sandbox_df, workers=1, timeout=20.0)
+    yield backend
+    backend.close()
+
+
+def test_LocalProcessExecutionBackend_stdout_and_errors(local_backend, sandbox_df):
+    result = local_backend.execute(
+        "import pandas as pd\ndf = pd.read_parquet('df.parquet')\nprint(df['salary'].sum())",
+        [sandbox_df],
+        plotting_code=False,
+    )
+    assert result.exit_code == 0
+    assert result.stdout == "6"
+
+    result = local_backend.execute("raise ValueError('bad code')", [sandbox_df], plotting_code=False)
+    assert result.exit_code == 1
+    assert "ValueError: bad code" in result.stderr
+
+
+def test_LocalProcessExecutionBackend_plotting(settings, local_backend, sandbox_df):
+    code_validation_tool = CodeValidationTool(
+        settings=settings,
+        df=sandbox_df.df,
+        sandbox_df=sandbox_df,
+        execution_backend=local_backend,
+    )
+    code = (
+        "import pandas as pd\n"
+        "import plotly.express as px\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "fig = px.bar(df, x='job_title', y='salary')"
+    )
+
+    result = local_backend.execute(code_validation_tool._modify_code(code), [sandbox_df], plotting_code=True)
+
+    assert result.exit_code == 0
+    assert result.image is None
+    assert json.loads(result.figure_json)["data"][0]["type"] == "bar"
+
+
+def test_LocalProcessExecutionBackend_loads_tables_lazily(local_backend, sandbox_df):
+    companies = SandboxDataFrame(pd.DataFrame({"job_title": ["a", "b"], "company": ["x", "y"]}), file_stem="companies")
+    code = (
+        "import pandas as pd\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        "companies = pd.read_parquet('companies.parquet')\n"
+        "print(len(df.merge(companies, on='job_title')))"
+    )
+
+    result = local_backend.execute(code, [sandbox_df, companies], plotting_code=False)
+    assert result.exit_code == 0
+    assert result.stdout == "3"
+
+    result = local_backend.execute(code, [sandbox_df], plotting_code=False)
+    assert result.exit_code == 0, "tables written once stay available to the worker"
+
+
+def test_LocalProcessExecutionBackend_timeout(sandbox_df):
+    backend = LocalProcessExecutionBackend(sandbox_df, workers=1, timeout=3.0)
+
+    result = backend.execute("while True:\n    pass", [sandbox_df], plotting_code=False)
+    assert result.exit_code == 1
+    assert "timed out" in result.stderr
+
+    result = backend.execute("print('recovered')", [sandbox_df], plotting_code=False)
+    assert result.stdout == "recovered"
+    backend.close()
+
+
+def test_LocalProcessExecutionBackend_cpu_time_limit(sandbox_df):
+    backend = LocalProcessExecutionBackend(sandbox_df, workers=1, cpu_time_limit=1, timeout=30.0)
+
+    result = backend.execute("while True:\n    pass", [sandbox_df], plotting_code=False)
+
+    assert result.exit_code == 1
+    assert "CPUTimeLimitExceeded" in result.stderr
+    backend.close()
+
+
+def test_LocalProcessExecutionBackend_hides_app_environment(sandbox_df, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "secret-key")
+    backend = LocalProcessExecutionBackend(sandbox_df, workers=1, timeout=20.0)
+    code = (
+        "import os\n"
+        "print('OPENAI_API_KEY' in os.environ)\n"
+        "print(os.path.exists('/proc/self/environ') and b'secret-key' in open('/proc/self/environ', 'rb').read())"
+    )
+    try:
+        result = backend.execute(code, [sandbox_df], plotting_code=False)
+    finally:
+        backend.close()
+
+    assert result.stdout.splitlines() == ["False", "False"]
+    assert os.environ["OPENAI_API_KEY"] == "secret-key"
+
+
+def test_LocalProcessExecutionBackend_reports_conflicting_tables(local_backend, sandbox_df):
+    other = SandboxDataFrame(pd.DataFrame({"salary": [4]}))
+
+    result = local_backend.execute("print(1)", [other], plotting_code=False)
+
+    assert result.exit_code == 1
+    assert "already holds a different dataframe as df.parquet" in result.stderr
@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+from llm_plotting.dataset import SandboxDataFrame
+from llm_plotting.fast_path import FastPathEvaluator, plan_fast_path
+
+READ = "import pandas as pd\ndf = pd.read_parquet('df.parquet')\n"
+
+
+@pytest.mark.parametrize(
+    "code, allowed",
+    [
+        (READ + "print(df['salary'].isna().sum())", True),
+        (READ + "df['k'] = df['salary'] / 1000\nprint(f\"{df['k'].mean():.2f}\")", True),
+        (READ + "print(df.groupby('job_title')['salary'].mean().round(2).to_dict())", True),
+        (READ + "print(df.to_string(buf='out.txt'))", False),
+        (READ + "print(df.to_string('out.txt'))", False),
+        (READ + "print(df.info('out.txt'))", False),
+        (READ + "print(df.agg({'salary': ['mean', 'max']}))", True),
+        (READ + "print(df.pivot_table(index='job_title', values='salary', aggfunc='median'))", True),
+        (READ + "df.to_csv('out.csv')", False),
+        (READ + "print(df.agg('to_csv', 0, 'out.csv'))", False),
+        (READ + "print(df.aggregate(func=['sum', 'to_csv']))", False),
+        (READ + "print(df.groupby('job_title').agg({'salary': 'to_json'}))", False),
+        (READ + "print(pd.pivot_table(df, 'salary', 'job_title', None, 'to_csv'))", False),
+        (READ + "print(df.groupby('job_title').agg(total=('salary', 'sum')))", True),
+        (READ + "print(df.groupby('job_title').agg(total=('salary', 'to_csv')))", False),
+        (READ + "print(df.round(**{'decimals': 2}))", False),
+        (READ + "print(df.__class__)", False),
+        (READ + "print(df.apply(lambda row: row))", False),
+        (READ + "for column in df.columns:\n    print(column)", False),
+        ("import os\nprint(os.listdir('.'))", False),
+        ("import pandas as pd\ndf = pd.read_csv('/etc/passwd')\nprint(df)", False),
+        ("import pandas as pd\ndf = pd.read_parquet('df.parquet', columns=['salary'])\nprint(df)", False),
+        (READ + "print(open('df.parquet').read())", False),
+        (READ + "x = df['salary'].sum()", False),
+    ],
+)
+def test_plan_fast_path_whitelist(code, allowed):
+    assert (plan_fast_path(code, ["df.parquet"]) is not None) == allowed
+
+
+def test_FastPathEvaluator_runs_with_standard_dtypes_and_limits(tmp_path):
+    df = pd.DataFrame({"job_title": pd.Categorical(["a", "b", "a"]), "salary": pd.array([1, 2, 3], dtype="int8")})
+    sandbox_df = SandboxDataFrame(df)
+    evaluator = FastPathEvaluator(memory_limit_mb=256, timeout=10.0)
+
+    plan = evaluator.plan(
+        READ + "print(df.dtypes.astype(str).to_dict())\nprint(df['salary'].sum() * 100)", [sandbox_df]
+    )
+    result = evaluator.evaluate(plan, [sandbox_df])
+    assert result.exit_code == 0
+    assert result.stdout.splitlines() == ["{'job_title': 'object', 'salary': 'int64'}", "600"]
+
+    plan = evaluator.plan(READ + "x = [1] * 10**10\nprint(len(x))", [sandbox_df])
+    assert evaluator.evaluate(plan, [sandbox_df]) is None
+    assert evaluator.stats()["evaluations"] == 1 and evaluator.stats()["fallbacks"] == 1
+
+    written = tmp_path / "written.txt"
+    assert evaluator.plan(READ + f"print(df.to_string({str(written)!r}))", [sandbox_df]) is None
+    assert not written.exists()
+
+    evaluator.record_sandbox_time(5.0)
+    evaluator.evaluate(evaluator.plan(READ + "print(len(df))", [sandbox_df]), [sandbox_df])
+    assert evaluator.stats()["seconds_saved"] > 4.0
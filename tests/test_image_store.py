@@ -0,0 +1,54 @@
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+from llm_plotting.image_store import ImageStore, prepare_validation_image
+
+
+def make_png(width, height):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_ImageStore_evicts_oldest_beyond_count():
+    image_store = ImageStore(max_images=2)
+    first = image_store.put(b"1")
+    second = image_store.put(b"2")
+    third = image_store.put(b"3")
+
+    assert image_store.get(first) is None
+    assert image_store.get(second).data == b"2"
+    assert image_store.latest_handle == third
+    assert len(image_store) == 2
+
+
+def test_ImageStore_evicts_oldest_beyond_bytes_but_keeps_latest():
+    image_store = ImageStore(max_bytes=10)
+    first = image_store.put(b"x" * 6)
+    second = image_store.put(b"y" * 6)
+    third = image_store.put(b"z" * 20)
+
+    assert image_store.get(first) is None
+    assert image_store.get(second) is None
+    assert image_store.get(third).data == b"z" * 20
+    assert image_store.size_bytes == 20
+
+
+def test_prepare_validation_image_downscales_large_images():
+    image_in_base64, mime_type = prepare_validation_image(make_png(2000, 1000), max_size=500)
+    small_in_base64, _ = prepare_validation_image(make_png(400, 300), max_size=500)
+
+    assert mime_type == "image/png"
+    assert Image.open(BytesIO(base64.b64decode(image_in_base64))).size == (500, 250)
+    assert Image.open(BytesIO(base64.b64decode(small_in_base64))).size == (400, 300)
+
+
+def test_ImageStore_looks_up_latest_handle_by_key():
+    image_store = ImageStore()
+    first = image_store.put(b"1", key="fig = 1")
+    image_store.put(b"2", key="fig = 2")
+
+    assert image_store.latest_handle_for("fig = 1") == first
+    assert image_store.latest_handle_for("fig = 3") is None
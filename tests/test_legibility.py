@@ -0,0 +1,79 @@
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from llm_plotting.executors import ExecutionResult
+from llm_plotting.legibility import LegibilityChecker
+from llm_plotting.tools import CodeValidationTool
+
+
+def check(figure, **kwargs):
+    return LegibilityChecker(**kwargs).check(figure.to_json())
+
+
+def test_LegibilityChecker_accepts_clean_bar_chart():
+    legibility_checker = LegibilityChecker(auto_accept=True)
+    figure = px.bar(x=["engineer", "analyst", "manager"], y=[3, 2, 1], labels={"x": "job", "y": "count"})
+
+    report = legibility_checker.check(figure.to_json())
+
+    assert report.clean
+    assert legibility_checker.accepts(figure.to_plotly_json(), report)
+    assert legibility_checker.stats() == {"rejected": 0, "accepted": 1, "escalated": 0}
+
+
+def test_LegibilityChecker_rejects_clear_failures():
+    many_categories = px.bar(x=[f"job {i}" for i in range(80)], y=list(range(80)))
+    long_labels = px.bar(x=["a very long job title that goes on and on", "short"], y=[1, 2])
+    many_legend_entries = px.scatter(x=list(range(30)), y=list(range(30)), color=[f"group {i}" for i in range(30)])
+    no_titles = go.Figure(go.Scatter(x=[1, 2], y=[2, 1]))
+    empty = go.Figure(go.Bar(x=[], y=[]))
+
+    assert "80 categories" in check(many_categories).issues[0]
+    assert "tickangle" in check(long_labels).issues[0]
+    assert "legend has 30 entries" in check(many_legend_entries).issues[0]
+    assert "title" in check(no_titles).issues[0]
+    assert "no data" in check(empty).issues[0]
+
+
+def test_LegibilityChecker_does_not_count_dates_as_categories():
+    days = pd.date_range("2024-01-01", periods=365)
+    labels = {"x": "day", "y": "sales"}
+    datetimes = px.line(x=days, y=range(365), labels=labels)
+    date_strings = px.line(x=days.strftime("%Y-%m-%d"), y=range(365), labels=labels)
+    forced_categories = px.line(x=days, y=range(365), labels=labels).update_xaxes(type="category")
+
+    assert check(datetimes).clean
+    assert check(date_strings).clean
+    assert "365 categories" in check(forced_categories).issues[0]
+
+
+def test_LegibilityChecker_requires_titles_only_on_axes_with_data():
+    salaries = pd.DataFrame({"salary": [40_000, 55_000, 90_000, 120_000]})
+    box = px.box(salaries, y="salary")
+    untitled_box = go.Figure(go.Box(y=salaries["salary"]))
+
+    assert "title" not in " ".join(check(box).issues)
+    assert check(untitled_box).issues == [
+        "Add a descriptive title to the y axis, e.g. with fig.update_layout(xaxis_title=..., yaxis_title=...)."
+    ]
+
+
+def test_LegibilityChecker_escalates_ambiguous_figures():
+    legibility_checker = LegibilityChecker(auto_accept=True)
+    figure = px.bar(x=[f"job {i}" for i in range(30)], y=list(range(30)))
+
+    report = legibility_checker.check(figure.to_json())
+
+    assert not report.issues and report.warnings
+    assert legibility_checker.stats()["escalated"] == 1
+
+
+def test_CodeValidationTool_answers_without_vision_model(settings):
+    settings = settings.model_copy(update={"legibility_auto_accept": True, "openai_api_base": "http://unreachable"})
+    code_validation_tool = CodeValidationTool(settings=settings)
+    clean = px.bar(x=["a", "b"], y=[1, 2]).to_json().encode("utf-8")
+    cluttered = px.bar(x=[f"job {i}" for i in range(100)], y=list(range(100))).to_json().encode("utf-8")
+
+    assert code_validation_tool._check_legibility(ExecutionResult(figure_json=clean)).startswith("The plot is legible")
+    assert "100 categories" in code_validation_tool._check_legibility(ExecutionResult(figure_json=cluttered))
@@ -0,0 +1,78 @@
+from langchain_core.agents import AgentAction
+from langchain_core.messages import SystemMessage
+
+from llm_plotting.memory import TokenBudgetMemory, code_topic, strip_code_blocks
+from llm_plotting.prompts import IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE
+from llm_plotting.tools import SANDBOX_EXECUTION_ERROR_PREFIX
+
+COLUMNS = ["job_title", "salary", "year"]
+
+
+def plot_code(x: str, y: str, color: str = "blue") -> str:
+    return (
+        "import pandas as pd\n"
+        "import plotly.express as px\n"
+        "df = pd.read_parquet('df.parquet')\n"
+        f"fig = px.bar(df, x='{x}', y='{y}', color_discrete_sequence=['{color}'])"
+    )
+
+
+def step(code: str, observation: str):
+    return AgentAction(tool="CodeValidationTool", tool_input={"code": code, "description": "plot"}, log=""), observation
+
+
+def test_strip_code_blocks_and_code_topic():
+    assert strip_code_blocks("Here it is:\n```python\nprint(1)\n```\n\n\nDone.") == "Here it is:\n\nDone."
+    assert strip_code_blocks("Cut off ```python\nprint(1)") == "Cut off"
+    assert code_topic(plot_code("job_title", "salary"), COLUMNS) == frozenset({"job_title", "salary"})
+    assert code_topic("print(1)", COLUMNS) is None
+
+
+def test_TokenBudgetMemory_keeps_accepted_code_and_drops_superseded_code():
+    memory = TokenBudgetMemory(input_key="user_input", output_key="output", return_messages=True, columns=COLUMNS)
+    rejected, accepted = plot_code("job_title", "salary", "green"), plot_code("job_title", "salary")
+    memory.save_context(
+        {"user_input": "plot salary by job title"},
+        {
+            "output": f"Here you go\n```python\n{accepted}\n```",
+            "intermediate_steps": [
+                step(rejected, "The axis labels overlap"),
+                step(accepted, IMAGE_SAVE_PATHVALIDATION_TOOL_ACCEPTABLE_OUTPUT_MESSAGE),
+            ],
+        },
+    )
+    recoloured = plot_code("job_title", "salary", "red")
+    memory.save_turn("make the bars red", "Done, the bars are red.", code=recoloured)
+    memory.save_context(
+        {"user_input": "print the mean salary"},
+        {
+            "output": "It failed",
+            "intermediate_steps": [step("print(df['salary'].mean(", SANDBOX_EXECUTION_ERROR_PREFIX)],
+        },
+    )
+
+    messages = memory.load_memory_variables({})["chat_history"]
+
+    assert memory.turns[0].code == accepted and memory.turns[2].code is None
+    assert [message.type for message in messages] == ["human", "ai"] * 3
+    assert "```" not in messages[1].content and "Here you go" in messages[1].content
+    assert recoloured in messages[3].content
+    assert "green" not in " ".join(message.content for message in messages)
+    assert memory.last_metrics["superseded_code"] == 1
+    assert memory.last_metrics["verbatim_turns"] == 3
+    assert len(memory.chat_memory.messages) == 6
+
+
+def test_TokenBudgetMemory_summarises_then_drops_old_turns_within_budget():
+    memory = TokenBudgetMemory(input_key="user_input", output_key="output", return_messages=True, token_budget=300)
+    for i in range(20):
+        memory.save_turn(f"question {i} " + "about salaries " * 10, f"answer {i} " + "with details " * 30)
+
+    messages = memory.load_memory_variables({})["chat_history"]
+    metrics = memory.last_metrics
+
+    assert metrics["memory_tokens"] <= 300
+    assert isinstance(messages[0], SystemMessage) and "question" in messages[0].content
+    assert messages[-2].content.startswith("question 19")
+    assert metrics["verbatim_turns"] >= 1 and metrics["summarised_turns"] >= 1 and metrics["dropped_turns"] >= 1
+    assert metrics["verbatim_turns"] + metrics["summarised_turns"] + metrics["dropped_turns"] == 20
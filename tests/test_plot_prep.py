@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from llm_plotting.e2b.plot_prep import OTHER_CATEGORY, PLOT_PREP_MARKER, lttb_indices, prepare_figure
+from llm_plotting.sandbox import LocalSandbox, SandboxPool
+from llm_plotting.tools import CodeValidationTool
+
+
+def test_lttb_indices_keeps_endpoints_and_peaks():
+    x = np.arange(1000, dtype=float)
+    y = np.zeros(1000)
+    y[500] = 10.0
+
+    indices = lttb_indices(x, y, 50)
+
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == 999
+    assert 500 in indices
+
+
+def test_prepare_figure_reduces_oversized_traces(capsys):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"x": rng.normal(size=30000), "y": rng.normal(size=30000)})
+
+    line = prepare_figure(px.line(df, y="y"), max_line_points=100)
+    scatter = prepare_figure(px.scatter(df, x="x", y="y"), max_scatter_points=1000, bins=20)
+    bars = prepare_figure(px.bar(x=[f"c{i}" for i in range(50)], y=np.arange(50)), max_categories=10)
+
+    assert len(line.data[0].y) == 100
+    assert scatter.data[0].type == "heatmap"
+    assert np.nansum(scatter.data[0].z) == 30000
+    assert len(bars.data[0].x) == 10
+    assert bars.data[0].x[-1] == OTHER_CATEGORY
+    assert bars.data[0].y.sum() == np.arange(50).sum()
+    assert capsys.readouterr().out.count(PLOT_PREP_MARKER) == 3
+
+
+def test_prepare_figure_leaves_small_figures_alone(capsys):
+    figure = px.scatter(x=[1, 2, 3], y=[3, 1, 2])
+
+    assert prepare_figure(figure) is figure
+    assert list(figure.data[0].x) == [1, 2, 3]
+    assert capsys.readouterr().out == ""
+
+
+def test_CodeValidationTool_reports_plot_prep_reductions(settings, vision_stub_server):
+    settings = settings.model_copy(
+        update={
+            "openai_api_base": vision_stub_server.api_base,
+            "execution_cache_enabled": False,
+            "plot_prep_max_scatter_points": 1000,
+        }
+    )
+    df = pd.DataFrame({"x": np.arange(5000), "y": np.arange(5000) % 7})
+    sandbox_pool = SandboxPool(sandbox_factory=LocalSandbox, size=1)
+    code_validation_tool = CodeValidationTool(settings=settings, df=df, sandbox_pool=sandbox_pool)
+
+    output = code_validation_tool._run(
+        "import pandas as pd\nimport plotly.express as px\n"
+        "df = pd.read_parquet('df.parquet')\nfig = px.scatter(df, x='x', y='y')",
+        description="y against x",
+        plotting_code=True,
+    )
+    sandbox_pool.close()
+
+    assert output.startswith(vision_stub_server.verdict)
+    assert "5,000 points binned into a 100x100 density heatmap" in output
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from llm_plotting.profiler import iter_chunks, profile_chunks, profile_dataframe
+from llm_plotting.prompt_helper import extract_metadata
+
+
+@pytest.fixture
+def large_df():
+    rng = np.random.default_rng(0)
+    n_rows = 50_000
+    df = pd.DataFrame(
+        {
+            "salary": rng.normal(100_000, 30_000, n_rows),
+            "job_id": rng.integers(0, 5_000, n_rows),
+            "job_title": rng.choice(["analyst", "engineer", "scientist"], n_rows, p=[0.5, 0.3, 0.2]),
+            "posted_at": pd.Timestamp("2020-01-01") + pd.to_timedelta(np.arange(n_rows), unit="h"),
+        }
+    )
+    df.loc[::10, "salary"] = np.nan
+    return df
+
+
+def test_profile_chunks_matches_exact_statistics(large_df):
+    profile = profile_chunks(iter_chunks(large_df, chunk_size=7_000), sample_size=5_000, sketch_size=512)
+    expected = large_df.describe()
+
+    summary = profile["statistical_summary"]["salary"]
+    assert summary["count"] == expected.loc["count", "salary"]
+    assert summary["mean"] == pytest.approx(expected.loc["mean", "salary"])
+    assert summary["std"] == pytest.approx(expected.loc["std", "salary"])
+    assert summary["min"] == pytest.approx(expected.loc["min", "salary"])
+    assert summary["50%"] == pytest.approx(expected.loc["50%", "salary"], rel=0.02)
+
+    assert profile["data_dimensions"] == [50_000, 4]
+    assert profile["missing_values_per_column"]["salary"] == 5_000
+    assert profile["distinct_values_per_column"]["job_id"] == pytest.approx(5_000, rel=0.15)
+    assert profile["distinct_values_per_column"]["job_title"] == 3
+    assert list(profile["top_values_per_column"]["job_title"]) == ["analyst", "engineer", "scientist"]
+    assert profile["datetime_ranges"]["posted_at"] == {
+        "min": "2020-01-01T00:00:00",
+        "max": large_df["posted_at"].max().isoformat(),
+    }
+    json.dumps(profile)
+
+
+def test_profile_dataframe_is_memoised(large_df):
+    assert profile_dataframe(large_df) is profile_dataframe(large_df.copy())
+
+
+def test_extract_metadata_profiles_large_frames(large_df):
+    metadata = json.loads(extract_metadata(large_df, exact_row_limit=10_000))
+
+    assert "distinct_values_per_column" in metadata
+    assert metadata["column_names"] == large_df.columns.tolist()
+
+
+def test_profile_distinct_counts_never_exceed_values(df):
+    profile = profile_dataframe(df)
+
+    for column, distinct in profile["distinct_values_per_column"].items():
+        assert distinct <= df[column].count()
+    assert profile["distinct_values_per_column"]["salary_in_usd"] == pytest.approx(
+        df["salary_in_usd"].nunique(), rel=0.15
+    )
@@ -1,6 +1,12 @@
+import json
 from unittest.mock import mock_open, patch
 
-from llm_plotting.prompt_helper import parse_requirements
+import numpy as np
+import pandas as pd
+
+from llm_plotting.dataset import ingest_csv
+from llm_plotting.profiler import profile_dataframe
+from llm_plotting.prompt_helper import encode_metadata, encode_tables_metadata, parse_requirements, rank_columns
 
 
 def test_parse_requirements():
@@ -19,3 +25,74 @@ def test_parse_requirements():
         result = parse_requirements("requirements.txt", names_only=True)
     expected = "plotly, pandas, numpy, kaleido"
     assert result == expected
+
+
+def _wide_df(n_columns=200, n_rows=50):
+    rng = np.random.default_rng(0)
+    columns = {f"feature_{i}": rng.normal(size=n_rows) for i in range(n_columns)}
+    columns["customerRegion"] = rng.choice(["North", "South", "East"], size=n_rows)
+    columns["order_total"] = rng.uniform(0, 100, size=n_rows)
+    return pd.DataFrame(columns)
+
+
+def test_encode_metadata_handles_wide_frames_within_budget():
+    df = _wide_df()
+    metadata_json, metrics = encode_metadata(df, "plot the order total by customer region", token_budget=500)
+    metadata = json.loads(metadata_json)
+
+    assert metadata["columns"] == df.shape[1]
+    assert metrics["metadata_tokens"] <= 500
+    assert metrics["metadata_tokens"] < metrics["full_metadata_tokens"]
+    assert metrics["detailed_columns"] + metrics["listed_columns"] + metrics["omitted_columns"] == df.shape[1]
+    assert metadata["omitted_columns"] == metrics["omitted_columns"] > 0
+
+
+def test_encode_metadata_details_relevant_columns_first():
+    df = _wide_df()
+    metadata = json.loads(encode_metadata(df, "plot the order total by customer region", token_budget=500)[0])
+
+    assert list(metadata["column_details"])[:2] == ["customerRegion", "order_total"]
+    details = metadata["column_details"]["customerRegion"]
+    assert details["type"] == "object"
+    assert "missing" not in details
+    assert set(details["top"]) == {"North", "South", "East"}
+
+
+def test_encode_metadata_states_standard_dtypes_of_downcast_frames():
+    dataset = ingest_csv(b"job_title,salary,rate\n" + b"analyst,1000,0.5\nengineer,2000,1.5\n" * 50)
+    metadata = json.loads(encode_metadata(dataset.df, "plot salary by job title", token_budget=500)[0])
+
+    assert dataset.df.dtypes.astype(str).tolist() != ["object", "int64", "float64"]
+    assert {column: details["type"] for column, details in metadata["column_details"].items()} == {
+        "job_title": "object",
+        "salary": "int64",
+        "rate": "float64",
+    }
+
+
+def test_rank_columns_matches_mentioned_values_and_close_spellings():
+    df = pd.DataFrame({"a": [1], "country": ["Germany"], "temperature": [1.5], "b": [2]})
+    profile = profile_dataframe(df)
+
+    assert rank_columns(profile, "show sales in Germany")[0] == "country"
+    assert rank_columns(profile, "plot the temprature")[0] == "temperature"
+    assert rank_columns(profile, "")[:2] == ["a", "country"]
+
+
+def test_encode_tables_metadata_lists_join_hints():
+    salaries = pd.DataFrame(
+        {"company_id": [1, 2, 3, 1, 2], "salary": [1.0, 2.0, 3.0, 4.0, 5.0], "job_title": list("abcab")}
+    )
+    companies = pd.DataFrame({"id": [1, 2, 3, 4], "name": ["w", "x", "y", "z"]})
+
+    metadata_json, metrics = encode_tables_metadata({"df": salaries, "companies": companies}, token_budget=1000)
+    metadata = json.loads(metadata_json)
+
+    assert list(metadata["tables"]) == ["df", "companies"]
+    assert metadata["tables"]["companies"]["rows"] == 4
+    (hint,) = metadata["join_hints"]
+    assert hint["left"] == "df.company_id" and hint["right"] == "companies.id"
+    assert hint["overlap"] == 1.0
+    assert not hint["left_unique"] and hint["right_unique"]
+    assert metrics["join_hints"] == 1
+    assert metrics["metadata_tokens"] <= 1000
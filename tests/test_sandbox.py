@@ -0,0 +1,113 @@
+import hashlib
+
+import pandas as pd
+import pytest
+
+from llm_plotting.prompts import IMAGE_SAVE_PATH
+from llm_plotting.sandbox import SANDBOX_CODE_PATH, SANDBOX_HOME, SANDBOX_SCRATCH_DIRS, LocalSandbox, SandboxPool
+from llm_plotting.tools import CodeValidationTool
+
+
+@pytest.fixture
+def sandbox_pool():
+    pool = SandboxPool(sandbox_factory=LocalSandbox, size=1)
+    yield pool
+    pool.close()
+
+
+def test_LocalSandbox_runs_code():
+    with LocalSandbox() as sandbox:
+        sandbox.filesystem.write(SANDBOX_CODE_PATH, "print(open('data.txt').read())")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/data.txt", "hello")
+
+        output = sandbox.process.start_and_wait(cmd=f"python3 {SANDBOX_CODE_PATH}")
+
+    assert output.exit_code == 0
+    assert output.stdout == "hello"
+
+
+def upload(sandbox_pool, sandbox, filename, content):
+    sandbox.filesystem.write(f"{SANDBOX_HOME}/{filename}", content)
+    sandbox_pool.mark_uploaded(sandbox, filename, content, hashlib.sha256(content.encode()).hexdigest())
+
+
+def test_SandboxPool_reuses_and_resets_sandbox(sandbox_pool):
+    with sandbox_pool.lease({"df.parquet": "data"}) as sandbox:
+        sandbox.filesystem.write(SANDBOX_CODE_PATH, "print(1)")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/{IMAGE_SAVE_PATH}", "image")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/written.csv", "private")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/results/out.txt", "private")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/.cache/private.txt", "private")
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/.bashrc", "export LEAKED=1")
+        for path in SANDBOX_SCRATCH_DIRS:
+            sandbox.filesystem.write(f"{path}/.hidden/private.txt", "private")
+        upload(sandbox_pool, sandbox, "df.parquet", "data")
+    first_sandbox = sandbox
+
+    with sandbox_pool.lease({"df.parquet": "data"}) as sandbox:
+        assert sandbox is first_sandbox
+        assert not sandbox.filesystem.exists(SANDBOX_CODE_PATH)
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/{IMAGE_SAVE_PATH}")
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/written.csv")
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/results")
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/.cache")
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/.bashrc")
+        for path in SANDBOX_SCRATCH_DIRS:
+            assert sandbox.filesystem.exists(path)
+            assert not sandbox.filesystem.exists(f"{path}/.hidden")
+        assert sandbox_pool.uploaded_fingerprint(sandbox, "df.parquet") == "data"
+        # code overwriting an upload
+        sandbox.filesystem.write(f"{SANDBOX_HOME}/df.parquet", "changed")
+
+    with sandbox_pool.lease({"df.parquet": "data"}) as sandbox:
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/df.parquet")
+        assert sandbox_pool.uploaded_fingerprint(sandbox, "df.parquet") is None
+
+
+def test_SandboxPool_removes_data_of_other_datasets(sandbox_pool):
+    with sandbox_pool.lease({"df.parquet": "data"}) as sandbox:
+        upload(sandbox_pool, sandbox, "df.parquet", "data")
+        upload(sandbox_pool, sandbox, "company.parquet", "companies")
+
+    with sandbox_pool.lease({"df.parquet": "other data"}) as other_sandbox:
+        assert other_sandbox is sandbox
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/df.parquet")
+        assert not sandbox.filesystem.exists(f"{SANDBOX_HOME}/company.parquet")
+        assert sandbox_pool.uploaded_fingerprint(sandbox, "df.parquet") is None
+
+
+def test_SandboxPool_evicts_idle_and_unhealthy_sandboxes(sandbox_pool):
+    with sandbox_pool.lease() as sandbox:
+        pass
+    sandbox.close()
+
+    with sandbox_pool.lease() as replacement:
+        assert replacement is not sandbox
+
+    sandbox_pool.idle_timeout = 0.0
+    sandbox_pool.evict_idle()
+    assert sandbox_pool.idle_count == 0
+    assert not replacement.is_open
+
+
+def test_SandboxPool_closes_overflow_sandboxes(sandbox_pool):
+    with sandbox_pool.lease() as first, sandbox_pool.lease() as second:
+        assert sandbox_pool.leased_count == 2
+
+    assert sandbox_pool.idle_count == 1
+    assert first.is_open != second.is_open
+
+
+def test_CodeValidationTool_executes_in_pooled_sandbox(settings, sandbox_pool):
+    settings.fast_path_enabled = False
+    df = pd.DataFrame({"salary": [1, 2, 3]})
+    code_validation_tool = CodeValidationTool(settings=settings, df=df, sandbox_pool=sandbox_pool)
+
+    output = code_validation_tool._run(
+        "import pandas as pd\ndf = pd.read_parquet('df.parquet')\nprint(df['salary'].sum())",
+        description="total salary",
+        plotting_code=False,
+    )
+
+    assert output == "6"
+    assert sandbox_pool.idle_count == 1
@@ -0,0 +1,111 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from llm_plotting.scheduler import ConcurrencyLimit, RequestScheduler, SchedulerFullError
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RequestScheduler(max_concurrent_requests=1, max_queued_per_session=2, session_check_interval=0.05)
+    yield scheduler
+    scheduler.close()
+
+
+def test_RequestScheduler_takes_turns_between_sessions(scheduler):
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+            await asyncio.sleep(0.01)
+            return name
+
+        return run
+
+    futures = [scheduler.submit(session, job(name)) for session, name in [("a", "a1"), ("a", "a2"), ("b", "b1")]]
+
+    assert [future.result(timeout=5) for future in futures] == ["a1", "a2", "b1"]
+    assert order == ["a1", "b1", "a2"]
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_RequestScheduler_bounds_queues(scheduler):
+    release = threading.Event()
+
+    async def blocking():
+        await asyncio.to_thread(release.wait)
+
+    try:
+        futures = [scheduler.submit("a", blocking)]
+        while scheduler.stats()["running"] == 0:
+            time.sleep(0.01)
+        futures += [scheduler.submit("a", blocking) for _ in range(2)]
+        with pytest.raises(SchedulerFullError):
+            scheduler.submit("a", blocking)
+        assert scheduler.queue_depth == 2
+    finally:
+        release.set()
+    for future in futures:
+        future.result(timeout=5)
+
+
+def test_RequestScheduler_cancels_work_of_inactive_sessions(scheduler):
+    active = {"a": True, "b": True}
+    scheduler.session_is_active = active.get
+
+    running = scheduler.submit("a", lambda: asyncio.sleep(10))
+    queued = scheduler.submit("b", lambda: asyncio.sleep(10))
+    time.sleep(0.1)
+    active["a"] = active["b"] = False
+
+    with pytest.raises(concurrent.futures.CancelledError):
+        running.result(timeout=5)
+    with pytest.raises(concurrent.futures.CancelledError):
+        queued.result(timeout=5)
+    assert scheduler.stats()["cancelled"] == 2
+
+
+def test_RequestScheduler_streams_and_cancels_when_the_consumer_leaves(scheduler):
+    cancelled = threading.Event()
+
+    async def numbers():
+        try:
+            for i in range(100):
+                yield i
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    stream = scheduler.stream("a", numbers)
+    assert [next(stream) for _ in range(3)] == [0, 1, 2]
+    stream.close()
+
+    assert cancelled.wait(timeout=5)
+
+
+def test_ConcurrencyLimit_caps_holders_across_event_loops():
+    limit = ConcurrencyLimit(2)
+    peak, lock = [0], threading.Lock()
+
+    async def hold():
+        async with limit.slot():
+            with lock:
+                peak[0] = max(peak[0], limit.active)
+            await asyncio.sleep(0.02)
+
+    async def run_many():
+        await asyncio.gather(*[hold() for _ in range(5)])
+
+    threads = [threading.Thread(target=asyncio.run, args=(run_many(),)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+    assert limit.active == 0 and limit.waiting == 0
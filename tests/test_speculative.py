@@ -0,0 +1,99 @@
+import time
+
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+
+from llm_plotting.agent import setup_agent_executor
+from llm_plotting.executors import ExecutionBackend, ExecutionResult
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.speculative import SpeculativeAgentExecutor
+from llm_plotting.tools import CodeValidationTool
+from tests.stubs import ScriptedChatModel, StaticImageBackend, VisionStubServer, tool_call_message
+
+
+class SlowForBadCodeBackend(ExecutionBackend):
+    """Fake sandbox, code containing 'bad' takes a second to run."""
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, code, sandbox_dfs, plotting_code):
+        self.executed.append(code)
+        if "bad" in code:
+            time.sleep(1.0)
+        return ExecutionResult(image=StaticImageBackend().execute(code, sandbox_dfs, plotting_code).image)
+
+
+def verdict_for(payload):
+    prompt = payload["messages"][1]["content"][0]["text"]
+    return "Axis labels overlap" if "bad" in prompt else "The plot is legible"
+
+
+def make_agent_executor(server, responses, num_candidates):
+    settings = Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        openai_api_base=server.api_base,
+        execution_cache_enabled=False,
+        validation_cache_enabled=False,
+    )
+    backend = SlowForBadCodeBackend()
+    code_validation_tool = CodeValidationTool(settings=settings, df=pd.DataFrame(), execution_backend=backend)
+    agent_executor = setup_agent_executor(
+        settings,
+        AgentSettings(num_candidates=num_candidates, max_parallel_candidates=num_candidates),
+        code_validation_tool.df,
+        llm=ScriptedChatModel(responses=responses),
+        code_validation_tool=code_validation_tool,
+    )
+    return agent_executor, backend
+
+
+async def collect(agent_executor):
+    inputs = {"user_input": "plot", "metadata_json": "{}", "dataframe_filename": "df", "dataframe_load_code": ""}
+    return [chunk async for chunk in agent_executor.astream(inputs)]
+
+
+@pytest.mark.asyncio
+async def test_SpeculativeAgentExecutor_first_accepted_candidate_wins():
+    responses = [
+        tool_call_message("fig = 'bad 1'"),
+        tool_call_message("fig = 'good'"),
+        tool_call_message("fig = 'bad 2'"),
+        AIMessage(content="Here is your plot"),
+    ]
+    with VisionStubServer(verdict=verdict_for) as server:
+        agent_executor, backend = make_agent_executor(server, responses, num_candidates=3)
+        assert isinstance(agent_executor, SpeculativeAgentExecutor)
+
+        start = time.perf_counter()
+        chunks = await collect(agent_executor)
+        elapsed = time.perf_counter() - start
+
+    steps = [chunk for chunk in chunks if "steps" in chunk]
+    assert len(steps) == 1
+    assert steps[0]["steps"][0].action.tool_input["code"] == "fig = 'good'"
+    assert steps[0]["steps"][0].observation == "The plot is legible"
+    assert chunks[-1]["output"] == "Here is your plot"
+    assert elapsed < 1.0
+    assert len(backend.executed) == 3
+
+
+@pytest.mark.asyncio
+async def test_SpeculativeAgentExecutor_falls_back_to_feedback_when_none_accepted():
+    responses = [
+        tool_call_message("fig = 'bad 1'"),
+        tool_call_message("fig = 'bad 2'"),
+        tool_call_message("fig = 'good'"),
+        tool_call_message("fig = 'good'  # duplicate candidates only run once"),
+        AIMessage(content="Here is your plot"),
+    ]
+    with VisionStubServer(verdict=verdict_for) as server:
+        agent_executor, backend = make_agent_executor(server, responses, num_candidates=2)
+        chunks = await collect(agent_executor)
+
+    observations = [chunk["steps"][0].observation for chunk in chunks if "steps" in chunk]
+    assert observations == ["Axis labels overlap", "The plot is legible"]
+    assert len(backend.executed) == 3
+    assert chunks[-1]["output"] == "Here is your plot"
@@ -0,0 +1,131 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from llm_plotting.dataset import ingest_csv
+from llm_plotting.executors import E2BExecutionBackend, ExecutionBackend, ExecutionResult
+from llm_plotting.sandbox import LocalSandbox, SandboxPool
+from llm_plotting.settings import AgentSettings, Settings
+from llm_plotting.streaming import PartialJSONString, StreamDelta
+from llm_plotting.streamlit_helper import STAgentInterface
+from llm_plotting.tools import CodeValidationTool
+from tests.stubs import ScriptedChatModel, tool_call_message
+
+
+class PrewarmRecordingBackend(ExecutionBackend):
+    def __init__(self):
+        self.prewarms = 0
+        self.releases = 0
+
+    def prewarm(self, sandbox_dfs):
+        self.prewarms += 1
+
+    def release_prewarmed(self):
+        self.releases += 1
+
+    def execute(self, code, sandbox_dfs, plotting_code):
+        return ExecutionResult(stdout="3")
+
+
+def test_PartialJSONString_decodes_value_split_anywhere():
+    code = 'print("tab\\there")\n# é \U0001f600 / "quoted"'
+    arguments = json.dumps({"description": "not the code", "code": code, "plotting_code": False})
+
+    for size in [1, 2, 5, len(arguments)]:
+        decoder = PartialJSONString("code")
+        decoded = "".join(decoder.feed(arguments[start:][:size]) for start in range(0, len(arguments), size))
+        assert decoded == code
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fast_path_enabled, prewarms", [(False, 1), (True, 0)])
+async def test_STAgentInterface_streams_code_and_prewarms_sandbox(fast_path_enabled, prewarms):
+    settings = Settings(
+        openai_api_key="key",
+        e2b_api_key="key",
+        execution_cache_enabled=False,
+        answer_cache_enabled=False,
+        fast_path_enabled=fast_path_enabled,
+    )
+    dataset = ingest_csv(b"job_title,salary\na,1.0\nb,2.0\n")
+    code = f"import pandas as pd\n{dataset.sandbox_df.load_code}\nprint(df['salary'].sum())"
+    llm = ScriptedChatModel(
+        responses=[tool_call_message(code, "total salary", plotting_code=False), AIMessage(content="The total is 3.")],
+        stream_chunk_size=4,
+    )
+    backend = PrewarmRecordingBackend()
+    code_validation_tool = CodeValidationTool(
+        settings=settings, df=dataset.df, sandbox_df=dataset.sandbox_df, execution_backend=backend
+    )
+    st_agent_interface = STAgentInterface(
+        settings,
+        AgentSettings(),
+        dataset,
+        execute_st_funcs=False,
+        llm=llm,
+        code_validation_tool=code_validation_tool,
+    )
+
+    items = await st_agent_interface.invoke("What is the total salary?")
+
+    deltas = [item["delta"] for item in items if "delta" in item]
+    assert all(isinstance(delta, StreamDelta) for delta in deltas)
+    assert "".join(delta.text for delta in deltas if delta.kind == "code") == code
+    assert "".join(delta.text for delta in deltas if delta.kind == "text") == "The total is 3."
+    assert len({delta.run_id for delta in deltas}) == 2
+    assert items[-1]["chunk"]["output"] == "The total is 3."
+    # code importing only pandas may be answered by the fast path, which needs no sandbox
+    assert backend.prewarms == prewarms
+    assert backend.releases >= 1
+
+
+def test_E2BExecutionBackend_reserves_prewarmed_sandbox(settings):
+    uploads = []
+
+    class CountingSandbox(LocalSandbox):
+        def upload_file(self, file, timeout=None):
+            uploads.append(file.name)
+            return super().upload_file(file, timeout)
+
+    sandbox_df = ingest_csv(b"salary\n1\n2\n").sandbox_df
+    sandbox_pool = SandboxPool(sandbox_factory=CountingSandbox, size=1)
+    backend = E2BExecutionBackend(sandbox_pool)
+    code = f"import pandas as pd\n{sandbox_df.load_code}\nprint(len(df))"
+    try:
+        backend.prewarm([sandbox_df])
+        backend.prewarm([sandbox_df])
+        assert uploads == [sandbox_df.filename]
+        # another session does not get the prewarmed sandbox
+        assert sandbox_pool.idle_count == 0 and sandbox_pool.leased_count == 1
+
+        result = backend.execute(code, [sandbox_df], False)
+        assert sandbox_pool.idle_count == 1 and sandbox_pool.leased_count == 0
+
+        backend.prewarm([sandbox_df])
+        backend.release_prewarmed()
+        assert sandbox_pool.idle_count == 1 and sandbox_pool.leased_count == 0
+    finally:
+        sandbox_pool.close()
+
+    assert result.stdout.strip() == "2"
+    assert uploads == [sandbox_df.filename]
+
+
+def test_E2BExecutionBackend_keeps_prewarms_per_request():
+    sandbox_df = ingest_csv(b"salary\n1\n2\n").sandbox_df
+    sandbox_pool = SandboxPool(sandbox_factory=LocalSandbox, size=2)
+    shared_backend = E2BExecutionBackend(sandbox_pool)
+    first_request, second_request = shared_backend.for_request(), shared_backend.for_request()
+    try:
+        first_request.prewarm([sandbox_df])
+        second_request.prewarm([sandbox_df])
+        assert sandbox_pool.leased_count == 2
+
+        # a request done without executing code keeps its hands off the other's sandbox
+        first_request.release_prewarmed()
+        assert sandbox_pool.leased_count == 1
+        assert second_request._prewarmed is not None
+    finally:
+        second_request.close()
+        sandbox_pool.close()
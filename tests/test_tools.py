@@ -1,7 +1,16 @@
+import asyncio
+import time
+from io import BytesIO
+
+import pandas as pd
 import pytest
+from PIL import Image
 
-from llm_plotting.prompts import IMAGE_SAVE_PATH
-from llm_plotting.tools import CodeValidationTool
+from llm_plotting.executors import ExecutionResult
+from llm_plotting.prompts import FIGURE_SAVE_PATH
+from llm_plotting.settings import Settings
+from llm_plotting.tools import CodeValidationTool, SandboxExecutionError
+from tests.stubs import CountingBackend, StaticImageBackend, VisionStubServer
 
 
 @pytest.fixture
@@ -26,4 +35,91 @@ def test_CodeValidationTool___modify_code(settings, example_code, df):
     code_validation_tool = CodeValidationTool(settings=settings, df=df)
     modified_code = code_validation_tool._modify_code(example_code)
 
-    assert f"import plotly.io as pio\npio.write_image(fig, '{IMAGE_SAVE_PATH }')" in modified_code
+    assert f"import plotly.io as pio\npio.write_json(fig, '{FIGURE_SAVE_PATH }')" in modified_code
+
+
+@pytest.mark.asyncio
+async def test_CodeValidationTool__arun_overlaps_tool_calls():
+    with VisionStubServer(latency=0.3) as server:
+        settings = Settings(
+            openai_api_key="key",
+            e2b_api_key="key",
+            openai_api_base=server.api_base,
+            execution_cache_enabled=False,
+            validation_cache_enabled=False,
+        )
+        code_validation_tool = CodeValidationTool(settings=settings, execution_backend=StaticImageBackend())
+
+        start = time.perf_counter()
+        outputs = await asyncio.gather(
+            *[code_validation_tool._arun(f"fig = {i}", description="plot", plotting_code=True) for i in range(5)]
+        )
+        elapsed = time.perf_counter() - start
+        for i in range(5):
+            await code_validation_tool._arun(f"fig = {i}", description="plot", plotting_code=True)
+
+    assert outputs == [server.verdict] * 5
+    assert elapsed < 5 * server.latency
+    assert server.requests_received == 10
+    assert len(server.connections) <= 5
+
+
+def test_CodeValidationTool_rasterises_figure_json_for_validation(settings):
+    figure_json = b'{"data": [{"type": "bar", "x": ["a", "b"], "y": [1, 2]}], "layout": {}}'
+    code_validation_tool = CodeValidationTool(
+        settings=settings, image_format="jpeg", image_width=2000, image_height=1500, image_scale=2
+    )
+
+    image_in_bytes, mime_type = code_validation_tool._figure_image(ExecutionResult(figure_json=figure_json))
+
+    # the output size does not inflate the images sent to the vision model
+    assert mime_type == "image/png"
+    assert Image.open(BytesIO(image_in_bytes)).size == (
+        settings.validation_image_width,
+        settings.validation_image_height,
+    )
+    assert code_validation_tool.get_validation_renderer().stats()["renders"] == 1
+
+    output = code_validation_tool.get_figure_renderer().render(figure_json)
+    assert Image.open(BytesIO(output)).size == (4000, 3000)
+
+
+def test_CodeValidationTool_keeps_images_per_instance(settings, vision_stub_server):
+    settings = settings.model_copy(
+        update={"openai_api_base": vision_stub_server.api_base, "execution_cache_enabled": False}
+    )
+    tools = [CodeValidationTool(settings=settings, execution_backend=StaticImageBackend()) for _ in range(2)]
+
+    tools[0]._run("fig = 1", description="plot", plotting_code=True)
+
+    stored_image = tools[0].get_image_store().get(tools[0].get_image_store().latest_handle)
+    assert stored_image.data.startswith(b"\x89PNG")
+    assert len(tools[1].get_image_store()) == 0
+
+
+def test_CodeValidationTool__image_validation_request_labels_png(settings):
+    code_validation_tool = CodeValidationTool(settings=settings)
+    image_in_bytes = StaticImageBackend().execute("", [], True).image
+
+    _, _, payload = code_validation_tool._image_validation_request(image_in_bytes, "plot", "code")
+
+    image_url = payload["messages"][1]["content"][1]["image_url"]["url"]
+    assert image_url.startswith("data:image/png;base64,")
+
+
+def test_CodeValidationTool_answers_read_only_questions_in_process(settings):
+    backend = CountingBackend()
+    code_validation_tool = CodeValidationTool(
+        settings=settings, df=pd.DataFrame({"salary": [1.0, None, 3.0]}), execution_backend=backend
+    )
+    read = "import pandas as pd\ndf = pd.read_parquet('df.parquet')\n"
+
+    assert code_validation_tool._execute_code(read + "print(df['salary'].isna().sum())", plotting_code=False) == "1"
+    assert backend.calls == 0
+    with pytest.raises(SandboxExecutionError, match="KeyError"):
+        code_validation_tool._execute_code(read + "print(df['pay'].sum())", plotting_code=False)
+    assert backend.calls == 0
+
+    code_validation_tool._execute_code("import os\nprint(os.getcwd())", plotting_code=False)
+    assert backend.calls == 1
+    assert code_validation_tool.get_fast_path_evaluator().stats()["evaluations"] >= 2
@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from llm_plotting.tracing import JsonlSpanExporter, Tracer, TracingCallbackHandler
+from tests.stubs import ScriptedChatModel
+
+
+def test_Tracer_nests_spans_across_threads_and_exports_finished_traces(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(exporter=JsonlSpanExporter(str(path)))
+
+    def worker():
+        with tracer.span("worker") as span:
+            span.set(payload_bytes=10)
+
+    async def request():
+        with tracer.span("request", session_id="session") as root:
+            with tracer.span("stage"):
+                await asyncio.to_thread(worker)
+            with pytest.raises(ValueError), tracer.span("failing"):
+                raise ValueError("boom")
+        return root
+
+    root = asyncio.run(request())
+
+    trace = tracer.latest_trace("session")
+    assert trace.root is root
+    names = {span.name: span for span in trace.spans}
+    assert names["stage"].parent_id == root.span_id
+    assert names["worker"].parent_id == names["stage"].span_id
+    assert names["worker"].attributes == {"payload_bytes": 10}
+    assert names["failing"].error == "ValueError: boom"
+
+    exported = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [span["name"] for span in exported] == ["request", "stage", "worker", "failing"]
+    assert {span["trace_id"] for span in exported} == {trace.trace_id}
+
+
+def test_TracingCallbackHandler_records_llm_spans_with_token_counts():
+    tracer = Tracer()
+    llm = ScriptedChatModel(responses=[AIMessage(content="a short answer")]).with_config(
+        callbacks=[TracingCallbackHandler(tracer)]
+    )
+
+    with tracer.span("request", session_id="session"):
+        llm.invoke([HumanMessage(content="plot the salaries")])
+        llm.invoke([HumanMessage(content="plot the salaries again")])
+
+    spans = [span for span in tracer.latest_trace("session").spans if span.name == "llm.generate"]
+    assert [span.attributes["iteration"] for span in spans] == [0, 1]
+    assert all(span.attributes["prompt_tokens"] > 0 for span in spans)
+    assert all(span.attributes["completion_tokens"] > 0 for span in spans)
+    assert all(span.end is not None for span in spans)